@@ -0,0 +1,88 @@
+"""
+Benchmark the variable-usage analyzer on deeply nested generated code.
+
+Compares the single-pass VariableUsageVisitor against the previous approach
+(recursive parent map + ancestor walk for every ast.Name).
+
+Usage:
+    python benchmarks/bench_analyzer.py [--depth N] [--width N] [--repeat N]
+"""
+import argparse
+import ast
+import time
+
+from codemate_ai import core
+
+
+def generate_nested_function(depth: int, width: int) -> str:
+    """Generate a function whose body nests for/if/while blocks `depth` levels deep."""
+    lines = ["def nested(data, limit):", "    total = 0"]
+    indent = "    "
+    for level in range(depth):
+        block = ("for", "if", "while")[level % 3]
+        if block == "for":
+            lines.append(f"{indent}for v{level} in data:")
+        elif block == "if":
+            lines.append(f"{indent}if total < limit + {level}:")
+        else:
+            lines.append(f"{indent}while total > limit * {level}:")
+        indent += "    "
+        for i in range(width):
+            lines.append(f"{indent}total = total + data[{i}] * limit - helper(total, {i})")
+    lines.append("    return total")
+    return "\n".join(lines) + "\n"
+
+
+def _legacy_create_parent_map(node):
+    parent_map = {}
+    for child in ast.iter_child_nodes(node):
+        parent_map[child] = node
+        parent_map.update(_legacy_create_parent_map(child))
+    return parent_map
+
+
+def legacy_variable_usage(node):
+    """The analyzer as it was before the single-pass rewrite."""
+    parents = _legacy_create_parent_map(node)
+    usage = {}
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name):
+            labels = usage.setdefault(child.id, set())
+            labels.add(core.CONTEXT_LABELS[type(child.ctx)])
+            current = child
+            while current in parents:
+                current = parents[current]
+                label = core.USAGE_LABELS.get(type(current))
+                if label:
+                    labels.add(label)
+    return {name: sorted(labels) for name, labels in usage.items()}
+
+
+def best_of(func, node, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(node)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--depth", type=int, default=90)
+    parser.add_argument("--width", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for depth in sorted({10, args.depth // 2, args.depth}):
+        node = ast.parse(generate_nested_function(depth, args.width)).body[0]
+        assert core.variable_usage(node) == legacy_variable_usage(node)
+
+        legacy = best_of(legacy_variable_usage, node, args.repeat)
+        single_pass = best_of(core.variable_usage, node, args.repeat)
+        print(f"depth={depth:4d}  legacy={legacy * 1000:9.2f} ms  "
+              f"single-pass={single_pass * 1000:8.2f} ms  speedup={legacy / single_pass:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Benchmark local generation throughput (generated tokens/sec) at batch sizes 1, 4 and 8.
+
+The same set of prompts is sent concurrently through agather_provider, with the
+batch scheduler limited to each batch size in turn.
+
+Usage:
+    python benchmarks/bench_batching.py [--model PATH_OR_ID] [--prompts N] [--new-tokens N]
+"""
+import argparse
+import time
+
+from codemate_ai import providers
+
+PROMPTS = [
+    "def load_csv(path):",
+    "class LinearRegression:",
+    "def tokenize(text):",
+    "import numpy as np\n\ndef normalize(x):",
+    "def fibonacci(n):",
+    "def parse_args():",
+    "class Cache:\n    def __init__(self):",
+    "def train(model, data, epochs):",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--model", default="gpt2")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--prompts", type=int, default=16)
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--batch-sizes", default="1,4,8")
+    args = parser.parse_args()
+
+    if not providers.load_local_transformers_model(args.model, device=args.device, dtype="float32"):
+        raise SystemExit(f"Could not load {args.model}")
+    providers.config.provider = providers.LLMProvider.TRANSFORMERS_LOCAL
+    providers.config.max_tokens = args.new_tokens
+    tokenizer = providers.config.local_tokenizer
+    prompts = [PROMPTS[i % len(PROMPTS)] for i in range(args.prompts)]
+
+    for batch_size in map(int, args.batch_sizes.split(",")):
+        providers.config.local_batch_size = batch_size
+        providers.run_async(providers.agather_provider(prompts[:batch_size]))  # warm-up
+        providers._local_batcher().reset_stats()
+        start = time.perf_counter()
+        results = providers.run_async(providers.agather_provider(prompts, limit=batch_size))
+        elapsed = time.perf_counter() - start
+        tokens = sum(len(tokenizer(text)["input_ids"]) for text in results)
+        stats = providers._local_batcher().stats()
+        print(f"batch={batch_size}  {tokens / elapsed:7.1f} tokens/s  ({tokens} tokens in {elapsed:.2f}s, "
+              f"mean batch {stats['mean_batch_size']:.1f})")
+
+
+if __name__ == "__main__":
+    main()
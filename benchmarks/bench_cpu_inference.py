@@ -0,0 +1,91 @@
+"""
+Compare CPU load time, memory and generation speed of the local model precisions.
+
+Each mode runs in a fresh interpreter so its peak RSS is measured in isolation:
+  float16  the previous hard-coded path
+  float32  full precision
+  bfloat16 half precision, fast on CPUs with AVX512-BF16 / AMX
+  int8     float32 load plus dynamic int8 quantization of nn.Linear layers
+  auto     what load_local_transformers_model picks on this machine
+
+Usage:
+    python benchmarks/bench_cpu_inference.py [--model PATH_OR_ID] [--new-tokens N] [--modes float32,int8,...]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+MODES = {
+    "float16": {"dtype": "float16"},
+    "float32": {"dtype": "float32"},
+    "bfloat16": {"dtype": "bfloat16"},
+    "int8": {"quantize": "int8"},
+    "auto": {},
+}
+
+
+def run_mode(model: str, mode: str, new_tokens: int) -> dict:
+    import torch
+    import transformers  # noqa: F401  (import cost is not part of load time)
+    from codemate_ai import providers
+    from codemate_ai.models import model_memory
+
+    start = time.perf_counter()
+    if not providers.load_local_transformers_model(model, device="cpu", **MODES[mode]):
+        return {"error": "load failed"}
+    load = time.perf_counter() - start
+    weights = sum(model_memory(providers.config.local_model).values()) / 2 ** 20
+
+    local_model, tokenizer = providers.config.local_model, providers.config.local_tokenizer
+    inputs = tokenizer("def load_csv(path):\n    ", return_tensors="pt")
+    generate = dict(max_new_tokens=new_tokens, min_new_tokens=new_tokens, do_sample=False,
+                    pad_token_id=tokenizer.eos_token_id)
+    with torch.inference_mode():
+        local_model.generate(**inputs, max_new_tokens=2, do_sample=False, pad_token_id=tokenizer.eos_token_id)
+        start = time.perf_counter()
+        output = local_model.generate(**inputs, **generate)
+        elapsed = time.perf_counter() - start
+    generated = output.shape[1] - inputs["input_ids"].shape[1]
+    return {
+        "dtype": str(next(local_model.parameters()).dtype).replace("torch.", ""),
+        "load_s": load,
+        "weights_mb": weights,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "tokens_per_s": generated / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--model", default="gpt2")
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_mode(args.model, args.run, args.new_tokens)))
+        return
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.environ.get("PYTHONPATH")])))
+    print(f"{'mode':<9} {'dtype':<9} {'load':>7} {'weights':>8} {'peak RSS':>9} {'tokens/s':>9}")
+    for mode in args.modes.split(","):
+        result = subprocess.run(
+            [sys.executable, __file__, "--model", args.model, "--new-tokens", str(args.new_tokens), "--run", mode],
+            capture_output=True, text=True, env=env
+        )
+        lines = result.stdout.strip().splitlines()
+        stats = json.loads(lines[-1]) if lines else {"error": result.stderr.strip().splitlines()[-1:]}
+        if "error" in stats:
+            print(f"{mode:<9} failed: {stats['error']}")
+            continue
+        print(f"{mode:<9} {stats['dtype']:<9} {stats['load_s']:6.2f}s {stats['weights_mb']:6.0f}MB "
+              f"{stats['peak_rss_mb']:7.0f}MB {stats['tokens_per_s']:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Benchmark the cost of `import codemate_ai` (what `%load_ext codemate_ai` pays).
+
+Runs a fresh interpreter with `-X importtime` and reports the cumulative time
+of the package import and its slowest dependencies. With --max-ms the script
+exits non-zero when the import is slower, so it can guard against regressions.
+
+Usage:
+    python benchmarks/bench_import.py [--runs N] [--top N] [--max-ms MS]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Imported only once the backend that needs them is selected.
+HEAVY_MODULES = ("torch", "transformers", "huggingface_hub", "google.generativeai",
+                 "jupyter_server", "nbformat", "numpy")
+
+
+def import_profile():
+    """Return ({module: cumulative microseconds}, [heavy modules that got imported])."""
+    probe = (
+        "import sys, codemate_ai; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.environ.get("PYTHONPATH")])))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", probe],
+                            capture_output=True, text=True, env=env, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return times, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8)
+    parser.add_argument("--max-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    runs = [import_profile() for _ in range(args.runs)]
+    best = min(times["codemate_ai"] for times, _ in runs) / 1000
+    times, loaded = runs[-1]
+
+    print(f"import codemate_ai: best of {args.runs} = {best:.0f} ms")
+    for name, cumulative in sorted(times.items(), key=lambda item: -item[1])[1:args.top + 1]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+    if loaded:
+        print(f"heavy modules imported eagerly: {', '.join(loaded)}")
+
+    if loaded or (args.max_ms is not None and best > args.max_ms):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark time-to-first-token of local generation with and without prefix KV-cache reuse.
+
+Sends several prompts that share a long context (as the magics do: persona and
+codebase context first, then the cell) to the local Transformers backend.
+
+Usage:
+    python benchmarks/bench_prefix_cache.py [--model PATH_OR_ID] [--context-lines N] [--requests N]
+"""
+import argparse
+import time
+
+from codemate_ai import providers
+
+CONTEXT_LINE = "def helper_{i}(data, scale={i}):\n    return [value * scale for value in data if value > {i}]\n"
+
+
+def time_to_first_token(prompt: str) -> float:
+    start = time.perf_counter()
+    stream = providers.stream_local_transformers(prompt)
+    next(stream, None)
+    elapsed = time.perf_counter() - start
+    stream.close()
+    return elapsed
+
+
+def run(prompts, enabled: bool) -> float:
+    providers.config.prefix_cache = enabled
+    providers.prefix_cache.clear()
+    time_to_first_token(prompts[0])
+    timings = [time_to_first_token(prompt) for prompt in prompts[1:]]
+    return sum(timings) / len(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--model", default="gpt2")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--context-lines", type=int, default=150)
+    parser.add_argument("--requests", type=int, default=5)
+    args = parser.parse_args()
+
+    if not providers.load_local_transformers_model(args.model, device=args.device, dtype="float32"):
+        raise SystemExit(f"Could not load {args.model}")
+    providers.config.max_tokens = 1
+
+    context = "".join(CONTEXT_LINE.format(i=i) for i in range(args.context_lines))
+    prompts = [f"Context of the codebase:\n{context}\n\nExplain helper_{i}." for i in range(args.requests + 1)]
+    prompt_tokens = len(providers.config.local_tokenizer(prompts[0])["input_ids"])
+
+    cold = run(prompts, enabled=False)
+    warm = run(prompts, enabled=True)
+    print(f"prompt={prompt_tokens} tokens  TTFT without prefix cache={cold * 1000:.0f} ms  "
+          f"with prefix cache={warm * 1000:.0f} ms  speedup={cold / warm:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark the BM25 code index: build, incremental update and query latency.
+
+Usage:
+    python benchmarks/bench_retrieval.py [--chunks N] [--queries N]
+"""
+import argparse
+import random
+import tempfile
+import time
+
+from codemate_ai.retrieval import CodeIndex
+
+WORDS = ["load", "save", "parse", "train", "model", "data", "frame", "csv", "plot", "metric",
+         "batch", "token", "cache", "index", "query", "score", "vector", "matrix", "loss", "epoch"]
+
+
+def synthetic_chunk(rng: random.Random, i: int):
+    name = "_".join(rng.sample(WORDS, 3)) + f"_{i}"
+    body = "\n".join(
+        f"    {rng.choice(WORDS)}_{rng.randint(0, 50)} = {rng.choice(WORDS)}({rng.choice(WORDS)}, {rng.randint(0, 9)})"
+        for _ in range(rng.randint(3, 15))
+    )
+    return {"name": name, "kind": "function", "source": f"def {name}(x):\n{body}\n    return x"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    cells = {f"cell{i}": [synthetic_chunk(rng, i * 10 + j) for j in range(10)] for i in range(args.chunks // 10)}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = CodeIndex(path=f"{tmp}/index.json")
+        start = time.perf_counter()
+        index.sync(cells)
+        build = time.perf_counter() - start
+
+        queries = [" ".join(rng.sample(WORDS, 4)) for _ in range(args.queries)]
+        index.search(queries[0])
+        start = time.perf_counter()
+        for query in queries:
+            index.search(query, k=5)
+        per_query = (time.perf_counter() - start) / len(queries)
+
+        cells[f"cell{len(cells)}"] = [synthetic_chunk(rng, -1)]
+        del cells["cell0"]
+        start = time.perf_counter()
+        index.sync(cells)
+        index.search(queries[0])
+        update = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index.save()
+        save = time.perf_counter() - start
+        start = time.perf_counter()
+        CodeIndex.load(index.path)
+        load = time.perf_counter() - start
+
+    print(f"chunks={len(index)}  build={build:.2f}s  query={per_query * 1000:.2f} ms  "
+          f"incremental update+query={update * 1000:.1f} ms  save={save:.2f}s  load={load:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
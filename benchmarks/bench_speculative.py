@@ -0,0 +1,114 @@
+"""
+Benchmark assisted (speculative) decoding of the local backend with a draft model.
+
+Generates greedily from code prompts with the main model alone and with the
+draft model proposing tokens, checks that both produce the same text, and
+reports the draft's accepted-token rate and the end-to-end speedup.
+
+The acceptance rate is derived from forward-pass counts: every verification
+pass of the main model yields the accepted draft tokens plus one token of its
+own, so accepted = new tokens - main passes, out of one proposal per draft pass.
+
+Usage:
+    python benchmarks/bench_speculative.py --model PATH_OR_ID --draft PATH_OR_ID [--tokens N] [--prompts N]
+"""
+import argparse
+import time
+
+from codemate_ai import providers
+
+PROMPTS = [
+    "def fibonacci(n):\n    \"\"\"Return the n-th Fibonacci number.\"\"\"\n",
+    "import json\n\ndef load_config(path):\n    \"\"\"Read a JSON config file and return it as a dict.\"\"\"\n",
+    "class Stack:\n    \"\"\"A simple LIFO stack.\"\"\"\n\n    def __init__(self):\n",
+    "def merge_sorted(a, b):\n    \"\"\"Merge two sorted lists into one sorted list.\"\"\"\n",
+    "def word_count(text):\n    \"\"\"Count how often each word occurs in text.\"\"\"\n",
+]
+
+
+class ForwardCounter:
+    """Counts forward passes of a model through a forward hook."""
+
+    def __init__(self, model):
+        self.calls = 0
+        self._handle = model.register_forward_hook(self._hook)
+
+    def _hook(self, module, inputs, output):
+        self.calls += 1
+
+    def remove(self):
+        self._handle.remove()
+
+
+def generate(prompt: str, max_new_tokens: int, draft=None):
+    model, tokenizer = providers.config.local_model, providers.config.local_tokenizer
+    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+    kwargs = {"assistant_model": draft} if draft is not None else {}
+    start = time.perf_counter()
+    output = model.generate(
+        **inputs,
+        max_new_tokens=max_new_tokens,
+        min_new_tokens=max_new_tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.eos_token_id,
+        **kwargs
+    )
+    elapsed = time.perf_counter() - start
+    new_tokens = output[0, inputs["input_ids"].shape[-1]:]
+    return tokenizer.decode(new_tokens, skip_special_tokens=True), len(new_tokens), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--draft", required=True)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default="float32")
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--prompts", type=int, default=len(PROMPTS))
+    parser.add_argument("--confidence", type=float, default=None,
+                        help="draft confidence below which it stops proposing (transformers default 0.4)")
+    args = parser.parse_args()
+
+    if not providers.load_local_transformers_model(args.model, device=args.device, dtype=args.dtype):
+        raise SystemExit(f"Could not load {args.model}")
+    if not providers.load_draft_model(args.draft, device=args.device, dtype=args.dtype):
+        raise SystemExit(f"Could not load {args.draft}")
+    model, draft = providers.config.local_model, providers.config.draft_model
+    if draft is model:
+        raise SystemExit("The draft must be a different model (or the same one with another --dtype)")
+    if args.confidence is not None:
+        draft.generation_config.assistant_confidence_threshold = args.confidence
+    prompts = PROMPTS[:args.prompts]
+
+    # Warm up both paths
+    generate(prompts[0], 4)
+    generate(prompts[0], 4, draft)
+
+    baseline_time = assisted_time = 0.0
+    tokens = main_passes = draft_passes = 0
+    mismatches = 0
+    for prompt in prompts:
+        text, _, elapsed = generate(prompt, args.tokens)
+        baseline_time += elapsed
+
+        main_counter, draft_counter = ForwardCounter(model), ForwardCounter(draft)
+        assisted_text, new_tokens, elapsed = generate(prompt, args.tokens, draft)
+        main_counter.remove()
+        draft_counter.remove()
+        assisted_time += elapsed
+        tokens += new_tokens
+        main_passes += main_counter.calls
+        draft_passes += draft_counter.calls
+        mismatches += assisted_text != text
+
+    accepted = tokens - main_passes
+    print(f"prompts={len(prompts)}  new tokens={tokens}  main passes={main_passes}  draft passes={draft_passes}")
+    print(f"accepted draft tokens={accepted} ({accepted / max(draft_passes, 1):.0%} of proposals, "
+          f"{tokens / max(main_passes, 1):.2f} tokens per main pass)")
+    print(f"without draft={tokens / baseline_time:.1f} tok/s  with draft={tokens / assisted_time:.1f} tok/s  "
+          f"speedup={baseline_time / assisted_time:.2f}x  outputs identical={mismatches == 0}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Load-test the OpenAI provider path against the local stub server.
+
+Starts codemate_ai.stub_server with a fixed time to first token and token
+rate, sends batches of prompts through agather_provider at several
+concurrency levels, and reports throughput and latency percentiles. Shows
+how much client-side overhead (connection pooling, SSE parsing, rate
+limiting, executor) adds on top of the server's own latency.
+
+Usage:
+    python benchmarks/bench_stub_load.py [--requests N] [--latency S] [--tokens-per-second N]
+"""
+import argparse
+import asyncio
+import time
+
+from codemate_ai import providers
+from codemate_ai.stub_server import StubServer, DEFAULT_RESPONSE, split_tokens
+from codemate_ai.telemetry import percentile
+
+
+async def timed_gather(prompts, limit):
+    latencies = []
+
+    async def one(prompt):
+        start = time.perf_counter()
+        result = await providers.acall_provider(prompt, providers.LLMProvider.OPENAI)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    semaphore = asyncio.Semaphore(limit)
+
+    async def limited(prompt):
+        async with semaphore:
+            return await one(prompt)
+
+    results = await asyncio.gather(*(limited(prompt) for prompt in prompts))
+    return results, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--concurrency", default="1,4,16")
+    args = parser.parse_args()
+
+    tokens = len(split_tokens(DEFAULT_RESPONSE))
+    ideal = args.latency + tokens / args.tokens_per_second
+    with StubServer(latency=args.latency, tokens_per_second=args.tokens_per_second) as server:
+        providers.config.api_keys["openai"].update(api_key=None, base_url=server.url, model="stub")
+        print(f"stub: {tokens} tokens per response, ideal latency {ideal * 1000:.0f} ms")
+        for limit in map(int, args.concurrency.split(",")):
+            providers.config.max_concurrency = limit
+            prompts = [f"Request {i}: reverse a string" for i in range(args.requests)]
+            start = time.perf_counter()
+            results, latencies = providers.run_async(timed_gather(prompts, limit))
+            elapsed = time.perf_counter() - start
+            failed = sum(1 for result in results if result.startswith("Error"))
+            print(f"concurrency={limit:>3}  {args.requests / elapsed:6.1f} req/s  "
+                  f"{args.requests * tokens / elapsed:7.0f} tok/s  "
+                  f"p50={percentile(latencies, 50) * 1000:.0f} ms  p95={percentile(latencies, 95) * 1000:.0f} ms  "
+                  f"overhead p50={(percentile(latencies, 50) - ideal) * 1000:.1f} ms  errors={failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Offline microbenchmark suite for CodeMate's local hot paths, checked against a stored baseline.
+
+Builds synthetic notebooks of increasing size and nesting depth and times
+core.analyze_code, core.create_parent_map, core.extract_code_from_notebook,
+core.display_highlighted_code (on a fenced block, a full response with prose
+around fenced blocks and unfenced code), CodeAssistMagics._split_code_and_explanation
+and prompt construction (context selection, retrieval and _compose_prompt).
+No network access or model is needed.
+
+Each case reports the best of `--repeat` runs. With a baseline file, a case
+slower than its baseline by more than `--tolerance` is a regression and the
+run exits with status 1. Baselines are machine specific: record them with
+`--save-baseline` on the machine that runs the comparison. A baseline is
+the median of `--rounds` runs of the suite, so one unusually fast run does
+not become the reference.
+
+Usage:
+    python benchmarks/run.py [--quick] [--repeat N] [--filter TEXT]
+                             [--baseline PATH] [--save-baseline] [--rounds N] [--tolerance FRACTION]
+"""
+import os
+import io
+import sys
+import ast
+import json
+import time
+import statistics
+import argparse
+import tempfile
+import contextlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Run as a script, only benchmarks/ is on sys.path; make the codemate_ai checkout importable
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# (cells, nesting depth) of the synthetic notebooks
+SIZES = [(10, 2), (100, 8), (400, 24)]
+QUICK_SIZES = SIZES[:2]
+
+
+def make_cell(index: int, depth: int) -> str:
+    """A cell with a helper class and a function whose body nests for/if/while blocks `depth` levels deep."""
+    lines = [
+        f"class Model{index}:",
+        f"    \"\"\"Synthetic model {index}.\"\"\"",
+        "    def __init__(self, scale):",
+        "        self.scale = scale",
+        "",
+        "    def apply(self, values):",
+        "        return [value * self.scale for value in values]",
+        "",
+        f"def process_{index}(data, limit=10):",
+        f"    \"\"\"Process data for step {index}.\"\"\"",
+        f"    model = Model{index}(limit)",
+        "    total = 0",
+    ]
+    indent = "    "
+    for level in range(depth):
+        block = ("for", "if", "while")[level % 3]
+        if block == "for":
+            lines.append(f"{indent}for v{level} in model.apply(data):")
+        elif block == "if":
+            lines.append(f"{indent}if total < limit + {level}:")
+        else:
+            lines.append(f"{indent}while total > limit * {level}:")
+        indent += "    "
+        lines.append(f"{indent}total = total + data[{level % 3}] * limit - len(data)")
+    lines.append("    return total")
+    return "\n".join(lines) + "\n"
+
+
+def make_notebook(cells: int, depth: int) -> List[str]:
+    return [make_cell(i, depth) for i in range(cells)]
+
+
+def write_notebook(sources: List[str], path: str):
+    import nbformat
+    notebook = nbformat.v4.new_notebook()
+    notebook.cells = [nbformat.v4.new_markdown_cell(f"## Step {i}") if i % 5 == 4 else nbformat.v4.new_code_cell(source)
+                      for i, source in enumerate(sources)]
+    with open(path, "w") as f:
+        nbformat.write(notebook, f)
+
+
+def make_response(sources: List[str]) -> str:
+    """An LLM-style response: explanation paragraphs around fenced code blocks."""
+    parts = []
+    for i, source in enumerate(sources):
+        parts.append(f"Step {i} computes a running total over the data and returns it.\n")
+        parts.append(f"```python\n{source}```\n")
+    return "\n".join(parts)
+
+
+def best_of(func: Callable[[], object], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def cases(sizes: List[Tuple[int, int]], workdir: str) -> Dict[str, Callable[[], object]]:
+    """Benchmark name -> zero-argument callable."""
+    from codemate_ai import core
+    from codemate_ai.context import build_context
+    from codemate_ai.magics import CodeAssistMagics
+
+    benchmarks = {}
+    for cells, depth in sizes:
+        label = f"[cells={cells},depth={depth}]"
+        sources = make_notebook(cells, depth)
+        code = "\n".join(sources)
+        tree = ast.parse(code)
+        notebook_path = os.path.join(workdir, f"notebook_{cells}_{depth}.ipynb")
+        write_notebook(sources, notebook_path)
+        response = make_response(sources[:max(1, cells // 10)])
+        fenced = f"```python\n{code}```"
+        full_response = make_response(sources)
+
+        # Build the context tree and retrieval index the prompt is built from
+        context_tree = core.analyze_cells(sources)
+        cell = sources[-1]
+
+        def build_prompt(context_tree=context_tree, cell=cell):
+            snippets = core.search_code(cell, k=5)
+            context, _ = build_context(context_tree, 4000, cell=cell, snippets=snippets)
+            return CodeAssistMagics._compose_prompt(f"Refactor this code:\n{cell}", context)
+
+        benchmarks[f"analyze_code{label}"] = lambda code=code: core.analyze_code(code)
+        benchmarks[f"create_parent_map{label}"] = lambda tree=tree: core.create_parent_map(tree)
+        benchmarks[f"extract_code_from_notebook{label}"] = (
+            lambda path=notebook_path: core.extract_code_from_notebook(path))
+        benchmarks[f"display_highlighted_code{label}"] = lambda fenced=fenced: core.display_highlighted_code(fenced)
+        benchmarks[f"render_response{label}"] = (
+            lambda full_response=full_response: core.display_highlighted_code(full_response))
+        benchmarks[f"render_unfenced{label}"] = lambda code=code: core.display_highlighted_code(code)
+        benchmarks[f"split_code_and_explanation{label}"] = (
+            lambda response=response: CodeAssistMagics._split_code_and_explanation(response))
+        benchmarks[f"build_prompt{label}"] = build_prompt
+    return benchmarks
+
+
+def run_suite(sizes: List[Tuple[int, int]], repeat: int = 5, name_filter: Optional[str] = None) -> Dict[str, float]:
+    """Run the benchmarks and return the best time of each in seconds."""
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        # Keep the cell cache and retrieval index away from the user's cache
+        previous = os.environ.get("CODEMATE_CACHE_DIR")
+        os.environ["CODEMATE_CACHE_DIR"] = os.path.join(workdir, "cache")
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                benchmarks = cases(sizes, workdir)
+                for name, func in benchmarks.items():
+                    if name_filter and name_filter not in name:
+                        continue
+                    func()  # warm up
+                    results[name] = best_of(func, repeat)
+        finally:
+            if previous is None:
+                os.environ.pop("CODEMATE_CACHE_DIR", None)
+            else:
+                os.environ["CODEMATE_CACHE_DIR"] = previous
+    return results
+
+
+def median_results(runs: List[Dict[str, float]]) -> Dict[str, float]:
+    """Per-benchmark median over several suite runs."""
+    return {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    """Names of the benchmarks slower than their baseline by more than `tolerance` (a fraction)."""
+    return [name for name, seconds in results.items()
+            if name in baseline and seconds > baseline[name] * (1 + tolerance)]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--quick", action="store_true", help="skip the largest notebook")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default=None, help="only run benchmarks whose name contains TEXT")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="suite runs whose median is stored with --save-baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed slowdown before failing, as a fraction of the baseline")
+    args = parser.parse_args(argv)
+
+    rounds = max(1, args.rounds) if args.save_baseline else 1
+    results = median_results([run_suite(QUICK_SIZES if args.quick else SIZES, args.repeat, args.filter)
+                              for _ in range(rounds)])
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+
+    width = max(len(name) for name in results)
+    print(f"{'benchmark':<{width}}  {'time':>10}  {'baseline':>10}  {'change':>7}")
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        change = f"{seconds / base - 1:+.0%}" if base else ""
+        flag = "  REGRESSION" if name in regressions else ""
+        base_text = f"{base * 1000:.3f}ms" if base else "-"
+        print(f"{name:<{width}}  {seconds * 1000:>8.3f}ms  {base_text:>10}  {change:>7}{flag}")
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(dict(sorted(baseline.items())), f, indent=2)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}: "
+              + ", ".join(regressions), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,12 @@
 from .magics import CodeAssistMagics
-from .providers import config, LLMProvider
+from .providers import config, LLMProvider, unload_local_models
+from .clients import clients
 
 def load_ipython_extension(ipython):
     """Load the extension in IPython."""
     ipython.register_magics(CodeAssistMagics)
 
 def unload_ipython_extension(ipython):
-    pass
+    """Release pooled provider clients and loaded local models when the extension is unloaded."""
+    clients.reset()
+    unload_local_models()
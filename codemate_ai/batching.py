@@ -0,0 +1,127 @@
+import math
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+from codemate_ai.context import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def length_bucket(tokens: int, minimum: int = 64) -> int:
+    """
+    Power-of-two bucket of a prompt length.
+
+    Prompts in the same bucket differ in length by at most 2x (or are all
+    shorter than `minimum`), which bounds the padding wasted when they are
+    generated as one batch.
+    """
+    return math.ceil(math.log2(max(tokens, minimum)))
+
+
+class _Request:
+    __slots__ = ("prompt", "key", "future", "enqueued")
+
+    def __init__(self, prompt: str, key: tuple):
+        self.prompt = prompt
+        self.key = key
+        self.future = Future()
+        self.enqueued = time.monotonic()
+
+
+class BatchScheduler:
+    """
+    Groups concurrently submitted prompts into batches for one `generate` call.
+
+    Requests are grouped by length bucket and generation parameters. A worker
+    thread takes the oldest pending request and waits up to `max_wait` seconds
+    for more requests with the same key, up to `max_batch_size`. It then runs
+    `generate_batch(prompts, **params)`, which must return one text per prompt,
+    and resolves each caller's future with its own result.
+    """
+
+    def __init__(self, generate_batch: Callable[..., List[str]], max_batch_size: int = 8,
+                 max_wait: float = 0.02, length: Callable[[str], int] = estimate_tokens):
+        self.generate_batch = generate_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.length = length
+        self._pending = []
+        self._condition = threading.Condition()
+        self._worker = None
+        self._closed = False
+        self.batches = 0
+        self.requests = 0
+
+    def submit(self, prompt: str, **params: Any) -> Future:
+        """Queue a prompt; the returned future resolves to its generated text."""
+        request = _Request(prompt, (length_bucket(self.length(prompt)), tuple(sorted(params.items()))))
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("BatchScheduler is closed")
+            self._pending.append(request)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="codemate-batcher", daemon=True)
+                self._worker.start()
+            self._condition.notify()
+        return request.future
+
+    def _next_batch(self) -> Optional[List[_Request]]:
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+            if not self._pending:
+                return None
+
+            key = self._pending[0].key
+            flush_at = self._pending[0].enqueued + self.max_wait
+            while not self._closed:
+                ready = sum(1 for request in self._pending if request.key == key)
+                left = flush_at - time.monotonic()
+                if ready >= self.max_batch_size or left <= 0:
+                    break
+                self._condition.wait(left)
+
+            batch = [request for request in self._pending if request.key == key][:self.max_batch_size]
+            self._pending = [request for request in self._pending if request not in batch]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # Callers that gave up (deadline, cancellation) are dropped from the batch
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            self.batches += 1
+            self.requests += len(batch)
+            try:
+                results = self.generate_batch([request.prompt for request in batch], **dict(batch[0].key[1]))
+                for request, result in zip(batch, results):
+                    request.future.set_result(result)
+            except Exception as e:
+                logger.error(f"Batched generation failed: {e}")
+                for request in batch:
+                    request.future.set_exception(e)
+
+    def reset_stats(self):
+        self.batches = self.requests = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Number of batches run, requests served and the mean batch size."""
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+        }
+
+    def close(self):
+        """Stop the worker once the pending requests are served."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache_dir() -> str:
+    """
+    Returns the directory used for CodeMate's on-disk caches.
+
+    The location can be overridden with the CODEMATE_CACHE_DIR environment variable.
+    """
+    default_dir = os.path.join(os.path.expanduser("~"), ".cache", "codemate_ai")
+    return os.environ.get("CODEMATE_CACHE_DIR", default_dir)
+
+
+class CellCache:
+    """
+    Memoizes per-cell analysis fragments by content hash.
+
+    Fragments are kept in memory and mirrored to a JSON file so they survive
+    kernel restarts. Only cells whose source changed need to be re-parsed.
+    """
+
+    def __init__(self, path: Optional[str] = None, version: int = 1, max_entries: int = 5000):
+        self.path = path or os.path.join(get_cache_dir(), "cells.json")
+        self.version = version
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._loaded = False
+        self._dirty = False
+
+    def key(self, source: str) -> str:
+        """Hash a cell source together with the analyzer version."""
+        digest = hashlib.sha256(f"{self.version}\0{source}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _load(self):
+        self._loaded = True
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.version:
+                self._entries.update(data.get("entries", {}))
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cell cache {self.path}: {e}")
+
+    def get(self, source: str) -> Optional[Dict[str, Any]]:
+        """Return the cached fragment for a cell source, or None."""
+        if not self._loaded:
+            self._load()
+        key = self.key(source)
+        fragment = self._entries.get(key)
+        if fragment is not None:
+            self._entries.move_to_end(key)
+        return fragment
+
+    def put(self, source: str, fragment: Dict[str, Any]):
+        """Store the fragment for a cell source."""
+        if not self._loaded:
+            self._load()
+        key = self.key(source)
+        self._entries[key] = fragment
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    def flush(self):
+        """Write pending entries to disk."""
+        if not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": self.version, "entries": self._entries}, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except Exception as e:
+            logger.warning(f"Could not write cell cache {self.path}: {e}")
+
+    def clear(self):
+        """Drop all entries from memory and disk."""
+        self._entries.clear()
+        self._loaded = True
+        self._dirty = False
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ResponseCache:
+    """
+    Two-tier cache for LLM responses.
+
+    A bounded in-memory LRU sits in front of a SQLite table that persists
+    across kernel restarts. Disk entries expire after `ttl` seconds and the
+    least recently used ones are evicted once the table exceeds `max_disk_bytes`.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_memory_entries: int = 256,
+                 ttl: float = 7 * 24 * 3600, max_disk_bytes: int = 50 * 1024 * 1024):
+        self.path = path or os.path.join(get_cache_dir(), "responses.sqlite")
+        self.max_memory_entries = max_memory_entries
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._db = None
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(provider: str, model: Optional[str], params: Dict[str, Any], persona: str, prompt: str) -> str:
+        """Build the cache key for one request."""
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        material = json.dumps([provider, model, params, persona, prompt_hash], sort_keys=True, default=str)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT, created REAL, accessed REAL, size INTEGER)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _remember(self, key: str, response: str, created: float):
+        self._memory[key] = (response, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for key, or None."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and time.time() - entry[1] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+            self._memory.pop(key, None)
+
+            try:
+                db = self._connect()
+                row = db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and time.time() - row[1] <= self.ttl:
+                    db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+                    db.commit()
+                    self._remember(key, row[0], row[1])
+                    self.disk_hits += 1
+                    return row[0]
+            except sqlite3.Error as e:
+                logger.warning(f"Response cache read failed: {e}")
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, response: str):
+        """Store a response in both tiers."""
+        with self._lock:
+            now = time.time()
+            self._remember(key, response, now)
+            try:
+                db = self._connect()
+                db.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, created, accessed, size) VALUES (?, ?, ?, ?, ?)",
+                    (key, response, now, now, len(response.encode("utf-8")))
+                )
+                self._evict(db, now)
+                db.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Response cache write failed: {e}")
+
+    def _evict(self, db, now: float):
+        db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        for key, size in db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._memory.pop(key, None)
+            total -= size
+            if total <= self.max_disk_bytes:
+                break
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and entry counts."""
+        with self._lock:
+            disk_entries = 0
+            try:
+                disk_entries = self._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            except sqlite3.Error:
+                pass
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries,
+            }
+
+    def clear(self):
+        """Drop all cached responses and reset the counters."""
+        with self._lock:
+            self._memory.clear()
+            self.memory_hits = self.disk_hits = self.misses = 0
+            try:
+                db = self._connect()
+                db.execute("DELETE FROM responses")
+                db.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Response cache clear failed: {e}")
+
+    def close(self):
+        """Close the SQLite connection."""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,64 @@
+import threading
+import logging
+from typing import Any, Callable, Hashable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+def new_http_session(pool_maxsize: int = 16) -> requests.Session:
+    """Create a requests session that keeps connections alive between calls."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class ClientPool:
+    """
+    Keeps one reusable client object (HTTP session, SDK client, model handle) per provider.
+
+    Each client is stored with the configuration key it was built from; asking for
+    a provider with a different key (new API key, model, ...) rebuilds it.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, provider: str, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """Return the client for provider, building it with factory if key changed."""
+        with self._lock:
+            entry = self._clients.get(provider)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+
+            client = factory()
+            if entry is not None:
+                self._close(entry[1])
+            self._clients[provider] = (key, client)
+            return client
+
+    def reset(self, provider: Optional[str] = None):
+        """Drop the cached client for one provider, or for all providers."""
+        with self._lock:
+            names = [provider] if provider else list(self._clients)
+            for name in names:
+                entry = self._clients.pop(name, None)
+                if entry is not None:
+                    self._close(entry[1])
+
+    @staticmethod
+    def _close(client: Any):
+        close = getattr(client, "close", None)
+        if callable(close):
+            try:
+                close()
+            except Exception as e:
+                logger.debug(f"Error closing client: {e}")
+
+
+clients = ClientPool()
@@ -0,0 +1,162 @@
+import ast
+import re
+from typing import Dict, Any, List, Optional, Tuple
+
+# Rough characters-per-token ratio shared by the supported model families.
+CHARS_PER_TOKEN = 4
+
+_IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_TRACEBACK_FRAME = re.compile(r'File "[^"]*", line \d+, in ([A-Za-z_][A-Za-z0-9_]*)')
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in text."""
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def referenced_names(code: str) -> set:
+    """
+    Collect the identifiers used in a piece of code.
+
+    Falls back to a plain identifier scan when the code does not parse.
+    """
+    try:
+        tree = ast.parse(code)
+    except Exception:
+        return set(_IDENTIFIER.findall(code))
+
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        elif isinstance(node, ast.Attribute):
+            names.add(node.attr)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+    return names
+
+
+def traceback_names(error: str) -> List[str]:
+    """Return the function names of the frames in a formatted traceback, innermost last."""
+    return _TRACEBACK_FRAME.findall(error or "")
+
+
+class ContextReport:
+    """Summary of what the context builder kept and dropped."""
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.kept = []
+        self.dropped = []
+        self.snippets = []
+        self.tokens = 0
+
+    @property
+    def total(self) -> int:
+        return len(self.kept) + len(self.dropped)
+
+    def summary(self) -> str:
+        message = f"Context: {len(self.kept)}/{self.total} entries, {len(self.snippets)} snippets (~{self.tokens} tokens)"
+        if self.dropped:
+            message += f"; dropped {len(self.dropped)} to fit the {self.budget}-token budget"
+        return message
+
+
+def _score(kind: str, name: str, info: Dict[str, Any], target: Optional[str],
+           cell_names: set, frames: List[str]) -> int:
+    """Score how relevant one context entry is to the request at hand."""
+    score = 0
+    if target and name == target:
+        score += 100
+    if name in frames:
+        # Frames closer to the failure are more relevant
+        score += 50 + len(frames) - frames[::-1].index(name)
+    if name in cell_names:
+        score += 20
+
+    if kind == "classes":
+        members = info.get("methods", {})
+        for method_name, method_info in members.items():
+            if method_name in frames:
+                score += 30
+            if method_name in cell_names:
+                score += 10
+            score += len(cell_names.intersection(method_info.get("variables", {})))
+    else:
+        score += len(cell_names.intersection(info.get("params", [])))
+        score += len(cell_names.intersection(info.get("variables", {})))
+    return score
+
+
+def build_context(context_tree: Dict[str, Any], budget: int, cell: str = "",
+                  target: Optional[str] = None, error: Optional[str] = None,
+                  snippets: Optional[List[Dict[str, Any]]] = None) -> Tuple[str, ContextReport]:
+    """
+    Select the most relevant context_tree entries that fit into `budget` tokens.
+
+    Entries (top-level functions and classes) are ranked by relevance to the
+    requested function name, the names referenced in the cell and the frames of
+    the traceback, then added greedily while they fit. The kept entries are
+    rendered in notebook order, in the same dict form as `context_tree`.
+    Retrieved source `snippets` (best first) are appended while budget remains.
+
+    Returns:
+    - tuple: (context text, ContextReport)
+    """
+    report = ContextReport(budget)
+    context_tree = context_tree or {}
+    if "no_definitions" in context_tree or not (context_tree.get("functions") or context_tree.get("classes")):
+        text = str(context_tree.get("no_definitions", {}).get("message", ""))
+        report.tokens = estimate_tokens(text) if text else 0
+        return _append_snippets(text, snippets, cell, report)
+
+    cell_names = referenced_names(cell) if cell else set()
+    frames = traceback_names(error)
+
+    entries = []
+    for kind in ("functions", "classes"):
+        for name, info in context_tree.get(kind, {}).items():
+            cost = estimate_tokens(repr({name: info}))
+            score = _score(kind, name, info, target, cell_names, frames)
+            entries.append((len(entries), kind, name, info, cost, score))
+
+    remaining = budget
+    selected = set()
+    for position, kind, name, info, cost, score in sorted(entries, key=lambda e: (-e[5], e[0])):
+        if cost <= remaining:
+            selected.add(position)
+            remaining -= cost
+            report.kept.append(name)
+        else:
+            report.dropped.append(name)
+
+    trimmed = {"functions": {}, "classes": {}}
+    for position, kind, name, info, cost, score in entries:
+        if position in selected:
+            trimmed[kind][name] = info
+
+    text = str(trimmed)
+    report.tokens = estimate_tokens(text)
+    return _append_snippets(text, snippets, cell, report)
+
+
+def _append_snippets(text: str, snippets: Optional[List[Dict[str, Any]]], cell: str,
+                     report: ContextReport) -> Tuple[str, ContextReport]:
+    """Append retrieved source snippets that still fit into the report's budget."""
+    blocks = []
+    for snippet in snippets or []:
+        source = snippet["source"].strip()
+        if not source or source in cell:
+            # The cell itself is already part of the prompt
+            continue
+        block = f"# {snippet['name']}\n{source}"
+        cost = estimate_tokens(block)
+        if report.tokens + cost > report.budget:
+            continue
+        blocks.append(block)
+        report.tokens += cost
+        report.snippets.append(snippet["name"])
+
+    if blocks:
+        text += "\n\nRelevant code from the notebook:\n```python\n" + "\n\n".join(blocks) + "\n```"
+    return text, report
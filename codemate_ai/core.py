@@ -1,13 +1,12 @@
 import ast
 import os
+import re
 import json
 import requests  # Import the missing library
-from typing import Dict, Any
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from typing import Dict, Any, List, Optional
 from IPython import get_ipython
-import nbformat
-from nbformat import NotebookNode
-from jupyter_server.serverapp import list_running_servers
-import astor
+from codemate_ai.cache import CellCache
 from IPython.display import HTML, display
 import ast
 
@@ -32,8 +31,8 @@ def set_style(style):
     """
     global current_style
     try:
-        # Test if the style is valid by creating a formatter
-        HtmlFormatter(style=style)
+        # Test if the style is valid by creating (and caching) its formatter
+        _formatter(style)
         current_style = style
         print(f"Pygments style set to: {style}")
     except Exception:
@@ -49,6 +48,64 @@ from IPython.display import display, Markdown, HTML
 from pygments import highlight
 from pygments.lexers import PythonLexer, guess_lexer
 from pygments.formatters import HtmlFormatter
+from functools import lru_cache
+
+# guess_lexer scores every registered lexer against the text it is given,
+# so language detection only looks at the start of the output.
+DETECTION_SAMPLE_CHARS = 4096
+_FENCE_RE = re.compile(r"^```[ \t]*[\w+#.-]*[ \t]*$", re.MULTILINE)
+
+
+@lru_cache(maxsize=None)
+def _formatter(style, wrapcode=False):
+    """Shared inline-styled HtmlFormatter for a style."""
+    return HtmlFormatter(style=style, noclasses=True, wrapcode=wrapcode)
+
+
+@lru_cache(maxsize=64)
+def _lexer(language):
+    """Shared lexer for a language name, falling back to Python when the name is unknown."""
+    from pygments.lexers import get_lexer_by_name
+    try:
+        return get_lexer_by_name(language)
+    except Exception:
+        return PythonLexer()
+
+
+def _parses_as_python(sample):
+    """True when sample is Python code rather than a bare expression such as a word of prose."""
+    # A sample may end mid-block; fall back to the text before its last top-level line
+    starts = [match.start() for match in re.finditer(r"^\S", sample, re.MULTILINE)]
+    for candidate in (sample, sample[:starts[-1]] if len(starts) > 1 else None):
+        if not candidate:
+            continue
+        try:
+            tree = ast.parse(candidate)
+        except (SyntaxError, ValueError):
+            continue
+        return any(not isinstance(statement, ast.Expr) for statement in tree.body)
+    return False
+
+
+def _detect_lexer(output, default_language='python'):
+    """
+    Pick a lexer for output that is not a single fenced code block.
+
+    Output containing fenced blocks is prose around code, which the Markdown
+    lexer renders with each block highlighted in its own language. Anything
+    else is judged by its first DETECTION_SAMPLE_CHARS characters, cut at a
+    line boundary: a sample that parses as Python uses the Python lexer when
+    that is the default language, otherwise Pygments guesses.
+    """
+    if _FENCE_RE.search(output):
+        return _lexer("markdown")
+    sample = output[:DETECTION_SAMPLE_CHARS]
+    if len(output) > DETECTION_SAMPLE_CHARS and "\n" in sample:
+        sample = sample[:sample.rindex("\n")]
+    if _lexer(default_language).name == "Python" and _parses_as_python(sample):
+        return _lexer(default_language)
+    return guess_lexer(sample)
+
 
 def display_highlighted_code(output, default_language='python'):
     """
@@ -100,8 +157,8 @@ def display_highlighted_code(output, default_language='python'):
 
     # Attempt to auto-detect language if not explicitly specified
     try:
-        lexer = guess_lexer(output)
-        formatter = HtmlFormatter(style=current_style, noclasses=True)  # Use the global `current_style`
+        lexer = _detect_lexer(output, default_language)
+        formatter = _formatter(current_style)  # Use the global `current_style`
         highlighted_code = highlight(output, lexer, formatter)
         display(HTML(highlighted_code))
     except Exception:
@@ -127,16 +184,11 @@ def _highlight_and_display_code(code, language):
     Internal helper to highlight code based on the language and style with smaller font.
     """
     global current_style  # Use the global `current_style` dynamically
-    from pygments.lexers import get_lexer_by_name
-
-    try:
-        lexer = get_lexer_by_name(language)
-    except Exception:
-        # If the language is unsupported, fall back to the default
-        lexer = PythonLexer()
+    # Unsupported languages fall back to Python
+    lexer = _lexer(language)
 
     # Apply smaller font size using custom CSS
-    formatter = HtmlFormatter(style=current_style, noclasses=True, wrapcode=True)
+    formatter = _formatter(current_style, wrapcode=True)
     highlighted_code = highlight(code, lexer, formatter)
     styled_code = f"""
     <style>
@@ -337,14 +389,196 @@ def print_context_summary():
 
 def create_parent_map(node: ast.AST) -> Dict[ast.AST, ast.AST]:
     """
-    Recursively build a dictionary mapping each node to its direct parent node.
+    Build a dictionary mapping each node to its direct parent node.
     """
     parent_map = {}
-    for child in ast.iter_child_nodes(node):
-        parent_map[child] = node
-        parent_map.update(create_parent_map(child))
+    stack = [node]
+    while stack:
+        parent = stack.pop()
+        for child in ast.iter_child_nodes(parent):
+            parent_map[child] = parent
+            stack.append(child)
     return parent_map
 
+
+# Usage labels applied to every variable nested anywhere below one of these nodes.
+USAGE_LABELS = {
+    ast.BinOp: "arithmetic",
+    ast.Call: "function_call",
+    ast.Compare: "comparison",
+    ast.Subscript: "index",
+    ast.Return: "return_value",
+    ast.For: "loop_usage",
+    ast.While: "loop_usage",
+    ast.If: "conditional_usage",
+    ast.IfExp: "conditional_usage",
+}
+
+CONTEXT_LABELS = {
+    ast.Store: "write",
+    ast.Load: "read",
+    ast.Del: "delete",
+}
+
+
+class VariableUsageVisitor(ast.NodeVisitor):
+    """
+    Collect read/write/delete and usage labels for every variable in a single pass.
+
+    Labels of the enclosing nodes (loops, conditionals, calls, ...) are tracked
+    as a stack of active counts while descending, so each node is visited once
+    and no parent map is needed.
+    """
+
+    def __init__(self):
+        self.variables = {}
+        self._active = {}
+
+    def visit(self, node: ast.AST):
+        label = USAGE_LABELS.get(type(node))
+        if label:
+            self._active[label] = self._active.get(label, 0) + 1
+
+        if isinstance(node, ast.Name):
+            labels = self.variables.setdefault(node.id, set())
+            ctx_label = CONTEXT_LABELS.get(type(node.ctx))
+            if ctx_label:
+                labels.add(ctx_label)
+            labels.update(self._active)
+
+        self.generic_visit(node)
+
+        if label:
+            if self._active[label] == 1:
+                del self._active[label]
+            else:
+                self._active[label] -= 1
+
+    def usage(self) -> Dict[str, List[str]]:
+        """Return the collected usage as JSON-friendly sorted lists."""
+        return {name: sorted(labels) for name, labels in self.variables.items()}
+
+
+def variable_usage(node: ast.AST) -> Dict[str, List[str]]:
+    """Return the variable usage map for a function or method node."""
+    visitor = VariableUsageVisitor()
+    visitor.visit(node)
+    return visitor.usage()
+
+
+# Bump whenever the shape of an analysis fragment changes so stale cache entries are ignored.
+ANALYZER_VERSION = 3
+
+cell_cache = CellCache(version=ANALYZER_VERSION)
+
+
+def _code_chunks(tree: ast.AST, code: str) -> List[Dict[str, str]]:
+    """
+    Split a parsed cell into retrievable source chunks.
+
+    Functions become one chunk each, classes one chunk per method (or one for
+    the whole class if it has none), and runs of other top-level statements
+    are grouped into a single "<module>" chunk.
+    """
+    chunks = []
+    pending = []
+
+    def flush_pending():
+        if pending:
+            source = "\n".join(ast.get_source_segment(code, stmt) or "" for stmt in pending)
+            chunks.append({"name": "<module>", "kind": "code", "source": source})
+            pending.clear()
+
+    for node in ast.iter_child_nodes(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            flush_pending()
+            chunks.append({"name": node.name, "kind": "function", "source": ast.get_source_segment(code, node) or ""})
+        elif isinstance(node, ast.ClassDef):
+            flush_pending()
+            methods = [sub for sub in node.body if isinstance(sub, (ast.FunctionDef, ast.AsyncFunctionDef))]
+            if not methods:
+                chunks.append({"name": node.name, "kind": "class", "source": ast.get_source_segment(code, node) or ""})
+            for method in methods:
+                chunks.append({
+                    "name": f"{node.name}.{method.name}",
+                    "kind": "method",
+                    "source": ast.get_source_segment(code, method) or ""
+                })
+        elif isinstance(node, ast.stmt):
+            pending.append(node)
+    flush_pending()
+    return chunks
+
+
+def _analyze_tree(tree: ast.AST, code: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Extract top-level functions and classes from a parsed module.
+
+    Returns a fragment with "functions" and "classes" entries shaped like `context_tree`.
+    When the source `code` is given, the fragment also carries its retrieval "chunks".
+    """
+    fragment = {
+        "functions": {},
+        "classes": {}
+    }
+
+    # Iterate over top-level nodes (functions, classes, etc.)
+    for node in ast.iter_child_nodes(tree):
+        # 1) Top-level Functions
+        if isinstance(node, ast.FunctionDef):
+            func_name = node.name
+            params = [arg.arg for arg in node.args.args]
+            docstring = ast.get_docstring(node)
+
+            var_usage = variable_usage(node)
+
+            fragment["functions"][func_name] = {
+                "params": params,
+                "docstring": docstring,
+                "variables": var_usage
+            }
+
+        # 2) Top-level Classes
+        elif isinstance(node, ast.ClassDef):
+            class_name = node.name
+            class_docstring = ast.get_docstring(node)
+            methods = {}
+
+            for subnode in node.body:
+                if isinstance(subnode, ast.FunctionDef):
+                    method_name = subnode.name
+                    method_params = [arg.arg for arg in subnode.args.args]
+                    method_doc = ast.get_docstring(subnode)
+
+                    method_vars = variable_usage(subnode)
+                    methods[method_name] = {
+                        "params": method_params,
+                        "docstring": method_doc,
+                        "variables": method_vars
+                    }
+
+            fragment["classes"][class_name] = {
+                "docstring": class_docstring,
+                "methods": methods
+            }
+
+    if code is not None:
+        fragment["chunks"] = _code_chunks(tree, code)
+
+    return fragment
+
+
+def _finalize_context_tree(tree: Dict[str, Any]) -> Dict[str, Any]:
+    """Publish `tree` as the global context_tree, adding the no-definitions placeholder."""
+    global context_tree
+    if not tree["functions"] and not tree["classes"]:
+        tree["no_definitions"] = {
+            "message": "No functions or classes found in the code."
+        }
+    context_tree = tree
+    return context_tree
+
+
 def analyze_code(code: str) -> Dict[str, Any]:
     """
     Parse code to extract:
@@ -358,176 +592,162 @@ def analyze_code(code: str) -> Dict[str, Any]:
         e.g. "loop_usage", "conditional_usage", "arithmetic", "function_call", etc.
     """
     global context_tree
+    try:
+        return _finalize_context_tree(_analyze_tree(ast.parse(code)))
+    except Exception as e:
+        print(f"Error parsing code: {e}")
+
     context_tree = {
         "functions": {},
         "classes": {}
     }
-    found_any_definitions = False
-
-    # Extend usage_map to include loops and conditionals (plus existing ops).
-    usage_map = {
-        ast.BinOp: "arithmetic",
-        ast.Call: "function_call",
-        ast.Compare: "comparison",
-        ast.Subscript: "index",
-        ast.Return: "return_value",
-        ast.For: "loop_usage",
-        ast.While: "loop_usage",
-        ast.If: "conditional_usage",
-        ast.IfExp: "conditional_usage",
-    }
+    return context_tree
 
-    try:
-        tree = ast.parse(code)
-
-        # Helper function to gather usage labels from all parents
-        def gather_parent_usage_labels(node_name: ast.Name, parent_dict: Dict[ast.AST, ast.AST]) -> set:
-            """
-            Given an ast.Name node and a parent map, climb up the chain
-            and collect all relevant usage labels (loop_usage, conditional_usage, etc.).
-            """
-            labels = set()
-            current = node_name
-
-            # Walk up until we have no parent or we've hit the root
-            while current in parent_dict:
-                current = parent_dict[current]
-                label = usage_map.get(type(current), None)
-                if label:
-                    labels.add(label)
-
-            return labels
-
-        # Iterate over top-level nodes (functions, classes, etc.)
-        for node in ast.iter_child_nodes(tree):
-            # 1) Top-level Functions
-            if isinstance(node, ast.FunctionDef):
-                found_any_definitions = True
-
-                func_name = node.name
-                params = [arg.arg for arg in node.args.args]
-                docstring = ast.get_docstring(node)
-
-                # Create a parent map inside this function
-                func_parents = create_parent_map(node)
-                var_usage = {}
-
-                # Walk the function AST
-                for child in ast.walk(node):
-                    if isinstance(child, ast.Name):
-                        var_name = child.id
-                        if var_name not in var_usage:
-                            var_usage[var_name] = set()
-
-                        # (1) Read/Write/Delete
-                        usage_type = type(child.ctx).__name__  # "Load", "Store", or "Del"
-                        if usage_type == "Store":
-                            var_usage[var_name].add("write")
-                        elif usage_type == "Load":
-                            var_usage[var_name].add("read")
-                        elif usage_type == "Del":
-                            var_usage[var_name].add("delete")
-
-                        # (2) Gather *all* parent usage labels
-                        parent_labels = gather_parent_usage_labels(child, func_parents)
-                        var_usage[var_name].update(parent_labels)
-
-                # Convert sets to lists for JSON-friendly structure
-                var_usage = {k: list(v) for k, v in var_usage.items()}
-
-                context_tree["functions"][func_name] = {
-                    "params": params,
-                    "docstring": docstring,
-                    "variables": var_usage
-                }
-
-            # 2) Top-level Classes
-            elif isinstance(node, ast.ClassDef):
-                found_any_definitions = True
-
-                class_name = node.name
-                class_docstring = ast.get_docstring(node)
-                methods = {}
-
-                for subnode in node.body:
-                    if isinstance(subnode, ast.FunctionDef):
-                        method_name = subnode.name
-                        method_params = [arg.arg for arg in subnode.args.args]
-                        method_doc = ast.get_docstring(subnode)
-
-                        # Create a parent map for this method
-                        method_parents = create_parent_map(subnode)
-                        method_vars = {}
-
-                        # Walk the method AST
-                        for grandchild in ast.walk(subnode):
-                            if isinstance(grandchild, ast.Name):
-                                var_name = grandchild.id
-                                if var_name not in method_vars:
-                                    method_vars[var_name] = set()
-
-                                # (1) Read/Write/Delete
-                                usage_type = type(grandchild.ctx).__name__
-                                if usage_type == "Store":
-                                    method_vars[var_name].add("write")
-                                elif usage_type == "Load":
-                                    method_vars[var_name].add("read")
-                                elif usage_type == "Del":
-                                    method_vars[var_name].add("delete")
-
-                                # (2) Gather *all* parent usage labels
-                                parent_labels = gather_parent_usage_labels(grandchild, method_parents)
-                                method_vars[var_name].update(parent_labels)
-
-                        method_vars = {k: list(v) for k, v in method_vars.items()}
-                        methods[method_name] = {
-                            "params": method_params,
-                            "docstring": method_doc,
-                            "variables": method_vars
-                        }
-
-                context_tree["classes"][class_name] = {
-                    "docstring": class_docstring,
-                    "methods": methods
-                }
-
-        # 3) If code has no functions/classes, store a placeholder
-        if not found_any_definitions:
-            context_tree["no_definitions"] = {
-                "message": "No functions or classes found in the code."
-            }
 
+def analyze_cell(code: str) -> Optional[Dict[str, Any]]:
+    """
+    Analyze a single cell, reusing the cached fragment when the source is unchanged.
+
+    Returns None if the cell cannot be parsed. Parse failures are cached too,
+    so a broken cell kept in the input history is only reported once.
+    """
+    fragment = cell_cache.get(code)
+    if fragment is not None:
+        return None if "error" in fragment else fragment
+
+    try:
+        fragment = _analyze_tree(ast.parse(code), code)
     except Exception as e:
         print(f"Error parsing code: {e}")
+        cell_cache.put(code, {"error": str(e)})
+        return None
 
-    return context_tree
+    cell_cache.put(code, fragment)
+    return fragment
+
+
+def analyze_cells(cells: List[str]) -> Dict[str, Any]:
+    """
+    Build the context tree from individual cell sources.
+
+    Each cell is analyzed once per distinct source; unchanged cells are served
+    from the in-memory / on-disk cell cache and merged in notebook order, so
+    later definitions override earlier ones just like in `analyze_code`.
+    """
+    tree = {
+        "functions": {},
+        "classes": {}
+    }
+
+    indexed_cells = {}
+    for cell in cells:
+        fragment = analyze_cell(cell)
+        if fragment is None:
+            continue
+        tree["functions"].update(fragment["functions"])
+        tree["classes"].update(fragment["classes"])
+        indexed_cells[cell_cache.key(cell)] = fragment.get("chunks", [])
+
+    cell_cache.flush()
 
+    index = get_code_index()
+    index.sync(indexed_cells)
+    index.save()
 
+    return _finalize_context_tree(tree)
 
 
+code_index = None
 
-def get_notebook_path() -> str:
-    """Get the path of the current Jupyter notebook."""
+
+def get_code_index() -> "CodeIndex":
+    """Return the retrieval index over the analyzed cells, loading it from disk on first use."""
+    global code_index
+    if code_index is None:
+        # Imported here so that NumPy is only loaded once retrieval is used
+        from codemate_ai.retrieval import CodeIndex
+        code_index = CodeIndex.load()
+    return code_index
+
+
+def search_code(query: str, k: int = 5) -> List[Dict[str, Any]]:
+    """Return the k code chunks most relevant to query."""
+    return get_code_index().search(query, k)
+
+
+
+
+
+# kernel id -> notebook path, reused until the file disappears or the kernel changes.
+_notebook_paths = {}
+
+# Seconds allowed for probing all running Jupyter servers.
+NOTEBOOK_DISCOVERY_TIMEOUT = 2.0
+
+
+def _find_session_path(server: Dict[str, Any], kernel_id: str, timeout: float) -> Optional[str]:
+    """Ask one Jupyter server for the notebook attached to kernel_id."""
+    try:
+        response = requests.get(
+            f"{server['url']}api/sessions",
+            params={"token": server.get("token", "")},
+            verify=False,
+            timeout=timeout,
+        )
+        response.raise_for_status()
+
+        for session in response.json():
+            if session["kernel"]["id"] == kernel_id:
+                return os.path.join(server["root_dir"], session["notebook"]["path"])
+    except Exception:
+        pass
+    return None
+
+
+def list_running_servers():
+    """List running Jupyter servers; jupyter_server is only imported when a path is looked up."""
+    from jupyter_server.serverapp import list_running_servers as running_servers
+    return running_servers()
+
+
+def clear_notebook_path_cache():
+    """Forget previously discovered notebook paths."""
+    _notebook_paths.clear()
+
+
+def get_notebook_path(timeout: float = NOTEBOOK_DISCOVERY_TIMEOUT) -> str:
+    """
+    Get the path of the current Jupyter notebook.
+
+    The result is cached per kernel. On a miss, all running servers are probed
+    concurrently and the first one that knows this kernel wins; servers that
+    do not answer within `timeout` seconds are abandoned.
+    """
     try:
         connection_file = os.path.basename(get_ipython().config['IPKernelApp']['connection_file'])
         kernel_id = connection_file.split('-', 1)[1].split('.')[0]
 
-        for server in list_running_servers():
+        cached = _notebook_paths.get(kernel_id)
+        if cached and os.path.exists(cached):
+            return cached
+        _notebook_paths.pop(kernel_id, None)
+
+        servers = list(list_running_servers())
+        if servers:
+            executor = ThreadPoolExecutor(max_workers=min(len(servers), 8))
+            futures = [executor.submit(_find_session_path, server, kernel_id, timeout) for server in servers]
             try:
-                response = requests.get(
-                    f"{server['url']}api/sessions",
-                    params={"token": server.get("token", "")},
-                    verify=False,
-                )
-                response.raise_for_status()
-                sessions = response.json()
-
-                for session in sessions:
-                    if session["kernel"]["id"] == kernel_id:
-                        return os.path.join(server["root_dir"], session["notebook"]["path"])
-            except Exception as e:
-                
-                continue
+                for future in as_completed(futures, timeout=timeout):
+                    path = future.result()
+                    if path:
+                        _notebook_paths[kernel_id] = path
+                        return path
+            except FuturesTimeoutError:
+                pass
+            finally:
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=False)
 
         raise RuntimeError("Could not find the notebook path.")
     except Exception as e:
@@ -535,9 +755,17 @@ def get_notebook_path() -> str:
         return None
 
 
-def extract_code_from_notebook(notebook_path: str) -> str:
-    """Extract code cells from a Jupyter notebook."""
+def _strip_magics(source: str) -> str:
+    """Drop magic, shell and pip lines from a cell source."""
+    return '\n'.join(line for line in source.split('\n')
+                     if not line.strip().startswith(('!', '%', 'pip')))
+
+
+def extract_cells_from_notebook(notebook_path: str) -> List[str]:
+    """Extract the source of each non-empty code cell from a Jupyter notebook."""
     try:
+        # nbformat pulls in jsonschema, which is slow to import
+        import nbformat
         with open(notebook_path, 'r') as f:
             nb = nbformat.read(f, as_version=4)
 
@@ -545,14 +773,76 @@ def extract_code_from_notebook(notebook_path: str) -> str:
         for cell in nb.cells:
             if cell.cell_type == 'code':
                 # Skip magic commands and shell commands
-                code = '\n'.join(line for line in cell.source.split('\n')
-                                 if not line.strip().startswith(('!', '%', 'pip')))
+                code = _strip_magics(cell.source)
                 if code.strip():
                     code_cells.append(code)
 
-        return '\n\n'.join(code_cells)
+        return code_cells
     except Exception as e:
         print(f"Error extracting code: {e}")
-        return ""
+        return []
+
+
+def extract_code_from_notebook(notebook_path: str) -> str:
+    """Extract code cells from a Jupyter notebook."""
+    return '\n\n'.join(extract_cells_from_notebook(notebook_path))
 
 
+def extract_cells_from_kernel(shell=None) -> List[str]:
+    """
+    Extract executed cell sources from the kernel's input history.
+
+    Unlike reading the .ipynb file this needs no server lookup or file I/O and
+    also sees cells that have been run but not saved. Cells executed several
+    times with the same source are kept once, at their latest position.
+    """
+    shell = shell or get_ipython()
+    if shell is None or getattr(shell, "history_manager", None) is None:
+        return []
+
+    latest = {}
+    for position, source in enumerate(shell.history_manager.input_hist_raw):
+        code = _strip_magics(source)
+        if code.strip():
+            latest.pop(code, None)
+            latest[code] = position
+
+    return list(latest)
+
+
+source_mode = "kernel"
+
+
+def set_source_mode(mode):
+    """
+    Sets where notebook code is read from.
+
+    Parameters:
+    - mode (str): 'kernel' to read the kernel's input history (falling back to the
+      saved notebook when the history is empty), or 'notebook' to always read the .ipynb file.
+    """
+    global source_mode
+    if mode not in ('kernel', 'notebook'):
+        raise ValueError(f"Invalid source: '{mode}'. Valid sources are: kernel, notebook")
+    source_mode = mode
+    print(f"Code source set to: {mode}")
+
+
+def get_source_cells(notebook_path: Optional[str] = None) -> Optional[List[str]]:
+    """
+    Returns the code cells to analyze, or None if no source could be found.
+
+    An explicit notebook_path always reads that file.
+    """
+    if notebook_path:
+        return extract_cells_from_notebook(notebook_path)
+
+    if source_mode == 'kernel':
+        cells = extract_cells_from_kernel()
+        if cells:
+            return cells
+
+    notebook_path = get_notebook_path()
+    if not notebook_path:
+        return None
+    return extract_cells_from_notebook(notebook_path)
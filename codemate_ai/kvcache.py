@@ -0,0 +1,111 @@
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional, Sequence, Tuple
+
+# Shorter shared prefixes are cheaper to prefill than to copy from the cache.
+MIN_PREFIX_TOKENS = 32
+
+
+def prefix_key(token_ids: Sequence[int]) -> str:
+    """Hash a token id sequence."""
+    return hashlib.sha256(",".join(map(str, token_ids)).encode("ascii")).hexdigest()
+
+
+def common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    """Number of leading tokens a and b have in common."""
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+class PrefixKVCache:
+    """
+    Reuses the key/value cache of previously prefilled prompts in local generation.
+
+    After a generation, the KV cache of its prompt is stored under the hash of
+    the prompt's token ids. A new prompt that starts with the same tokens (the
+    persona and codebase context come first in every prompt) gets a copy of the
+    stored cache cropped to the shared prefix, so only the differing suffix is
+    prefilled. Entries belong to one model, identified by its registry key;
+    using another model clears them, and so does unloading the owner.
+    """
+
+    def __init__(self, max_entries: int = 4, min_prefix: int = MIN_PREFIX_TOKENS):
+        self.max_entries = max_entries
+        self.min_prefix = min_prefix
+        self._entries = OrderedDict()
+        self._owner = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _check_owner(self, owner: Hashable):
+        if self._owner != owner:
+            self._entries.clear()
+            self._owner = owner
+
+    def lookup(self, owner: Hashable, token_ids: List[int]) -> Tuple[Optional[Any], int]:
+        """
+        Return (cache, cached length) for the longest stored prefix of token_ids.
+
+        The returned cache is a private copy that generation may extend. At
+        least one prompt token is always left uncached so generation has an
+        input to start from. Returns (None, 0) on a miss.
+        """
+        with self._lock:
+            self._check_owner(owner)
+            best_key, best_length = None, 0
+            for key, (ids, _) in self._entries.items():
+                length = min(common_prefix_length(ids, token_ids), len(token_ids) - 1)
+                if length > best_length:
+                    best_key, best_length = key, length
+            if best_key is None or best_length < self.min_prefix:
+                self.misses += 1
+                return None, 0
+
+            self._entries.move_to_end(best_key)
+            ids, stored = self._entries[best_key]
+            cache = copy.deepcopy(stored)
+            self.hits += 1
+            self.reused_tokens += best_length
+        excess = cache.get_seq_length() - best_length
+        if excess > 0:
+            cache.crop(-excess)
+        return cache, best_length
+
+    def store(self, owner: Hashable, token_ids: List[int], cache: Any):
+        """Keep the KV cache of a finished generation, cropped to its prompt."""
+        if len(token_ids) < self.min_prefix:
+            return
+        excess = cache.get_seq_length() - len(token_ids)
+        if excess > 0:
+            cache.crop(-excess)
+        with self._lock:
+            self._check_owner(owner)
+            key = prefix_key(token_ids)
+            self._entries[key] = (list(token_ids), cache)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, owner: Hashable):
+        """Drop the stored caches if they belong to owner (a model that was unloaded)."""
+        with self._lock:
+            if self._owner == owner:
+                self._entries.clear()
+                self._owner = None
+
+    def clear(self):
+        """Drop all stored caches and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._owner = None
+            self.hits = self.misses = self.reused_tokens = 0
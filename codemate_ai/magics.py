@@ -9,12 +9,19 @@ from io import StringIO
 import traceback
 from codemate_ai.providers import config, LLMProvider,call_openai,call_gemini,call_anthropic,call_local_transformers,call_huggingface_hub
 from codemate_ai.core import clean_code_output,set_style,set_persona,get_persona,print_context_summary,display_highlighted_code
+from codemate_ai.progress import PipelineProgress, StreamingDisplay
+from codemate_ai.clients import clients
+from codemate_ai.context import build_context, estimate_tokens
+from codemate_ai import telemetry
+from codemate_ai.stopping import StopConditions
 import inspect
 import traceback
 import cProfile
 import pstats
 from io import StringIO
 
+context_tree = {}
+
 
 @magics_class
 class CodeAssistMagics(Magics):
@@ -56,6 +63,229 @@ class CodeAssistMagics(Magics):
         except ValueError as e:
             print(e)        
     
+    @line_magic
+    def set_code_source(self, line):
+        """
+        Choose where the notebook code used for context is read from.
+
+        Usage:
+        %set_code_source kernel|notebook
+        """
+        try:
+            core.set_source_mode(line.strip().lower())
+        except ValueError as e:
+            print(e)
+
+    @line_magic
+    def set_progress(self, line):
+        """
+        Turn the pipeline progress display on or off.
+
+        Usage:
+        %set_progress on|off
+        """
+        value = line.strip().lower()
+        if value not in ("on", "off"):
+            return "Usage: %set_progress on|off"
+
+        config.show_progress = value == "on"
+        return f"Progress display turned {value}"
+
+    @line_magic
+    def codemate_cache(self, line):
+        """
+        Show response cache statistics or clear the cache.
+
+        Usage:
+        %codemate_cache [stats|clear]
+        """
+        action = line.strip().lower() or "stats"
+        if action == "clear":
+            providers.response_cache.clear()
+            providers.prefix_cache.clear()
+            return "Response cache cleared"
+        if action != "stats":
+            return "Usage: %codemate_cache [stats|clear]"
+
+        stats = providers.response_cache.stats()
+        print(f"Hits: {stats['hits']} (memory {stats['memory_hits']}, disk {stats['disk_hits']})")
+        print(f"Misses: {stats['misses']}")
+        print(f"Hit rate: {stats['hit_rate']:.0%}")
+        print(f"Entries: {stats['memory_entries']} in memory, {stats['disk_entries']} on disk")
+        kv = providers.prefix_cache
+        if kv.hits or kv.misses:
+            print(f"Local prefix KV cache: {kv.hits} hits, {kv.misses} misses, {kv.reused_tokens} prompt tokens reused")
+
+    @line_magic
+    def set_context_budget(self, line):
+        """
+        Set the token budget for codebase context in prompts.
+
+        Usage:
+        %set_context_budget <tokens> [provider[/model]]
+        """
+        args = line.split()
+        if not args or not args[0].isdigit():
+            return "Usage: %set_context_budget <tokens> [provider[/model]]"
+
+        key = args[1] if len(args) > 1 else "default"
+        config.context_budgets[key] = int(args[0])
+        return f"Context budget for {key} set to {args[0]} tokens"
+
+    @line_magic
+    def set_rate_limit(self, line):
+        """
+        Limit requests and tokens per minute sent to a provider.
+
+        Usage:
+        %set_rate_limit <provider> [rpm=<n>] [tpm=<n>]
+        %set_rate_limit <provider> off
+        """
+        args = line.split()
+        if not args or args[0] not in config.api_keys:
+            return f"Usage: %set_rate_limit <provider> [rpm=<n>] [tpm=<n>]. Providers: {', '.join(config.api_keys)}"
+
+        provider = args[0]
+        if args[1:] == ["off"]:
+            config.rate_limits.pop(provider, None)
+            return f"Rate limit for {provider} removed"
+
+        limits = {}
+        for arg in args[1:]:
+            name, _, value = arg.partition("=")
+            if name not in ("rpm", "tpm") or not value.isdigit():
+                return "Usage: %set_rate_limit <provider> [rpm=<n>] [tpm=<n>]"
+            limits[name] = int(value)
+        config.rate_limits[provider] = limits
+        return f"Rate limit for {provider}: " + ", ".join(f"{k}={v}" for k, v in limits.items())
+
+    @line_magic
+    def codemate_stats(self, line):
+        """
+        Show timing and token statistics of recent magic calls.
+
+        Usage:
+        %codemate_stats [magic|provider]
+        %codemate_stats clear
+        %codemate_stats sink <path>|off
+        """
+        args = line.split()
+        if args == ["clear"]:
+            telemetry.recorder.clear()
+            return "Telemetry cleared"
+        if len(args) == 2 and args[0] == "sink":
+            telemetry.recorder.sink = None if args[1] == "off" else args[1]
+            return f"Telemetry sink: {telemetry.recorder.sink or 'off'}"
+        if len(args) > 1 or (args and args[0] not in ("magic", "provider")):
+            return "Usage: %codemate_stats [magic|provider] | clear | sink <path>|off"
+
+        by = args[0] if args else "magic"
+        summary = telemetry.recorder.summary(by)
+        if not summary:
+            return "No magic calls recorded yet"
+
+        def seconds(value):
+            return f"{value:.2f}s" if value is not None else "-"
+
+        for key, stats in summary.items():
+            if key is None:
+                # Calls that never reached a provider, e.g. %analyze_code
+                key = "no provider"
+            print(f"{key}: {stats['count']} calls, total p50 {seconds(stats['p50'])} p95 {seconds(stats['p95'])}, "
+                  f"first token p50 {seconds(stats['ttft_p50'])} p95 {seconds(stats['ttft_p95'])}")
+            print(f"    ~{stats['prompt_tokens']:.0f} prompt / ~{stats['completion_tokens']:.0f} completion tokens, "
+                  f"cache hits {stats['cache_hit_rate']:.0%}, errors {stats['errors']}, retries {stats['retries']}")
+            if stats["stages"]:
+                print("    stage p50: " + ", ".join(f"{stage} {seconds(value)}" for stage, value in stats["stages"].items()))
+        return None
+
+    @line_magic
+    def codemate_route(self, line):
+        """
+        Route requests over several providers by their recent latency.
+
+        Usage:
+        %codemate_route <provider> <provider> [...] [--no-hedge]
+        %codemate_route stats
+        %codemate_route off
+        """
+        args = line.split()
+        if not args or args == ["stats"]:
+            if not config.routing:
+                return "Routing is off"
+            print(f"Routing over: {', '.join(p.value for p in config.routing)} (hedging {'on' if config.hedge else 'off'})")
+            for (provider, model), stats in providers.router.summary().items():
+                p50 = f"{stats['p50']:.2f}s" if stats["p50"] is not None else "-"
+                p95 = f"{stats['p95']:.2f}s" if stats["p95"] is not None else "-"
+                print(f"{provider}/{model}: p50 {p50}, p95 {p95}, "
+                      f"errors {stats['error_rate']:.0%} of {stats['samples']}")
+            print(f"Hedged requests: {providers.router.hedged}, won by the hedge: {providers.router.hedge_wins}")
+            return None
+
+        if args == ["off"]:
+            config.routing = []
+            return f"Routing off. Provider: {config.provider.value if config.provider else None}"
+
+        names = [arg.lower() for arg in args if not arg.startswith("--")]
+        valid = [p.value for p in LLMProvider]
+        invalid = [name for name in names if name not in valid]
+        if invalid or len(names) < 2:
+            return f"Usage: %codemate_route <provider> <provider> [...] [--no-hedge] | stats | off. Providers: {', '.join(valid)}"
+
+        config.routing = [LLMProvider(name) for name in dict.fromkeys(names)]
+        config.hedge = "--no-hedge" not in args
+        config.provider = config.provider or config.routing[0]
+        return f"Routing over {', '.join(names)} (hedging {'on' if config.hedge else 'off'})"
+
+    @line_magic
+    def codemate_models(self, line):
+        """
+        List, unload or budget the locally loaded Transformers models.
+
+        Usage:
+        %codemate_models [list]
+        %codemate_models unload <path>|all
+        %codemate_models budget <cpu|cuda> <GiB>
+        """
+        args = line.split()
+        action = args[0].lower() if args else "list"
+        registry = providers.model_registry
+
+        if action == "list":
+            entries = registry.entries()
+            if not entries:
+                return "No local models loaded"
+            for entry in reversed(entries):
+                path, dtype, device = entry.key[:3]
+                active = " (active)" if entry.model is providers.config.local_model else ""
+                memory = ", ".join(f"{name} {size / 2 ** 30:.2f} GiB" for name, size in entry.memory.items())
+                print(f"{path} [{dtype}, {device}]: {memory}{active}")
+            for device, used in registry.usage().items():
+                budget = registry.budget(device)
+                limit = f"{budget / 2 ** 30:.1f} GiB" if budget else "unlimited"
+                print(f"{device}: {used / 2 ** 30:.2f} GiB used of {limit}")
+            return None
+
+        if action == "unload" and len(args) == 2:
+            if args[1] == "all":
+                providers.unload_local_models()
+                return "All local models unloaded"
+            unloaded = 0
+            for entry in registry.entries():
+                if entry.key[0] == args[1]:
+                    # The registry detaches the active model and draft when they are unloaded
+                    unloaded += registry.unload(entry.key)
+            return f"Unloaded {unloaded} model(s) for {args[1]}"
+
+        if action == "budget" and len(args) == 3:
+            try:
+                registry.budgets[args[1]] = int(float(args[2]) * 2 ** 30)
+            except ValueError:
+                return "Usage: %codemate_models budget <cpu|cuda> <GiB>"
+            return f"{args[1]} model budget set to {args[2]} GiB"
+
+        return "Usage: %codemate_models [list] | unload <path>|all | budget <cpu|cuda> <GiB>"
+
     @line_magic
     def set_api_key(self, line):
         """Set API key for a provider."""
@@ -72,9 +302,28 @@ class CodeAssistMagics(Magics):
         providers.config.api_keys[provider]["api_key"] = key
         if model:
             providers.config.api_keys[provider]["model"] = model
+        clients.reset(provider)
             
         return f"API key for {provider} set successfully"
 
+    @line_magic
+    def set_base_url(self, line):
+        """
+        Point a provider at another endpoint, e.g. a self-hosted OpenAI-compatible server.
+
+        Usage:
+        %set_base_url <provider> <url>
+        %set_base_url <provider> default
+        """
+        args = line.split()
+        if len(args) != 2 or args[0] not in providers.config.api_keys:
+            return f"Usage: %set_base_url <provider> <url>|default. Providers: {', '.join(providers.config.api_keys)}"
+
+        provider, url = args
+        providers.config.api_keys[provider]["base_url"] = None if url == "default" else url
+        clients.reset(provider)
+        return f"{provider} endpoint: {providers.base_url(provider) or 'SDK default'}"
+
     @line_magic
     def set_llm_provider(self, line):
         """Set the LLM provider and optionally load a model."""
@@ -86,31 +335,44 @@ class CodeAssistMagics(Magics):
         if provider_name not in [p.value for p in providers.LLMProvider]:
             return f"Invalid provider. Choose from: {', '.join(p.value for p in providers.LLMProvider)}"
 
+        # Pooled clients are rebuilt by clients.get when their own configuration changes
         providers.config.provider = providers.LLMProvider(provider_name)
 
         model_path = None
         if len(args) > 1:
             model_path = args[1]
-            providers.config.api_keys[provider_name]["model"] = model_path
+            if provider_name in providers.config.api_keys:
+                providers.config.api_keys[provider_name]["model"] = model_path
+        device = next((arg.split("=")[1] for arg in args if arg.startswith("--device=")), "auto")
+        dtype = next((arg.split("=")[1] for arg in args if arg.startswith("--dtype=")), "auto")
+        quantize = "int8" if "--int8" in args else None
+        draft = next((arg.split("=", 1)[1] for arg in args if arg.startswith("--draft=")), None)
         if provider_name == "transformers_local":
             if model_path:
-                if providers.load_model(model_path):
-                    return f"Local model '{model_path}' loaded successfully"
+                if providers.load_local_transformers_model(model_path, device=device, load_in_8bit="--8bit" in args,
+                                                           dtype=dtype, quantize=quantize):
+                    return f"Local model '{model_path}' loaded successfully" + self._load_draft(draft, device, dtype, quantize)
                 return f"Failed to load model '{model_path}'"
         elif provider_name == "transformers_download":
             if model_path:
                 try:
                     load_8bit = "--8bit" in args
-                    device = next((arg.split("=")[1] for arg in args if arg.startswith("--device=")), "auto")
 
-                    model_path = providers.download_model(model_path)
-                    if providers.load_model(model_path, device=device, load_in_8bit=load_8bit):
-                        return f"Model '{model_path}' downloaded and loaded successfully"
+                    model_path = providers.download_huggingface_model(model_path)
+                    if providers.load_downloaded_model(model_path, device=device, load_in_8bit=load_8bit,
+                                                       dtype=dtype, quantize=quantize):
+                        if draft and draft != "none":
+                            draft = providers.download_huggingface_model(draft)
+                        return (f"Model '{model_path}' downloaded and loaded successfully"
+                                + self._load_draft(draft, device, dtype, quantize))
                     return f"Failed to load model '{model_path}'"
                 except Exception as e:
                     return f"Error: {e}"
             else:
                 return "Model path is required for transformers_download provider."
+        elif provider_name == "transformers_hub":
+            if model_path:
+                providers.config.api_keys["huggingface"]["model"] = model_path
         else:
             if model_path:
                 providers.config.model_name = model_path
@@ -122,25 +384,32 @@ class CodeAssistMagics(Magics):
         else:
             return f"Provider set to {provider_name}"
 
+    def _load_draft(self, draft, device, dtype, quantize):
+        """Load or remove the draft model for assisted decoding; returns a note for the magic's output."""
+        if draft is None:
+            return ""
+        if draft == "none":
+            providers.load_draft_model(None)
+            return ". Draft model removed"
+        if providers.load_draft_model(draft, device=device, dtype=dtype, quantize=quantize):
+            return f". Draft model '{draft}' loaded for assisted decoding"
+        return f". Failed to load draft model '{draft}'"
+
 
 
     @line_magic
+    @telemetry.traced
     def analyze_code(self,line):
         """
         Analyze code in the current notebook using core.analyze_code
         and store a global `context_tree`. 
         Returns a short textual summary.
         """
-        notebook_path = line.strip() if line else core.get_notebook_path()
-        if not notebook_path:
-            return "Could not determine notebook path"
+        error = self._analyze_notebook(line.strip() if line else None)
+        if error:
+            return error
 
         try:
-            code = core.extract_code_from_notebook(notebook_path)
-
-            global context_tree
-            context_tree = core.analyze_code(code)
-
             # Build a textual summary from the new structure
             summary_lines = []
 
@@ -245,80 +514,90 @@ class CodeAssistMagics(Magics):
         explanation = "\n".join(explanation_lines).strip()
         return code, explanation
     
-    @staticmethod
-    def analyze_codebase_fancy():
+    def _analyze_notebook(self, notebook_path=None, progress=None):
         """
-        Displays a fancy message while analyzing the codebase.
+        Refresh the global `context_tree` from the current notebook.
+
+        Returns an error message, or None on success.
         """
-        message = [
-            "🔍 Scanning your project...",
-            "🛠️  Parsing functions, classes, and modules...",
-            "⚙️  Building context tree...",
-            "📊  Generating brilliance! "
-        ]
-        
-        for line in message:
-            display(line)
-            time.sleep(1.5)
-            clear_output(wait=True)
+        global context_tree
+        progress = progress or PipelineProgress(enabled=False)
 
+        progress.stage("extract")
+        cells = core.get_source_cells(notebook_path)
+        if cells is None:
+            return "Could not determine notebook path"
+
+        try:
+            progress.stage("parse", f"({len(cells)} cells)")
+            context_tree = core.analyze_cells(cells)
+        except Exception as e:
+            return f"Error analyzing code: {e}"
+        return None
+
+    def _build_context(self, cell="", target=None, error=None):
+        """
+        Render the part of `context_tree` most relevant to this request that fits the token budget.
+        """
+        budget = config.context_budget(model=providers.model_id())
+        query = " ".join(part for part in (target, cell, error) if part)
+        snippets = core.search_code(query, k=config.retrieval_top_k) if query else []
+        text, report = build_context(context_tree, budget, cell=cell, target=target, error=error, snippets=snippets)
+        if report.dropped:
+            print(report.summary())
+        return text
+
+    def _progress(self):
+        """Create a progress display for one magic invocation."""
+        return PipelineProgress(enabled=config.show_progress)
 
     @line_magic
+    @telemetry.traced
     def generate_code(self, line):
         """Magic command to generate code and display it properly with explanations."""
         if not config.provider:
             return "Please set up a provider first using %set_llm_provider"
 
-        function_name = line.strip()
-        
-        
-                
-        self.analyze_codebase_fancy()
-        self.shell.run_line_magic('analyze_code', None)    
-        # Get the current persona (mode)
-        current_persona = get_persona()
-
-        # Construct the prompt
-        prompt = (
-            f"Generate Python code for a function named '{function_name}' considering the context of the codebase provided: {context_tree}. {current_persona}"
-        )
-
-        # Call the appropriate LLM provider
-        if config.provider == LLMProvider.TRANSFORMERS_LOCAL:
-            response = call_local_transformers(prompt)
-        elif config.provider == LLMProvider.TRANSFORMERS_HUB:
-            response = call_huggingface_hub(prompt)
-        elif config.provider == LLMProvider.OPENAI:
-            response = call_openai(prompt)
-        elif config.provider == LLMProvider.ANTHROPIC:
-            response = call_anthropic(prompt)
-        elif config.provider == LLMProvider.GEMINI:
-            response = call_gemini(prompt)
-        elif config.provider == LLMProvider.TRANSFORMERS_DOWNLOAD:
-            response = call_local_transformers(prompt)
-        else:
-            return "Provider not implemented"
+        function_name, options = self._parse_options(line)
+        if options is None:
+            return
 
-        # Split response into code and text explanation
-        code, explanation = self._split_code_and_explanation(response)
+        with self._progress() as progress:
+            self._analyze_notebook(progress=progress)
 
-        # Display the code with syntax highlighting
-        if code:
-            display_highlighted_code(code)
+            progress.stage("prompt")
+            # Construct the prompt
+            codebase_context = self._build_context(target=function_name)
+            prompt = self._compose_prompt(
+                f"Generate Python code for a function named '{function_name}' considering the context of the codebase above.",
+                codebase_context
+            )
 
-        # Display the explanation as Markdown
-        if explanation:
-            display(Markdown(explanation))
+            # Call the appropriate LLM provider; stop as soon as the function is complete
+            progress.stage("provider")
+            response = self._stream_response(prompt, options, default_stop="function", function=function_name)
 
- 
+            progress.stage("render")
+            # Split response into code and text explanation
+            code, explanation = self._split_code_and_explanation(response)
 
+            # Display the code with syntax highlighting
+            if code:
+                display_highlighted_code(code)
+
+            # Display the explanation as Markdown
+            if explanation:
+                display(Markdown(explanation))
 
-    
     @cell_magic
+    @telemetry.traced
     def debug_cell(self, line, cell):
         """Debug a cell with AI assistance and display results with proper formatting."""
         if not config.provider:
             return "Please set up a provider first using %set_llm_provider"
+        _, options = self._parse_options(line)
+        if options is None:
+            return
         
         # Capture output and errors
         stdout_capture = StringIO()
@@ -338,52 +617,39 @@ class CodeAssistMagics(Magics):
         if error_msg:
             print("\nAnalyzing error and suggesting solutions...")
             
-            # Analyze codebase for context, similar to generate_code
-            self.analyze_codebase_fancy()
-            self.shell.run_line_magic('analyze_code', None)
-            
-            # Get current persona
-            current_persona = get_persona()
-            
-            prompt = f"""Given this Python code:
+            with self._progress() as progress:
+                # Analyze codebase for context, similar to generate_code
+                self._analyze_notebook(progress=progress)
+
+                progress.stage("prompt")
+                codebase_context = self._build_context(cell=cell, error=error_msg)
+
+                prompt = self._compose_prompt(f"""Given this Python code:
     {cell}
     The code produced this error:
     {error_msg}
-    Consider the context of the codebase if relevant:
-    {context_tree}
-    {current_persona}
+    Consider the context of the codebase above if relevant.
     Please provide:
     1. A clear explanation of the error
     2. The corrected code
-    3. Additional debugging tips if relevant"""
-            
-            # Call the appropriate LLM provider
-            if config.provider == LLMProvider.TRANSFORMERS_LOCAL:
-                response = call_local_transformers(prompt)
-            elif config.provider == LLMProvider.TRANSFORMERS_HUB:
-                response = call_huggingface_hub(prompt)
-            elif config.provider == LLMProvider.OPENAI:
-                response = call_openai(prompt)
-            elif config.provider == LLMProvider.ANTHROPIC:
-                response = call_anthropic(prompt)
-            elif config.provider == LLMProvider.GEMINI:
-                response = call_gemini(prompt)
-            elif config.provider == LLMProvider.TRANSFORMERS_DOWNLOAD:
-                response = call_local_transformers(prompt)
-            else:
-                return "Provider not implemented"
-            
-            # Split response into code and explanation
-            code, explanation = self._split_code_and_explanation(response)
-            
-            # Display the explanation as Markdown first
-            if explanation:
-                display(Markdown(explanation))
-            
-            # Display the corrected code with syntax highlighting
-            if code:
-                print("\nCorrected code:")
-                display_highlighted_code(code)
+    3. Additional debugging tips if relevant""", codebase_context)
+
+                # Call the appropriate LLM provider
+                progress.stage("provider")
+                response = self._stream_response(prompt, options)
+
+                progress.stage("render")
+                # Split response into code and explanation
+                code, explanation = self._split_code_and_explanation(response)
+
+                # Display the explanation as Markdown first
+                if explanation:
+                    display(Markdown(explanation))
+
+                # Display the corrected code with syntax highlighting
+                if code:
+                    print("\nCorrected code:")
+                    display_highlighted_code(code)
         else:
             output = stdout_capture.getvalue()
             if output:
@@ -393,68 +659,79 @@ class CodeAssistMagics(Magics):
 
 
     @cell_magic
+    @telemetry.traced
     def refactor_code(self, line, cell):
         """Cell magic to suggest code refactoring improvements."""
         if not config.provider:
             return "Please set up a provider first using %set_llm_provider"
+        _, options = self._parse_options(line)
+        if options is None:
+            return
         
-        # Analyze current codebase
-        self.analyze_codebase_fancy()
-        self.shell.run_line_magic('analyze_code', None)
-        current_persona = get_persona()
-        
-        prompt = f"""Analyze this Python code and suggest refactoring improvements:
-    {cell}
+        with self._progress() as progress:
+            # Analyze current codebase
+            self._analyze_notebook(progress=progress)
 
-    Consider the broader codebase context:
-    {context_tree}
+            progress.stage("prompt")
+            codebase_context = self._build_context(cell=cell)
+
+            prompt = self._compose_prompt(f"""Analyze this Python code and suggest refactoring improvements:
+    {cell}
 
-    {current_persona}
+    Consider the broader codebase context above.
 
     Please suggest:
     1. Code quality improvements
     2. Performance optimizations
     3. Better design patterns
-    4. Refactored code implementation"""
+    4. Refactored code implementation""", codebase_context)
 
-        # Call appropriate provider and display results
-        response = self._call_provider(prompt)
-        code, explanation = self._split_code_and_explanation(response)
-        
-        if explanation:
-            display(Markdown(explanation))
-        if code:
-            print("\nRefactored code suggestion:")
-            display_highlighted_code(code)
+            # Call appropriate provider and display results
+            progress.stage("provider")
+            response = self._stream_response(prompt, options)
+
+            progress.stage("render")
+            code, explanation = self._split_code_and_explanation(response)
+
+            if explanation:
+                display(Markdown(explanation))
+            if code:
+                print("\nRefactored code suggestion:")
+                display_highlighted_code(code)
 
     @cell_magic
+    @telemetry.traced
     def explain_code(self, line, cell):
         """Cell magic to generate detailed explanation of code."""
         if not config.provider:
             return "Please set up a provider first using %set_llm_provider"
+        _, options = self._parse_options(line)
+        if options is None:
+            return
         
-        current_persona = get_persona()
-        prompt = f"""Explain this Python code in detail:
+        prompt = self._compose_prompt(f"""Explain this Python code in detail:
     {cell}
 
-    {current_persona}
-
     Please provide:
     1. High-level overview
     2. Line-by-line explanation
     3. Key design decisions
-    4. Usage examples"""
+    4. Usage examples""")
         
-        response = self._call_provider(prompt)
+        response = self._stream_response(prompt, options)
         display(Markdown(response))
 
         
 
     @cell_magic
+    @telemetry.traced
     def optimize_code(self, line, cell):
             """Magic command to suggest performance optimizations for code."""
             if not config.provider:
                 return "Please set up a provider first using %set_llm_provider"
+            _, options = self._parse_options(line)
+            if options is None:
+                return
             
             # Run the code and profile it
             profiler = cProfile.Profile()
@@ -474,8 +751,7 @@ class CodeAssistMagics(Magics):
                 sys.stdout = sys.__stdout__
                 sys.stderr = sys.__stderr__
             
-            current_persona = get_persona()
-            prompt = f"""Analyze this Python code and its performance profile:
+            prompt = self._compose_prompt(f"""Analyze this Python code and its performance profile:
 
         Code:
         {cell}
@@ -483,15 +759,13 @@ class CodeAssistMagics(Magics):
         Profile results:
         {profile_data}
 
-        {current_persona}
-
         Please suggest:
         1. Performance bottlenecks
         2. Optimization strategies
         3. Optimized implementation
-        4. Benchmarking comparisons"""
+        4. Benchmarking comparisons""")
             
-            response = self._call_provider(prompt)
+            response = self._stream_response(prompt, options)
             code, explanation = self._split_code_and_explanation(response)
             
             if explanation:
@@ -501,52 +775,121 @@ class CodeAssistMagics(Magics):
                 display_highlighted_code(code)
 
     @cell_magic
+    @telemetry.traced
     def generate_test(self, line, cell):
         """Cell magic to generate unit tests for code."""
         if not config.provider:
             return "Please set up a provider first using %set_llm_provider"
+        _, options = self._parse_options(line)
+        if options is None:
+            return
         
-        self.analyze_codebase_fancy()
-        current_persona = get_persona()
-        
-        prompt = f"""Generate comprehensive unit tests for this Python code:
-    {cell}
+        with self._progress() as progress:
+            self._analyze_notebook(progress=progress)
 
-    Consider the codebase context:
-    {context_tree}
+            progress.stage("prompt")
+            codebase_context = self._build_context(cell=cell)
 
-    {current_persona}
+            prompt = self._compose_prompt(f"""Generate comprehensive unit tests for this Python code:
+    {cell}
+
+    Consider the codebase context above.
 
     Please provide:
     1. Test cases covering main functionality
     2. Edge cases
     3. Error cases
     4. Mocking examples if needed
-    5. Complete test implementation"""
-        
-        response = self._call_provider(prompt)
-        code, explanation = self._split_code_and_explanation(response)
-        
-        if explanation:
-            display(Markdown(explanation))
-        if code:
-            print("\nGenerated test code:")
-            display_highlighted_code(code)
+    5. Complete test implementation""", codebase_context)
 
-    
-    def _call_provider(self, prompt):
-        """Helper method to call the configured LLM provider."""
-        if config.provider == LLMProvider.TRANSFORMERS_LOCAL:
-            return call_local_transformers(prompt)
-        elif config.provider == LLMProvider.TRANSFORMERS_HUB:
-            return call_huggingface_hub(prompt)
-        elif config.provider == LLMProvider.OPENAI:
-            return call_openai(prompt)
-        elif config.provider == LLMProvider.ANTHROPIC:
-            return call_anthropic(prompt)
-        elif config.provider == LLMProvider.GEMINI:
-            return call_gemini(prompt)
-        elif config.provider == LLMProvider.TRANSFORMERS_DOWNLOAD:
-            return call_local_transformers(prompt)
-        else:
-            return "Provider not implemented"           
+            progress.stage("provider")
+            response = self._stream_response(prompt, options)
+
+            progress.stage("render")
+            code, explanation = self._split_code_and_explanation(response)
+
+            if explanation:
+                display(Markdown(explanation))
+            if code:
+                print("\nGenerated test code:")
+                display_highlighted_code(code)
+
+    @staticmethod
+    def _compose_prompt(task, codebase_context=None):
+        """
+        Build a prompt with the parts shared between requests first.
+
+        The persona and codebase context rarely change between calls, so putting
+        them before the cell-specific task lets the local backend reuse their
+        KV cache (see codemate_ai.kvcache) and only prefill the task.
+        """
+        parts = [get_persona()]
+        if codebase_context is not None:
+            parts.append(f"Context of the codebase:\n{codebase_context}")
+        parts.append(task)
+        return "\n\n".join(parts)
+
+    @staticmethod
+    def _parse_options(line):
+        """
+        Split `--name` / `--name=value` options from the rest of a magic's line.
+
+        `--timeout` is converted to seconds. If its value is invalid, the error
+        is printed and the options are None, so the magic can return early.
+
+        Returns:
+        - tuple: (remaining text, {name: value or True} or None)
+        """
+        words = []
+        options = {}
+        for word in (line or "").split():
+            if word.startswith("--"):
+                name, _, value = word[2:].partition("=")
+                options[name] = value or True
+            else:
+                words.append(word)
+        if options.get("timeout") not in (None, True):
+            try:
+                options["timeout"] = float(options["timeout"])
+            except ValueError:
+                print(f"Invalid --timeout value: {options['timeout']}")
+                return " ".join(words), None
+        return " ".join(words), options
+
+    def _stream_response(self, prompt, options=None, default_stop=None, function=None):
+        """
+        Stream the provider response into a live display and return the full text.
+
+        Responses are served from / stored in the response cache unless `--no-cache`
+        is given. `--timeout=<seconds>` overrides the end-to-end deadline.
+        `--stop=fence|function|none|<string>` overrides the magic's default_stop;
+        `function` stops once the definition of `function` is complete.
+        """
+        options = options or {}
+        stops = StopConditions.parse(options.get("stop", default_stop), function=function)
+        timeout = options.get("timeout")
+        deadline = time.monotonic() + (timeout if isinstance(timeout, float) else config.deadline)
+
+        live = StreamingDisplay(enabled=config.stream)
+        chunks = []
+        telemetry.mark("provider")
+        telemetry.count(prompt_tokens=estimate_tokens(prompt))
+        started = time.perf_counter()
+        try:
+            for delta in providers.stream_cached(prompt, persona=get_persona(), use_cache=not options.get("no-cache"),
+                                                 deadline=deadline, stops=stops):
+                if not chunks:
+                    telemetry.annotate(ttft=time.perf_counter() - started)
+                chunks.append(delta)
+                live.update(chunks)
+        except providers.ProviderError as e:
+            telemetry.annotate(error=str(e))
+            chunks = [str(e)]
+        except KeyboardInterrupt:
+            # Keep whatever arrived before the interrupt
+            print("Generation interrupted; showing partial output.")
+        finally:
+            live.close()
+        response = "".join(chunks).strip()
+        telemetry.count(completion_tokens=estimate_tokens(response))
+        return response
@@ -0,0 +1,266 @@
+import os
+import gc
+import sys
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Checkpoint files counted when estimating a model's size before loading it.
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth")
+
+
+def model_memory(model: Any) -> Dict[str, int]:
+    """
+    Bytes held by a model's parameters and buffers, per device type ("cpu", "cuda", ...).
+
+    Tensors shared between modules (tied embeddings) are only counted once.
+    The state dict is used when available, so the packed weights of
+    dynamically quantized layers are counted too.
+    """
+    usage = {}
+    seen = set()
+    if hasattr(model, "state_dict"):
+        tensors = []
+        for value in model.state_dict(keep_vars=True).values():
+            # Quantized linear layers store their packed params as a (weight, bias) tuple
+            for item in value if isinstance(value, (tuple, list)) else [value]:
+                if hasattr(item, "numel"):
+                    tensors.append(item)
+    else:
+        tensors = list(model.parameters())
+        if hasattr(model, "buffers"):
+            tensors += list(model.buffers())
+    for tensor in tensors:
+        if id(tensor) in seen:
+            continue
+        seen.add(id(tensor))
+        device = getattr(tensor.device, "type", str(tensor.device))
+        usage[device] = usage.get(device, 0) + tensor.numel() * tensor.element_size()
+    return usage
+
+
+def checkpoint_bytes(path: str) -> int:
+    """Size of the weight files in a local model directory, or 0 when unknown (e.g. a Hub id)."""
+    if not os.path.isdir(path):
+        return 0
+    total = 0
+    for name in os.listdir(path):
+        if name.endswith(WEIGHT_SUFFIXES):
+            total += os.path.getsize(os.path.join(path, name))
+    return total
+
+
+def default_budget(device: str) -> Optional[int]:
+    """Default memory budget: half of physical RAM for "cpu", 90% of GPU 0 for "cuda"."""
+    try:
+        if device == "cpu":
+            return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 2
+        torch = sys.modules.get("torch")
+        if device == "cuda" and torch is not None and torch.cuda.is_available():
+            return int(torch.cuda.get_device_properties(0).total_memory * 0.9)
+    except (ValueError, OSError, AttributeError):
+        pass
+    return None
+
+
+def resolve_device(device: str) -> str:
+    """Map "auto" to "cpu" on hosts without CUDA, where device_map="auto" would need accelerate."""
+    if device != "auto":
+        return device
+    import torch
+    return "auto" if torch.cuda.is_available() else "cpu"
+
+
+def device_type(device: str) -> str:
+    """Device type ("cpu", "cuda", ...) a model loaded with this device or device_map mostly lives on."""
+    if device == "auto":
+        return "cuda"
+    return device.split(":")[0]
+
+
+def cpu_supports_bf16() -> bool:
+    """True when the CPU has native bfloat16 instructions (AVX512-BF16 or AMX)."""
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def select_dtype(device: str) -> str:
+    """
+    Choose the weight dtype for a device.
+
+    float16 on GPUs; on CPU, bfloat16 where the hardware supports it natively
+    and float32 otherwise, since float16 matmuls on CPU are slow or unsupported.
+    """
+    if device_type(device) != "cpu":
+        return "float16"
+    return "bfloat16" if cpu_supports_bf16() else "float32"
+
+
+def quantize_int8(model: Any) -> Any:
+    """
+    Dynamically quantize a CPU model's nn.Linear layers to int8.
+
+    Weights are stored as int8 and activations are quantized on the fly,
+    which roughly quarters the memory of those layers and speeds up CPU
+    matmuls. Layers that are not nn.Linear (e.g. GPT-2's Conv1D) are kept.
+    """
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+    # In place, so each float32 layer is released as soon as it is replaced
+    return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def _release_device_memory():
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class LoadedModel:
+    """A model, its tokenizer and the memory it occupies per device type."""
+
+    def __init__(self, key: Hashable, model: Any, tokenizer: Any):
+        self.key = key
+        self.model = model
+        self.tokenizer = tokenizer
+        self.memory = model_memory(model)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self.memory.values())
+
+
+class ModelRegistry:
+    """
+    Keeps several local models loaded, keyed by (path, dtype, device, ...).
+
+    Switching back to a model that is still loaded is free. When the models on a
+    device type exceed its budget (`budgets`, bytes per device type; missing
+    entries use `default_budget`), the least recently used ones are unloaded.
+    The model being loaded or used and the `pinned` keys are never evicted.
+    Callbacks in `on_unload` are called with the key of every unloaded model.
+    """
+
+    def __init__(self, budgets: Optional[Dict[str, Optional[int]]] = None):
+        self.budgets = dict(budgets or {})
+        self.pinned = set()
+        self.on_unload = []
+        self._models = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._models
+
+    def budget(self, device: str) -> Optional[int]:
+        if device in self.budgets:
+            return self.budgets[device]
+        return default_budget(device)
+
+    def usage(self) -> Dict[str, int]:
+        """Bytes currently held per device type."""
+        with self._lock:
+            usage = {}
+            for entry in self._models.values():
+                for device, size in entry.memory.items():
+                    usage[device] = usage.get(device, 0) + size
+            return usage
+
+    def pin(self, *keys: Optional[Hashable]):
+        """Protect these keys (e.g. the active model and its draft) from eviction, replacing earlier pins."""
+        with self._lock:
+            self.pinned = {key for key in keys if key is not None}
+
+    def get(self, key: Hashable) -> Optional[Tuple[Any, Any]]:
+        """Return (model, tokenizer) for a loaded key and mark it most recently used."""
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None:
+                return None
+            self._models.move_to_end(key)
+            return entry.model, entry.tokenizer
+
+    def load(self, key: Hashable, loader: Callable[[], Tuple[Any, Any]],
+             expected: Optional[Dict[str, int]] = None) -> Tuple[Any, Any]:
+        """
+        Return (model, tokenizer) for key, calling loader() if it is not loaded yet.
+
+        Parameters:
+        - key (Hashable): Identifies the model, e.g. (path, dtype, device).
+        - loader (callable): Returns a freshly loaded (model, tokenizer).
+        - expected (dict): Estimated bytes per device type, used to make room before loading.
+        """
+        with self._lock:
+            loaded = self.get(key)
+            if loaded is not None:
+                return loaded
+
+            if expected:
+                self._evict(expected, keep=None)
+            model, tokenizer = loader()
+            entry = LoadedModel(key, model, tokenizer)
+            self._models[key] = entry
+            self._evict({}, keep=key)
+            logger.info(f"Loaded model {key} ({entry.total_bytes / 2 ** 20:.0f} MiB)")
+            return model, tokenizer
+
+    def _evict(self, incoming: Dict[str, int], keep: Optional[Hashable]):
+        usage = self.usage()
+        for device in set(usage) | set(incoming):
+            budget = self.budget(device)
+            if budget is None:
+                continue
+            needed = usage.get(device, 0) + incoming.get(device, 0)
+            for key in list(self._models):
+                if needed <= budget:
+                    break
+                if key == keep or key in self.pinned:
+                    continue
+                size = self._models[key].memory.get(device, 0)
+                if size:
+                    self.unload(key)
+                    needed -= size
+
+    def unload(self, key: Hashable) -> bool:
+        """Unload one model and free its memory."""
+        with self._lock:
+            entry = self._models.pop(key, None)
+        if entry is None:
+            return False
+        logger.info(f"Unloading model {key}")
+        entry.model = entry.tokenizer = None
+        del entry
+        self._notify_unload([key])
+        _release_device_memory()
+        return True
+
+    def clear(self):
+        """Unload every model."""
+        with self._lock:
+            keys = list(self._models)
+            self._models.clear()
+        self._notify_unload(keys)
+        _release_device_memory()
+
+    def _notify_unload(self, keys: List[Hashable]):
+        for key in keys:
+            for callback in self.on_unload:
+                callback(key)
+
+    def entries(self) -> List[LoadedModel]:
+        """Loaded models, least recently used first."""
+        with self._lock:
+            return list(self._models.values())
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,114 @@
+import os
+import time
+from IPython import get_ipython
+from IPython.display import display, HTML, Markdown
+from typing import List
+from codemate_ai import telemetry
+
+# Pipeline stages shown while a magic runs, in execution order.
+STAGES = {
+    "extract": "🔍 Reading notebook cells...",
+    "parse": "🛠️  Parsing functions, classes, and modules...",
+    "prompt": "⚙️  Building prompt...",
+    "provider": "📡 Waiting for the model...",
+    "render": "📊 Rendering response...",
+}
+
+
+def live_display_supported() -> bool:
+    """Returns True when running in a Jupyter kernel, where displays can be updated in place."""
+    shell = get_ipython()
+    return shell is not None and type(shell).__name__ == "ZMQInteractiveShell"
+
+
+def progress_supported() -> bool:
+    """
+    Returns True when in-place display updates are available.
+
+    Progress is disabled in terminal IPython, plain Python, and when the
+    CODEMATE_PROGRESS environment variable is set to 0 (batch / headless runs).
+    """
+    if os.environ.get("CODEMATE_PROGRESS", "1").lower() in ("0", "false", "off", "no"):
+        return False
+    return live_display_supported()
+
+
+class PipelineProgress:
+    """
+    Shows the current pipeline stage of a magic in a single, in-place updated line.
+
+    Usage:
+        with PipelineProgress(enabled) as progress:
+            progress.stage("extract")
+            ...
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled and progress_supported()
+        self.current = None
+        self._handle = None
+        self._started = time.perf_counter()
+
+    def stage(self, name: str, detail: str = ""):
+        """Mark the start of a pipeline stage and refresh the display."""
+        self.current = name
+        telemetry.mark(name)
+        if not self.enabled:
+            return
+        stages = list(STAGES)
+        step = stages.index(name) + 1 if name in STAGES else len(stages)
+        elapsed = time.perf_counter() - self._started
+        message = f"[{step}/{len(stages)}] {STAGES.get(name, name)} {detail}".rstrip()
+        html = HTML(f"<span style='font-family: monospace; color: #666;'>{message} ({elapsed:.1f}s)</span>")
+        if self._handle is None:
+            self._handle = display(html, display_id=True)
+        else:
+            self._handle.update(html)
+
+    def done(self):
+        """Remove the progress line."""
+        if self._handle is not None:
+            self._handle.update(HTML(""))
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.done()
+        return False
+
+
+class StreamingDisplay:
+    """
+    Renders a response as Markdown while it is still streaming in.
+
+    The display is refreshed at most every `interval` seconds so that fast
+    token streams do not flood the frontend with updates.
+    """
+
+    def __init__(self, enabled: bool = True, interval: float = 0.1):
+        self.enabled = enabled and live_display_supported()
+        self.interval = interval
+        self._handle = None
+        self._last_update = 0.0
+
+    def update(self, chunks: List[str], force: bool = False):
+        """Show the text received so far."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if not force and now - self._last_update < self.interval:
+            return
+        self._last_update = now
+        text = Markdown("".join(chunks))
+        if self._handle is None:
+            self._handle = display(text, display_id=True)
+        else:
+            self._handle.update(text)
+
+    def close(self):
+        """Remove the live text so the final rendering can take its place."""
+        if self._handle is not None:
+            self._handle.update(HTML(""))
+            self._handle = None
@@ -1,13 +1,26 @@
 from enum import Enum
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from huggingface_hub import snapshot_download
-import google.generativeai as genai
 import requests
 import json
-from typing import Optional, Dict, Any
+import time
+import queue
+import threading
+import contextvars
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Iterator, AsyncIterator, List
 import logging
 from codemate_ai.core import clean_code_output, styled_code,display_highlighted_code
+from codemate_ai.clients import clients, new_http_session
+from codemate_ai.cache import ResponseCache
+from codemate_ai.models import model_registry, checkpoint_bytes, resolve_device, device_type, select_dtype, quantize_int8
+from codemate_ai.kvcache import PrefixKVCache
+from codemate_ai.batching import BatchScheduler
+from codemate_ai.stopping import StopConditions, StopCriteria, apply_stops
+from codemate_ai.routing import Router
+from codemate_ai import telemetry
+from codemate_ai.context import estimate_tokens
+from codemate_ai.ratelimit import RateLimiter, DeadlineExceeded, RETRYABLE_STATUS, backoff_delay, parse_retry_after, remaining
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -27,89 +40,376 @@ class CodeAssistConfig:
         self.model_name = None
         self.local_model = None
         self.local_tokenizer = None
+        # Registry keys of the active local model and its draft
+        self.local_model_key = None
+        self.draft_model_key = None
+        # Optional draft model for assisted decoding with the local model
+        self.draft_model = None
+        self.draft_tokenizer = None
+        self.show_progress = True
+        self.stream = True
+        self.temperature = 0.7
+        self.max_tokens = 800
+        self.retrieval_top_k = 5
+        self.max_concurrency = 4
+        # Reuse the KV cache of shared prompt prefixes in local generation
+        self.prefix_cache = True
+        # Group concurrent async local requests into batched generate() calls
+        self.local_batching = True
+        self.local_batch_size = 8
+        self.local_batch_wait = 0.02
+        # End-to-end seconds allowed per magic, and per-request socket timeouts
+        self.deadline = 180.0
+        self.connect_timeout = 10.0
+        self.read_timeout = 60.0
+        self.max_retries = 4
+        # Per-provider limits, e.g. {"openai": {"rpm": 500, "tpm": 90000}}
+        self.rate_limits = {}
+        # Providers to route requests over by latency (empty: use `provider` only),
+        # and whether a slow request is hedged with a second provider
+        self.routing = []
+        self.hedge = True
+        self.context_budgets = {
+            "default": 4000,
+            "openai": 6000,
+            "anthropic": 20000,
+            "gemini": 20000,
+            "transformers_hub": 1500,
+            "transformers_local": 1500,
+            "transformers_download": 1500,
+        }
+        # base_url overrides the provider's endpoint, e.g. a self-hosted
+        # OpenAI-compatible server (vLLM, llama.cpp, TGI) for "openai"
         self.api_keys = {
-            "openai": {"api_key": None, "model": "gpt-4"},
-            "anthropic": {"api_key": None, "model": "claude-3-sonnet"},
-            "gemini": {"api_key": None, "model": "gemini-pro-1.5"},
-            "huggingface": {"api_key": None, "model": None}
+            "openai": {"api_key": None, "model": "gpt-4", "base_url": None},
+            "anthropic": {"api_key": None, "model": "claude-3-sonnet", "base_url": None},
+            "gemini": {"api_key": None, "model": "gemini-pro-1.5", "base_url": None},
+            "huggingface": {"api_key": None, "model": None, "base_url": None}
         }
 
+    def context_budget(self, provider: Optional["LLMProvider"] = None, model: Optional[str] = None) -> int:
+        """
+        Token budget for the codebase context in prompts.
+
+        Looks up "<provider>/<model>", then "<provider>", then "default" in context_budgets.
+        When routing without a given provider, the smallest budget of the routed providers is used.
+        """
+        if provider is None and self.routing:
+            return min(self.context_budget(routed) for routed in self.routing)
+        provider = provider or self.provider
+        name = provider.value if provider else None
+        for key in (f"{name}/{model}" if model else None, name, "default"):
+            if key in self.context_budgets:
+                return self.context_budgets[key]
+        return 4000
+
+    def generation_params(self) -> Dict[str, Any]:
+        """Sampling parameters sent with every request."""
+        return {"temperature": self.temperature, "max_tokens": self.max_tokens}
+
 config = CodeAssistConfig()
 
-def call_openai(prompt: str) -> str:
-    if not config.api_keys["openai"]["api_key"]:
-        return "OpenAI API key not set. Use %set_api_key openai <your_key>"
+# Endpoints used when a provider has no base_url configured
+DEFAULT_BASE_URLS = {
+    "openai": "https://api.openai.com/v1",
+    "anthropic": "https://api.anthropic.com/v1",
+}
+prefix_cache = PrefixKVCache()
+model_registry.on_unload.append(prefix_cache.discard)
+response_cache = ResponseCache()
+router = Router()
+
+
+def base_url(provider: str) -> Optional[str]:
+    """The endpoint for provider (an api_keys name): its configured base_url or the vendor default."""
+    url = config.api_keys[provider].get("base_url") or DEFAULT_BASE_URLS.get(provider)
+    return url.rstrip("/") if url else None
+
+
+def _missing_key(provider: str) -> bool:
+    """True when provider has no API key; self-hosted endpoints (a custom base_url) may not need one."""
+    return not config.api_keys[provider]["api_key"] and not config.api_keys[provider].get("base_url")
+
+
+def _http_session(provider: str, headers: Dict[str, str]) -> "requests.Session":
+    """Return the pooled keep-alive session for provider, rebuilt when its headers change."""
+    def factory():
+        session = new_http_session()
+        session.headers.update(headers)
+        return session
+
+    return clients.get(provider, tuple(sorted(headers.items())), factory)
+
 
+def _gemini_model():
+    """Return the pooled Gemini model for the configured key and model name."""
+    api_key = config.api_keys["gemini"]["api_key"]
+    model_name = config.api_keys["gemini"]["model"]
+    endpoint = base_url("gemini")
+
+    def factory():
+        import google.generativeai as genai
+        genai.configure(api_key=api_key, client_options={"api_endpoint": endpoint} if endpoint else None)
+        return genai.GenerativeModel(model_name)
+
+    return clients.get("gemini", (api_key, model_name, endpoint), factory)
+
+
+def _huggingface_client():
+    """Return the pooled HuggingFace InferenceClient for the configured token and model."""
+    from huggingface_hub import InferenceClient
+
+    token = config.api_keys["huggingface"]["api_key"]
+    model_name = config.api_keys["huggingface"]["model"] or "gpt2"
+    # A TGI server URL takes the place of the model id
+    endpoint = base_url("huggingface")
+    return clients.get(
+        "huggingface",
+        (token, model_name, endpoint),
+        lambda: InferenceClient(token=token, model=endpoint or model_name, timeout=config.read_timeout),
+    )
+
+class ProviderError(Exception):
+    """Raised by the streaming provider calls; the message is shown to the user as-is."""
+
+
+def _iter_sse(response) -> Iterator[str]:
+    """Yield the data payload of each server-sent event in a streaming HTTP response."""
+    response.encoding = "utf-8"
+    data_lines = []
+    for line in response.iter_lines(decode_unicode=True):
+        telemetry.count(bytes_received=len(line.encode("utf-8")) + 1)
+        if not line:
+            # A blank line terminates the current event
+            if data_lines:
+                yield "\n".join(data_lines)
+                data_lines = []
+            continue
+        if line.startswith(":"):
+            continue
+        if line.startswith("data:"):
+            data = line[5:]
+            data_lines.append(data[1:] if data.startswith(" ") else data)
+    if data_lines:
+        yield "\n".join(data_lines)
+
+
+def _join_stream(stream: Iterator[str]) -> str:
+    """Collect a text stream into the blocking, str-returning form."""
     try:
-        headers = {
-            "Authorization": f"Bearer {config.api_keys['openai']['api_key']}",
-            "Content-Type": "application/json"
-        }
+        return "".join(stream).strip()
+    except ProviderError as e:
+        return str(e)
+
+
+_limiters = {}
+
+
+def _rate_limiter(provider: str) -> RateLimiter:
+    """Return the shared limiter for provider, rebuilt when its configured limits change."""
+    limits = config.rate_limits.get(provider, {})
+    key = (limits.get("rpm"), limits.get("tpm"))
+    entry = _limiters.get(provider)
+    if entry is None or entry[0] != key:
+        entry = (key, RateLimiter(*key))
+        _limiters[provider] = entry
+    return entry[1]
+
+
+def _default_deadline(deadline: Optional[float]) -> float:
+    """Use the configured end-to-end deadline when the caller did not pass one."""
+    return deadline if deadline is not None else time.monotonic() + config.deadline
+
+
+def _http_timeout(left: Optional[float]):
+    """(connect, read) timeout for one HTTP request, never past the deadline."""
+    if left is None:
+        return (config.connect_timeout, config.read_timeout)
+    return (min(config.connect_timeout, left), min(config.read_timeout, left))
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    response = getattr(error, "response", None)
+    for candidate in (getattr(response, "status_code", None), getattr(error, "status_code", None),
+                      getattr(error, "code", None)):
+        if isinstance(candidate, int):
+            return candidate
+    return None
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return _status_code(error) in RETRYABLE_STATUS
+
+
+def _with_retries(provider: str, prompt: str, start, deadline: Optional[float]):
+    """
+    Start a provider call under its rate limiter, retrying transient failures.
+
+    `start(seconds_left)` opens the request and returns the response or stream.
+    429 / 5xx responses and connection errors are retried with jittered
+    exponential backoff, honoring Retry-After, as long as the deadline allows.
+    Retries only happen before any output has been produced.
+    """
+    limiter = _rate_limiter(provider)
+    for attempt in range(config.max_retries + 1):
+        limiter.acquire(estimate_tokens(prompt) + config.max_tokens, deadline)
+        try:
+            return start(remaining(deadline))
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            if attempt >= config.max_retries or not _is_retryable(e):
+                raise
+            headers = getattr(getattr(e, "response", None), "headers", None) or {}
+            delay = backoff_delay(attempt, parse_retry_after(headers.get("Retry-After")))
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise
+            logger.warning(f"{provider} request failed ({e}); retry {attempt + 1} in {delay:.1f}s")
+            telemetry.count(retries=1)
+            time.sleep(delay)
+
+
+def _post_stream(session: "requests.Session", url: str, data: Dict[str, Any]):
+    """Return a `start` callable for _with_retries that opens a streaming POST."""
+    def start(left):
+        telemetry.count(bytes_sent=len(json.dumps(data).encode("utf-8")))
+        response = session.post(url, json=data, stream=True, timeout=_http_timeout(left))
+        try:
+            response.raise_for_status()
+        except Exception:
+            response.close()
+            raise
+        return response
+
+    return start
+
+
+def stream_openai(prompt: str, deadline: Optional[float] = None,
+                  stops: Optional[StopConditions] = None) -> Iterator[str]:
+    """Stream an OpenAI chat completion as text deltas."""
+    deadline = _default_deadline(deadline)
+    if _missing_key("openai"):
+        raise ProviderError("OpenAI API key not set. Use %set_api_key openai <your_key>")
+
+    try:
+        headers = {"Content-Type": "application/json"}
+        if config.api_keys["openai"]["api_key"]:
+            headers["Authorization"] = f"Bearer {config.api_keys['openai']['api_key']}"
+        session = _http_session("openai", headers)
         data = {
             "model": config.api_keys["openai"]["model"],
             "messages": [
                 {"role": "system", "content": "You are a helpful coding assistant."},
                 {"role": "user", "content": prompt}
             ],
-            "temperature": 0.7,
-            "max_tokens": 800
+            "temperature": config.temperature,
+            "max_tokens": config.max_tokens,
+            "stream": True
         }
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=data
-        )
-        response.raise_for_status()
-        
-        return response.json()["choices"][0]["message"]["content"].strip()
+        if stops and stops.sequences:
+            # OpenAI accepts at most 4 stop sequences
+            data["stop"] = stops.native(4)
+        with _with_retries("openai", prompt, _post_stream(
+            session,
+            f"{base_url('openai')}/chat/completions",
+            data
+        ), deadline) as response:
+            for event in _iter_sse(response):
+                remaining(deadline)
+                if event.strip() == "[DONE]":
+                    break
+                choices = json.loads(event).get("choices") or [{}]
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+    except ProviderError:
+        raise
     except Exception as e:
         logger.error(f"OpenAI API error: {e}")
-        return f"Error: {str(e)}"
+        raise ProviderError(f"Error: {str(e)}") from e
+
+def call_openai(prompt: str, deadline: Optional[float] = None) -> str:
+    return _join_stream(stream_openai(prompt, deadline))
 
-def call_anthropic(prompt: str) -> str:
-    if not config.api_keys["anthropic"]["api_key"]:
-        return "Anthropic API key not set. Use %set_api_key anthropic <your_key>"
+def stream_anthropic(prompt: str, deadline: Optional[float] = None,
+                     stops: Optional[StopConditions] = None) -> Iterator[str]:
+    """Stream an Anthropic message as text deltas."""
+    deadline = _default_deadline(deadline)
+    if _missing_key("anthropic"):
+        raise ProviderError("Anthropic API key not set. Use %set_api_key anthropic <your_key>")
 
     try:
-        headers = {
-            "x-api-key": config.api_keys["anthropic"]["api_key"],
-            "Content-Type": "application/json",
-            "anthropic-version": "2023-06-01"
-        }
+        headers = {"Content-Type": "application/json", "anthropic-version": "2023-06-01"}
+        if config.api_keys["anthropic"]["api_key"]:
+            headers["x-api-key"] = config.api_keys["anthropic"]["api_key"]
+        session = _http_session("anthropic", headers)
         data = {
             "model": config.api_keys["anthropic"]["model"],
             "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": 800,
-            "temperature": 0.7
+            "max_tokens": config.max_tokens,
+            "temperature": config.temperature,
+            "stream": True
         }
-        response = requests.post(
-            "https://api.anthropic.com/v1/messages",
-            headers=headers,
-            json=data
-        )
-        response.raise_for_status()
-        return response.json()["content"][0]["text"].strip()
+        if stops and stops.sequences:
+            data["stop_sequences"] = stops.native()
+        with _with_retries("anthropic", prompt, _post_stream(
+            session,
+            f"{base_url('anthropic')}/messages",
+            data
+        ), deadline) as response:
+            for event in _iter_sse(response):
+                remaining(deadline)
+                payload = json.loads(event)
+                event_type = payload.get("type")
+                if event_type == "content_block_delta":
+                    delta = payload.get("delta", {}).get("text")
+                    if delta:
+                        yield delta
+                elif event_type == "error":
+                    raise RuntimeError(payload.get("error", {}).get("message", "stream error"))
+                elif event_type == "message_stop":
+                    break
+    except ProviderError:
+        raise
     except Exception as e:
         logger.error(f"Anthropic API error: {e}")
-        return f"Error: {str(e)}"
+        raise ProviderError(f"Error: {str(e)}") from e
+
+def call_anthropic(prompt: str, deadline: Optional[float] = None) -> str:
+    return _join_stream(stream_anthropic(prompt, deadline))
 
-def call_gemini(prompt: str) -> str:
+def stream_gemini(prompt: str, deadline: Optional[float] = None,
+                  stops: Optional[StopConditions] = None) -> Iterator[str]:
+    """Stream a Gemini response as text chunks."""
+    deadline = _default_deadline(deadline)
     if not config.api_keys["gemini"]["api_key"]:
-        return "Gemini API key not set. Use %set_api_key gemini <your_key>"
+        raise ProviderError("Gemini API key not set. Use %set_api_key gemini <your_key>")
 
     try:
-        genai.configure(api_key=config.api_keys["gemini"]["api_key"])
-        model = genai.GenerativeModel(config.api_keys["gemini"]["model"])
-        response = model.generate_content(prompt)
-        test = response.text.strip()
-        return test
+        model = _gemini_model()
+        generation_config = {"stop_sequences": stops.native(5)} if stops and stops.sequences else None
+        chunks = _with_retries("gemini", prompt, lambda left: model.generate_content(
+            prompt, stream=True, generation_config=generation_config, request_options={"timeout": left}
+        ), deadline)
+        for chunk in chunks:
+            remaining(deadline)
+            if chunk.text:
+                yield chunk.text
+    except ProviderError:
+        raise
     except Exception as e:
         logger.error(f"Gemini API error: {e}")
-        return f"Error: {str(e)}"
+        raise ProviderError(f"Error: {str(e)}") from e
+
+def call_gemini(prompt: str, deadline: Optional[float] = None) -> str:
+    return _join_stream(stream_gemini(prompt, deadline))
 
 def download_huggingface_model(model_name: str, cache_dir: Optional[str] = None) -> str:
     """Download a model from HuggingFace Hub to run locally."""
     try:
+        from huggingface_hub import snapshot_download
         logger.info(f"Downloading model {model_name} from HuggingFace Hub...")
         
         model_path = snapshot_download(
@@ -125,91 +425,631 @@ def download_huggingface_model(model_name: str, cache_dir: Optional[str] = None)
         logger.error(f"Error downloading model: {e}")
         raise
 
-def load_downloaded_model(model_path: str, device: str = "auto", load_in_8bit: bool = False):
-    """Load a downloaded model with various optimizations."""
-    try:
-        logger.info(f"Loading model from {model_path}")
-        
-        model_kwargs = {
-            "device_map": device,
-            "torch_dtype": torch.float16,
-        }
-        
+def _load_registered_model(model_name_or_path: str, device: str, load_in_8bit: bool,
+                           dtype: str, quantize: Optional[str]):
+    """Load a model and tokenizer through the model registry; returns (key, model, tokenizer)."""
+    device = resolve_device(device)
+    if load_in_8bit and device == "cpu":
+        # bitsandbytes 8-bit loading needs a GPU
+        load_in_8bit, quantize = False, "int8"
+    if quantize == "int8":
+        # Dynamic quantization works on float32 weights
+        dtype = "float32"
+    elif dtype == "auto":
+        dtype = select_dtype(device)
+    key = (model_name_or_path, dtype, device, "8bit" if load_in_8bit else quantize)
+
+    def loader():
+        import torch
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+        logger.info(f"Loading local model: {model_name_or_path} ({dtype}, {device}{', ' + quantize if quantize else ''})")
+        model_kwargs = {"torch_dtype": getattr(torch, dtype)}
+        if device != "cpu":
+            # device_map needs accelerate; plain CPU loading does not
+            model_kwargs["device_map"] = device
         if load_in_8bit:
             model_kwargs["load_in_8bit"] = True
-        
-        tokenizer = AutoTokenizer.from_pretrained(model_path)
-        model = AutoModelForCausalLM.from_pretrained(
-            model_path,
-            **model_kwargs
-        )
-        
-        config.local_model = model
-        config.local_tokenizer = tokenizer
-        
-        logger.info("Model loaded successfully")
-        return True
-        
+        tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+        model = AutoModelForCausalLM.from_pretrained(model_name_or_path, **model_kwargs)
+        if quantize == "int8":
+            model = quantize_int8(model)
+        model.eval()
+        return model, tokenizer
+
+    expected = {device_type(device): checkpoint_bytes(model_name_or_path)}
+    model, tokenizer = model_registry.load(key, loader, expected)
+    return key, model, tokenizer
+
+def _on_model_unloaded(key):
+    """Detach an unloaded model from the config if it was the active model or its draft."""
+    if key is not None and key == config.local_model_key:
+        config.local_model = config.local_tokenizer = config.local_model_key = None
+    if key is not None and key == config.draft_model_key:
+        config.draft_model = config.draft_tokenizer = config.draft_model_key = None
+
+model_registry.on_unload.append(_on_model_unloaded)
+
+def load_local_transformers_model(model_name_or_path: str, device: str = "auto", load_in_8bit: bool = False,
+                                  dtype: str = "auto", quantize: Optional[str] = None) -> bool:
+    """
+    Load a local Transformers model and make it the active local model.
+
+    Parameters:
+    - model_name_or_path (str): Local directory or Hub id of the model.
+    - device (str): "auto", "cpu", "cuda", ... "auto" loads on CPU when no GPU is available.
+    - load_in_8bit (bool): 8-bit weights via bitsandbytes on GPU; on CPU this means quantize="int8".
+    - dtype (str): Weight dtype, or "auto" to pick one for the device (see models.select_dtype).
+    - quantize (str): "int8" for dynamic int8 quantization of linear layers on CPU.
+
+    Models are kept in the model registry keyed by path, dtype, device and
+    quantization, so switching back to a loaded model does not reload it.
+    The active model and its draft are pinned in the registry. Switching to
+    another model removes the draft, since it was matched to the old
+    model's tokenizer.
+    """
+    # The model being replaced may be evicted to make room, the draft may not
+    model_registry.pin(config.draft_model_key)
+    try:
+        key, model, tokenizer = _load_registered_model(model_name_or_path, device, load_in_8bit, dtype, quantize)
     except Exception as e:
-        logger.error(f"Error loading model: {e}")
+        logger.error(f"Error loading local model: {e}")
+        model_registry.pin(config.local_model_key, config.draft_model_key)
         return False
+    if key != config.local_model_key:
+        config.draft_model = config.draft_tokenizer = config.draft_model_key = None
+    config.local_model, config.local_tokenizer, config.local_model_key = model, tokenizer, key
+    model_registry.pin(config.local_model_key, config.draft_model_key)
+    return True
 
-def load_local_transformers_model(model_name_or_path: str):
-    """Load a local Transformers model."""
-    try:
-        logger.info(f"Loading local model: {model_name_or_path}")
-        tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name_or_path,
-            torch_dtype=torch.float16,
-            device_map="auto"
-        )
-        config.local_model = model
-        config.local_tokenizer = tokenizer
+def load_draft_model(model_name_or_path: Optional[str], device: str = "auto",
+                     dtype: str = "auto", quantize: Optional[str] = None) -> bool:
+    """
+    Load a small draft model for assisted (speculative) decoding, or remove it with None.
+
+    The draft proposes several tokens per step and the main model verifies them
+    in one forward pass; the output distribution is that of the main model.
+    The draft should share the main model's tokenizer. If its vocabulary
+    differs, generation falls back to translating tokens through text, which
+    is slower.
+    """
+    if not model_name_or_path:
+        config.draft_model = config.draft_tokenizer = config.draft_model_key = None
+        model_registry.pin(config.local_model_key)
         return True
+    # Loading the draft must not evict the main model
+    model_registry.pin(config.local_model_key)
+    try:
+        key, model, tokenizer = _load_registered_model(model_name_or_path, device, False, dtype, quantize)
     except Exception as e:
-        logger.error(f"Error loading local model: {e}")
+        logger.error(f"Error loading draft model: {e}")
+        model_registry.pin(config.local_model_key, config.draft_model_key)
         return False
+    config.draft_model, config.draft_model_key = model, key
+    same_vocab = config.local_tokenizer is not None and tokenizer.get_vocab() == config.local_tokenizer.get_vocab()
+    config.draft_tokenizer = None if same_vocab else tokenizer
+    model_registry.pin(config.local_model_key, config.draft_model_key)
+    return True
 
-def call_local_transformers(prompt: str) -> str:
-    """Use locally loaded Transformers model for text generation."""
+def _assistant_kwargs(batch_size: int = 1) -> Dict[str, Any]:
+    """Extra `generate` arguments for assisted decoding with the draft model, if one is loaded."""
+    if config.draft_model is None or batch_size != 1:
+        # Assisted generation only supports a single sequence
+        return {}
+    kwargs = {"assistant_model": config.draft_model}
+    if config.draft_tokenizer is not None:
+        kwargs.update(tokenizer=config.local_tokenizer, assistant_tokenizer=config.draft_tokenizer)
+    return kwargs
+
+def load_downloaded_model(model_path: str, device: str = "auto", load_in_8bit: bool = False,
+                          dtype: str = "auto", quantize: Optional[str] = None):
+    """Load a downloaded model with various optimizations."""
+    return load_local_transformers_model(model_path, device=device, load_in_8bit=load_in_8bit,
+                                         dtype=dtype, quantize=quantize)
+
+def unload_local_models():
+    """Unload every registered local model, including the active one."""
+    config.local_model = None
+    config.local_tokenizer = None
+    config.local_model_key = None
+    config.draft_model = None
+    config.draft_tokenizer = None
+    config.draft_model_key = None
+    prefix_cache.clear()
+    model_registry.pin()
+    model_registry.clear()
+
+def _dynamic_cache_class():
+    """transformers.DynamicCache, or None on versions before 4.36 where prefix caching is unavailable."""
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        logger.debug("transformers has no DynamicCache; prefix KV caching is disabled")
+        return None
+    return DynamicCache
+
+class _EventStoppingCriteria:
+    """
+    Stops `generate` as soon as the given threading.Event is set.
+
+    Duck-types transformers.StoppingCriteria so that transformers is only imported with a local model.
+    """
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.event.is_set()
+
+
+def stream_local_transformers(prompt: str, deadline: Optional[float] = None,
+                              stops: Optional[StopConditions] = None) -> Iterator[str]:
+    """
+    Stream text from the locally loaded Transformers model as it is generated.
+
+    `generate` runs on a worker thread feeding a TextIteratorStreamer. If the
+    consumer stops early (closed generator, KeyboardInterrupt) generation is
+    stopped at the next token and the text received so far stays valid.
+
+    With config.prefix_cache enabled, the KV cache of the longest prompt prefix
+    seen before is reused so only the new part of the prompt is prefilled.
+    This needs transformers 4.36 or later (DynamicCache); older versions
+    generate without it.
+    """
     if not config.local_model or not config.local_tokenizer:
-        return "Local model not loaded. Use %set_llm_provider transformers_local <model_path>"
+        raise ProviderError("Local model not loaded. Use %set_llm_provider transformers_local <model_path>")
 
+    deadline = _default_deadline(deadline)
+    stop_event = threading.Event()
     try:
+        from transformers import TextIteratorStreamer, StoppingCriteriaList
         inputs = config.local_tokenizer(prompt, return_tensors="pt").to(config.local_model.device)
-        outputs = config.local_model.generate(
-            inputs["input_ids"],
-            max_new_tokens=800,
-            temperature=0.7,
-            do_sample=True,
-            pad_token_id=config.local_tokenizer.eos_token_id
-        )
-        response = config.local_tokenizer.decode(outputs[0], skip_special_tokens=True)
-        this_is_bs = response[len(prompt):].strip()
-        return this_is_bs
+        streamer = TextIteratorStreamer(config.local_tokenizer, skip_prompt=True, skip_special_tokens=True,
+                                        timeout=remaining(deadline))
+        errors = []
+
+        cache = owner = token_ids = None
+        DynamicCache = _dynamic_cache_class() if config.prefix_cache else None
+        if DynamicCache is not None:
+            ids = inputs["input_ids"][0]
+            token_ids = ids.tolist() if hasattr(ids, "tolist") else list(ids)
+            owner = config.local_model_key
+            cache, cached = prefix_cache.lookup(owner, token_ids)
+            if cache is None:
+                cache = DynamicCache()
+            else:
+                logger.debug(f"Reusing KV cache for {cached} of {len(token_ids)} prompt tokens")
+
+        criteria = [_EventStoppingCriteria(stop_event)]
+        if stops:
+            criteria.append(StopCriteria(stops, config.local_tokenizer, inputs["input_ids"].shape[-1]))
+
+        def generate():
+            try:
+                config.local_model.generate(
+                    inputs["input_ids"],
+                    attention_mask=inputs.get("attention_mask"),
+                    past_key_values=cache,
+                    max_new_tokens=config.max_tokens,
+                    temperature=config.temperature,
+                    do_sample=True,
+                    pad_token_id=config.local_tokenizer.eos_token_id,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList(criteria),
+                    **_assistant_kwargs()
+                )
+                if cache is not None:
+                    prefix_cache.store(owner, token_ids, cache)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        worker = threading.Thread(target=contextvars.copy_context().run, args=(generate,), name="codemate-generate",
+                                  daemon=True)
+        worker.start()
+        try:
+            for text in streamer:
+                remaining(deadline)
+                if text:
+                    yield text
+        except queue.Empty:
+            # The streamer's timeout: no token arrived before the deadline
+            raise DeadlineExceeded("deadline exceeded")
+        # The streamer ends inside generate(); wait until the prompt's KV cache is stored
+        # so that an immediately following call can reuse it
+        worker.join()
+        if errors:
+            raise errors[0]
+    except ProviderError:
+        raise
     except Exception as e:
-        return f"Local Transformers Error: {str(e)}"
+        raise ProviderError(f"Local Transformers Error: {str(e)}") from e
+    finally:
+        stop_event.set()
 
-def call_huggingface_hub(prompt: str) -> str:
-    """Use HuggingFace Hub inference API for text generation."""
-    if not config.api_keys["huggingface"]["api_key"]:
-        return "HuggingFace API key not set. Use %set_api_key huggingface <your_key>"
+def generate_local_batch(prompts: List[str], max_new_tokens: int, temperature: float,
+                         stops: Optional[StopConditions] = None) -> List[str]:
+    """
+    Generate completions for several prompts with one padded `generate` call.
 
+    Prompts are left-padded, as decoder-only models continue from the last
+    position. With stop conditions, each sequence stops as soon as its own
+    text is complete. Returns the generated text for each prompt, in order.
+    """
+    model, tokenizer = config.local_model, config.local_tokenizer
+    if not model or not tokenizer:
+        raise ProviderError("Local model not loaded. Use %set_llm_provider transformers_local <model_path>")
+    # The tokenizer is shared with the streaming path, so padding is only changed while tokenizing
+    pad_token, padding_side = tokenizer.pad_token, tokenizer.padding_side
     try:
-        from huggingface_hub import InferenceClient
+        if pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+        pad_token_id = tokenizer.pad_token_id
+    finally:
+        tokenizer.pad_token, tokenizer.padding_side = pad_token, padding_side
+    prompt_length = inputs["input_ids"].shape[1]
+    output = model.generate(
+        inputs["input_ids"],
+        attention_mask=inputs["attention_mask"],
+        max_new_tokens=max_new_tokens,
+        temperature=temperature,
+        do_sample=True,
+        pad_token_id=pad_token_id,
+        stopping_criteria=[StopCriteria(stops, tokenizer, prompt_length)] if stops else None,
+        **_assistant_kwargs(len(prompts))
+    )
+    texts = tokenizer.batch_decode(output[:, prompt_length:], skip_special_tokens=True)
+    if stops:
+        # Trim the tokens generated past the stop within the last step
+        texts = [text[:stops.cut(text)] if stops.cut(text) is not None else text for text in texts]
+    return [text.strip() for text in texts]
 
-        client = InferenceClient(
-            token=config.api_keys["huggingface"]["api_key"],
-            model=config.api_keys["huggingface"]["model"] or "gpt2"
-        )
-        result = client.text_generation(
+def call_local_transformers(prompt: str, deadline: Optional[float] = None) -> str:
+    """Use locally loaded Transformers model for text generation."""
+    return _join_stream(stream_local_transformers(prompt, deadline))
+
+def stream_huggingface_hub(prompt: str, deadline: Optional[float] = None,
+                           stops: Optional[StopConditions] = None) -> Iterator[str]:
+    """Stream tokens from the HuggingFace Hub inference API."""
+    deadline = _default_deadline(deadline)
+    if _missing_key("huggingface"):
+        raise ProviderError("HuggingFace API key not set. Use %set_api_key huggingface <your_key>")
+
+    try:
+        client = _huggingface_client()
+        tokens = _with_retries("huggingface", prompt, lambda left: client.text_generation(
             prompt,
-            max_new_tokens=800,
-            temperature=0.7,
+            max_new_tokens=config.max_tokens,
+            temperature=config.temperature,
             do_sample=True,
-            return_full_text=False
+            return_full_text=False,
+            stop=stops.native() if stops and stops.sequences else None,
+            stream=True
+        ), deadline)
+        for token in tokens:
+            remaining(deadline)
+            if token:
+                yield token
+    except ProviderError:
+        raise
+    except Exception as e:
+        raise ProviderError(f"HuggingFace Hub Error: {str(e)}") from e
+
+def call_huggingface_hub(prompt: str, deadline: Optional[float] = None) -> str:
+    """Use HuggingFace Hub inference API for text generation."""
+    return _join_stream(stream_huggingface_hub(prompt, deadline))
+
+
+def stream_provider(prompt: str, provider: Optional[LLMProvider] = None,
+                    deadline: Optional[float] = None, stops: Optional[StopConditions] = None) -> Iterator[str]:
+    """
+    Stream the response of the configured (or given) provider as text deltas.
+
+    Every backend, API or local, is consumed through this same incremental interface.
+    Stop conditions are passed to the backend natively where possible and
+    enforced on the streamed text, closing the backend stream once they match.
+
+    Without a given provider, requests are routed over config.routing when it is set.
+
+    Raises ProviderError with a user-facing message if the call fails.
+    """
+    if provider is None and config.routing:
+        yield from _stream_routed(prompt, deadline, stops)
+        return
+    provider = provider or config.provider
+    if provider == LLMProvider.OPENAI:
+        stream = stream_openai(prompt, deadline, stops)
+    elif provider == LLMProvider.ANTHROPIC:
+        stream = stream_anthropic(prompt, deadline, stops)
+    elif provider == LLMProvider.GEMINI:
+        stream = stream_gemini(prompt, deadline, stops)
+    elif provider == LLMProvider.TRANSFORMERS_HUB:
+        stream = stream_huggingface_hub(prompt, deadline, stops)
+    elif provider in (LLMProvider.TRANSFORMERS_LOCAL, LLMProvider.TRANSFORMERS_DOWNLOAD):
+        stream = stream_local_transformers(prompt, deadline, stops)
+    else:
+        raise ProviderError("Provider not implemented")
+    yield from apply_stops(stream, stops)
+
+
+def _route_key(provider: LLMProvider) -> tuple:
+    return (provider.value, model_id(provider))
+
+
+def _stream_routed(prompt: str, deadline: Optional[float], stops: Optional[StopConditions]) -> Iterator[str]:
+    """Stream from the fastest healthy provider in config.routing, hedging slow requests."""
+    deadline = _default_deadline(deadline)
+    candidates = {_route_key(provider): provider for provider in config.routing}
+    router.hedge = config.hedge
+
+    def selected(key):
+        telemetry.annotate(provider=key[0], model=key[1])
+
+    try:
+        yield from router.stream(
+            list(candidates), lambda key: stream_provider(prompt, candidates[key], deadline, stops), deadline,
+            on_select=selected
         )
-        return result.strip()
+    except DeadlineExceeded as e:
+        raise ProviderError(f"Routing Error: {e}") from e
+
+
+def call_provider(prompt: str, provider: Optional[LLMProvider] = None,
+                  deadline: Optional[float] = None, stops: Optional[StopConditions] = None) -> str:
+    """Call the configured (or given) provider and return the full response text."""
+    return _join_stream(stream_provider(prompt, provider, deadline, stops))
+
+
+def _endpoint(provider: Optional[LLMProvider]) -> Optional[str]:
+    """The custom base_url configured for an API provider, if any."""
+    if provider == LLMProvider.TRANSFORMERS_HUB:
+        return config.api_keys["huggingface"].get("base_url")
+    if provider is not None and provider.value in config.api_keys:
+        return config.api_keys[provider.value].get("base_url")
+    return None
+
+
+def model_id(provider: Optional[LLMProvider] = None) -> Optional[str]:
+    """Identify the model serving the configured (or given) provider."""
+    provider = provider or config.provider
+    if provider in (LLMProvider.TRANSFORMERS_LOCAL, LLMProvider.TRANSFORMERS_DOWNLOAD):
+        return getattr(config.local_model, "name_or_path", None)
+    if provider == LLMProvider.TRANSFORMERS_HUB:
+        return config.api_keys["huggingface"]["model"]
+    if provider is not None and provider.value in config.api_keys:
+        return config.api_keys[provider.value]["model"]
+    return None
+
+
+def stream_cached(prompt: str, persona: str = "", use_cache: bool = True,
+                  provider: Optional[LLMProvider] = None, deadline: Optional[float] = None,
+                  stops: Optional[StopConditions] = None) -> Iterator[str]:
+    """
+    Stream a response through the response cache.
+
+    A cache hit is yielded as a single chunk. On a miss the provider stream is
+    passed through and stored once it completes; failed or interrupted
+    responses are never cached. With use_cache=False the lookup is skipped
+    but the fresh response still replaces the cached one.
+    """
+    if provider is None and config.routing:
+        # Any of the routed providers may answer
+        name, model = "route", ",".join(f"{p}/{m}" for p, m in map(_route_key, config.routing))
+    else:
+        provider = provider or config.provider
+        name, model = provider.value if provider else None, model_id(provider)
+        telemetry.annotate(provider=name, model=model)
+    params = dict(config.generation_params(), stops=stops.key() if stops else None)
+    endpoint = _endpoint(provider)
+    if endpoint:
+        # The same model name on another server may answer differently
+        params["base_url"] = endpoint
+    key = response_cache.make_key(name, model, params, persona, prompt)
+    if use_cache:
+        cached = response_cache.get(key)
+        if cached is not None:
+            telemetry.annotate(cache_hit=True)
+            yield cached
+            return
+
+    chunks = []
+    for delta in stream_provider(prompt, provider, deadline, stops):
+        chunks.append(delta)
+        yield delta
+    response_cache.put(key, "".join(chunks))
+
+
+# ---------------------------------------------------------------------------
+# asyncio API
+#
+# The provider transports (pooled requests sessions, vendor SDKs, local
+# generate) are blocking, so the async API runs them on a bounded executor.
+# At most config.max_concurrency calls are in flight at once, across all
+# callers in the kernel.
+# ---------------------------------------------------------------------------
+
+_executor = None
+_executor_size = None
+_executor_lock = threading.Lock()
+
+
+def _provider_executor() -> ThreadPoolExecutor:
+    """Return the shared executor, resized when config.max_concurrency changes."""
+    global _executor, _executor_size
+    with _executor_lock:
+        if _executor is None or _executor_size != config.max_concurrency:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ThreadPoolExecutor(max_workers=config.max_concurrency,
+                                           thread_name_prefix="codemate-provider")
+            _executor_size = config.max_concurrency
+        return _executor
+
+
+async def _run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Executor threads do not inherit the caller's context (and its telemetry span) by themselves
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await loop.run_in_executor(_provider_executor(), call)
+
+
+async def acall_openai(prompt: str, deadline: Optional[float] = None) -> str:
+    return await _run_blocking(call_openai, prompt, _default_deadline(deadline))
+
+async def acall_anthropic(prompt: str, deadline: Optional[float] = None) -> str:
+    return await _run_blocking(call_anthropic, prompt, _default_deadline(deadline))
+
+async def acall_gemini(prompt: str, deadline: Optional[float] = None) -> str:
+    return await _run_blocking(call_gemini, prompt, _default_deadline(deadline))
+
+async def acall_huggingface_hub(prompt: str, deadline: Optional[float] = None) -> str:
+    return await _run_blocking(call_huggingface_hub, prompt, _default_deadline(deadline))
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def _local_batcher() -> BatchScheduler:
+    """Return the shared local batch scheduler, rebuilt when its settings change."""
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None or (_batcher.max_batch_size, _batcher.max_wait) != (config.local_batch_size,
+                                                                                config.local_batch_wait):
+            if _batcher is not None:
+                _batcher.close()
+            _batcher = BatchScheduler(generate_local_batch, max_batch_size=config.local_batch_size,
+                                      max_wait=config.local_batch_wait)
+        return _batcher
+
+
+async def acall_local_transformers(prompt: str, deadline: Optional[float] = None,
+                                   stops: Optional[StopConditions] = None) -> str:
+    """
+    Async counterpart of call_local_transformers.
+
+    With config.local_batching, requests are queued on the batch scheduler, so
+    prompts awaited concurrently (e.g. through agather_provider) share batched
+    `generate` calls instead of running one at a time.
+    """
+    deadline = _default_deadline(deadline)
+    if not config.local_batching:
+        return await _run_blocking(call_provider, prompt, LLMProvider.TRANSFORMERS_LOCAL, deadline, stops)
+    if not config.local_model or not config.local_tokenizer:
+        raise ProviderError("Local model not loaded. Use %set_llm_provider transformers_local <model_path>")
+
+    future = _local_batcher().submit(prompt, max_new_tokens=config.max_tokens, temperature=config.temperature,
+                                     stops=stops)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), remaining(deadline))
+    except (asyncio.TimeoutError, DeadlineExceeded) as e:
+        future.cancel()
+        raise ProviderError("Local Transformers Error: deadline exceeded") from e
+    except ProviderError:
+        raise
     except Exception as e:
-        return f"HuggingFace Hub Error: {str(e)}"
+        raise ProviderError(f"Local Transformers Error: {str(e)}") from e
+
+
+async def acall_provider(prompt: str, provider: Optional[LLMProvider] = None,
+                        deadline: Optional[float] = None, stops: Optional[StopConditions] = None) -> str:
+    """Async counterpart of call_provider. The deadline also covers time spent queued."""
+    if provider is None and config.routing:
+        return await _run_blocking(call_provider, prompt, None, _default_deadline(deadline), stops)
+    provider = provider or config.provider
+    if provider in (LLMProvider.TRANSFORMERS_LOCAL, LLMProvider.TRANSFORMERS_DOWNLOAD):
+        return await acall_local_transformers(prompt, deadline, stops)
+    return await _run_blocking(call_provider, prompt, provider, _default_deadline(deadline), stops)
+
+
+class _StreamFailure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+async def astream_provider(prompt: str, provider: Optional[LLMProvider] = None,
+                          deadline: Optional[float] = None) -> AsyncIterator[str]:
+    """
+    Async counterpart of stream_provider.
+
+    The provider stream is consumed on the executor and its deltas are handed
+    to the event loop as they arrive. If the consumer stops early the
+    underlying stream is closed, which also stops local generation.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    stop_event = threading.Event()
+    finished = object()
+    deadline = _default_deadline(deadline)
+
+    def deliver(item):
+        try:
+            loop.call_soon_threadsafe(chunks.put_nowait, item)
+        except RuntimeError:
+            # The event loop is gone; nobody is listening anymore
+            stop_event.set()
+
+    def produce():
+        stream = stream_provider(prompt, provider, deadline)
+        try:
+            for delta in stream:
+                if stop_event.is_set():
+                    break
+                deliver(delta)
+        except BaseException as e:
+            deliver(_StreamFailure(e))
+        finally:
+            stream.close()
+            deliver(finished)
+
+    loop.run_in_executor(_provider_executor(), contextvars.copy_context().run, produce)
+    try:
+        while True:
+            item = await chunks.get()
+            if item is finished:
+                break
+            if isinstance(item, _StreamFailure):
+                raise item.error
+            yield item
+    finally:
+        stop_event.set()
+
+
+async def agather_provider(prompts: List[str], provider: Optional[LLMProvider] = None,
+                           limit: Optional[int] = None, deadline: Optional[float] = None,
+                           stops: Optional[StopConditions] = None) -> List[str]:
+    """
+    Run many prompts concurrently and return their responses in order.
+
+    At most `limit` prompts are in flight: by default config.max_concurrency,
+    or config.local_batch_size for local models so that full batches can form.
+    """
+    if limit is None:
+        routed = provider is None and config.routing
+        local = not routed and (provider or config.provider) in (LLMProvider.TRANSFORMERS_LOCAL,
+                                                                LLMProvider.TRANSFORMERS_DOWNLOAD)
+        limit = config.local_batch_size if local and config.local_batching else config.max_concurrency
+    semaphore = asyncio.Semaphore(limit)
+    deadline = _default_deadline(deadline)
+
+    async def run(prompt):
+        async with semaphore:
+            return await acall_provider(prompt, provider, deadline, stops)
+
+    return await asyncio.gather(*(run(prompt) for prompt in prompts))
+
+
+def run_async(coro):
+    """
+    Run a coroutine to completion from synchronous code.
+
+    Inside Jupyter the kernel's event loop is already running, so the
+    coroutine is run on a fresh loop in a helper thread instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    with ThreadPoolExecutor(max_workers=1) as runner:
+        return runner.submit(contextvars.copy_context().run, asyncio.run, coro).result()
@@ -0,0 +1,113 @@
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+# HTTP statuses worth retrying: rate limited, overloaded or transient server errors.
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a call cannot finish before its deadline."""
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `per_minute` units per minute.
+
+    A rate of None means unlimited.
+    """
+
+    def __init__(self, per_minute: Optional[float], capacity: Optional[float] = None):
+        self.per_minute = per_minute
+        self.capacity = capacity or per_minute or 0
+        self._available = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        rate = self.per_minute / 60.0
+        self._available = min(self.capacity, self._available + (now - self._updated) * rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Take `amount` units and return how many seconds the caller must wait first.
+
+        Requests larger than the bucket are capped to its capacity so they can still proceed.
+        """
+        if not self.per_minute:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            amount = min(amount, self.capacity)
+            self._available -= amount
+            if self._available >= 0:
+                return 0.0
+            return -self._available / (self.per_minute / 60.0)
+
+    def refund(self, amount: float):
+        """Give back units taken by reserve() for a call that did not go ahead."""
+        if not self.per_minute:
+            return
+        with self._lock:
+            self._available = min(self.capacity, self._available + min(amount, self.capacity))
+
+
+class RateLimiter:
+    """Per-provider limits on requests per minute and tokens per minute."""
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def acquire(self, tokens: int, deadline: Optional[float] = None):
+        """Block until one request of `tokens` tokens is allowed; raise DeadlineExceeded if that is too late."""
+        wait = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        if wait <= 0:
+            return
+        if deadline is not None and time.monotonic() + wait > deadline:
+            # Rejected calls must not use up budget that later calls could have had
+            self.requests.refund(1)
+            self.tokens.refund(tokens)
+            raise DeadlineExceeded(f"rate limit wait of {wait:.1f}s exceeds the deadline")
+        time.sleep(wait)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None,
+                  base: float = 0.5, cap: float = 30.0) -> float:
+    """
+    Delay before retry number `attempt` (0-based).
+
+    Uses full-jitter exponential backoff, but never less than the server's Retry-After.
+    """
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def remaining(deadline: Optional[float]) -> Optional[float]:
+    """Seconds left until deadline (a time.monotonic() value), or None without a deadline."""
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("deadline exceeded")
+    return left
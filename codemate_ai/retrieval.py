@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import math
+import logging
+from collections import Counter
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+
+from codemate_ai.cache import get_cache_dir
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+_CAMEL = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split code into lowercase search terms.
+
+    Identifiers are kept whole and also split on underscores and camelCase,
+    so `load_csv_file` matches queries for `load`, `csv` and `file`.
+    """
+    terms = []
+    for word in _WORD.findall(text):
+        lower = word.lower()
+        terms.append(lower)
+        parts = [part.lower() for piece in word.split("_") for part in _CAMEL.findall(piece)]
+        if len(parts) > 1:
+            terms.extend(parts)
+    return terms
+
+
+class CodeIndex:
+    """
+    BM25 index over code chunks, updated incrementally per cell.
+
+    Postings are kept per term and converted to NumPy arrays lazily, so a query
+    only touches the arrays of its own terms and scores all chunks with a single
+    vectorized accumulation.
+    """
+
+    def __init__(self, path: Optional[str] = None, k1: float = 1.5, b: float = 0.75):
+        self.path = path or os.path.join(get_cache_dir(), "code_index.json")
+        self.k1 = k1
+        self.b = b
+        self._chunks = {}
+        self._cells = {}
+        self._postings = {}
+        self._arrays = {}
+        self._lengths = np.zeros(0, dtype=np.float32)
+        self._total_length = 0
+        self._next_id = 0
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def _add_chunk(self, chunk: Dict[str, Any], terms: Dict[str, int]) -> int:
+        chunk_id = self._next_id
+        self._next_id += 1
+        length = sum(terms.values())
+        self._chunks[chunk_id] = dict(chunk, terms=terms)
+        if chunk_id >= len(self._lengths):
+            grown = np.zeros(max(16, 2 * len(self._lengths), chunk_id + 1), dtype=np.float32)
+            grown[:len(self._lengths)] = self._lengths
+            self._lengths = grown
+        self._lengths[chunk_id] = length
+        self._total_length += length
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[chunk_id] = tf
+            self._arrays.pop(term, None)
+        return chunk_id
+
+    def _remove_chunk(self, chunk_id: int):
+        chunk = self._chunks.pop(chunk_id)
+        self._total_length -= int(self._lengths[chunk_id])
+        self._lengths[chunk_id] = 0
+        for term in chunk["terms"]:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(chunk_id, None)
+                if not postings:
+                    del self._postings[term]
+            self._arrays.pop(term, None)
+
+    def update_cell(self, cell_key: str, chunks: List[Dict[str, Any]]):
+        """Index the chunks of a cell; cells are keyed by content hash, so known keys are skipped."""
+        if cell_key in self._cells:
+            return
+        ids = []
+        for chunk in chunks:
+            terms = dict(Counter(tokenize(f"{chunk['name']}\n{chunk['source']}")))
+            if terms:
+                ids.append(self._add_chunk(chunk, terms))
+        self._cells[cell_key] = ids
+        self._dirty = True
+
+    def remove_cell(self, cell_key: str):
+        """Drop every chunk that came from a cell."""
+        for chunk_id in self._cells.pop(cell_key, []):
+            self._remove_chunk(chunk_id)
+        self._dirty = True
+
+    def sync(self, cells: Dict[str, List[Dict[str, Any]]]):
+        """
+        Make the index mirror `cells` (cell key -> chunks).
+
+        Only cells that were added or removed since the last sync are touched.
+        """
+        for cell_key in [key for key in self._cells if key not in cells]:
+            self.remove_cell(cell_key)
+        for cell_key, chunks in cells.items():
+            self.update_cell(cell_key, chunks)
+
+    def _term_arrays(self, term: str):
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            postings = self._postings[term]
+            arrays = (
+                np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                np.fromiter(postings.values(), dtype=np.float32, count=len(postings)),
+            )
+            self._arrays[term] = arrays
+        return arrays
+
+    def search(self, query: str, k: int = 5) -> List[Dict[str, Any]]:
+        """Return up to k chunks ranked by BM25 score, each with a "score" entry."""
+        if not self._chunks:
+            return []
+
+        count = len(self._chunks)
+        avg_length = self._total_length / count if count else 1.0
+        scores = np.zeros(self._next_id, dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self._postings:
+                continue
+            ids, tfs = self._term_arrays(term)
+            idf = math.log(1 + (count - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self._lengths[ids] / avg_length)
+            scores[ids] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+
+        k = min(k, int(np.count_nonzero(scores)))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        for chunk_id in top:
+            chunk = self._chunks[int(chunk_id)]
+            results.append({"name": chunk["name"], "kind": chunk["kind"],
+                            "source": chunk["source"], "score": float(scores[chunk_id])})
+        return results
+
+    def save(self):
+        """Write the index to disk if it changed."""
+        if not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({
+                    "cells": {key: [self._chunks[i] for i in ids] for key, ids in self._cells.items()}
+                }, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except Exception as e:
+            logger.warning(f"Could not write code index {self.path}: {e}")
+
+    @classmethod
+    def load(cls, path: Optional[str] = None, **kwargs) -> "CodeIndex":
+        """Load an index saved with `save`, or return an empty one."""
+        index = cls(path=path, **kwargs)
+        if not os.path.exists(index.path):
+            return index
+        try:
+            with open(index.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for cell_key, chunks in data.get("cells", {}).items():
+                index._cells[cell_key] = [
+                    index._add_chunk({key: chunk[key] for key in ("name", "kind", "source")}, chunk["terms"])
+                    for chunk in chunks
+                ]
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable code index {index.path}: {e}")
+        index._dirty = False
+        return index
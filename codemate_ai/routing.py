@@ -0,0 +1,241 @@
+import time
+import queue
+import logging
+import threading
+import contextvars
+from collections import deque
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Sequence
+
+from codemate_ai.ratelimit import DeadlineExceeded, remaining
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyStats:
+    """
+    Rolling latency and error rate over the last `window` calls of one provider and model.
+
+    Latency is time to first chunk: what the user waits for before output appears.
+    """
+
+    def __init__(self, window: int = 100):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency: Optional[float], ok: bool = True):
+        with self._lock:
+            self._samples.append((latency, ok))
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Latency percentile (0-100) of the successful calls, or None before any succeeded."""
+        with self._lock:
+            latencies = sorted(latency for latency, ok in self._samples if ok)
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(round(q / 100 * (len(latencies) - 1))))
+        return latencies[index]
+
+    @property
+    def p50(self) -> Optional[float]:
+        return self.percentile(50)
+
+    @property
+    def p95(self) -> Optional[float]:
+        return self.percentile(95)
+
+    @property
+    def error_rate(self) -> float:
+        with self._lock:
+            if not self._samples:
+                return 0.0
+            return sum(1 for _, ok in self._samples if not ok) / len(self._samples)
+
+
+class _Attempt:
+    """One provider stream opened on a worker thread, up to its first chunk."""
+
+    def __init__(self, key: Hashable, open_stream: Callable[[Hashable], Iterator[str]], results: "queue.Queue"):
+        self.key = key
+        self.started = time.monotonic()
+        self.cancelled = False
+        self._stream = None
+        self._lock = threading.Lock()
+        self._open_stream = open_stream
+        self._results = results
+        # Run in the caller's context so the attempt's work counts towards its telemetry span
+        threading.Thread(target=contextvars.copy_context().run, args=(self._run,), name="codemate-route",
+                         daemon=True).start()
+
+    def _run(self):
+        stream = None
+        try:
+            stream = self._open_stream(self.key)
+            first = next(stream, None)
+        except Exception as e:
+            self._results.put((self, None, None, e))
+            return
+        with self._lock:
+            if self.cancelled:
+                # Lost the race: stop the request (and local generation) now
+                stream.close()
+                return
+            self._stream = stream
+            self._results.put((self, stream, first, None))
+
+    def cancel(self):
+        """Stop this attempt, closing its stream if it already delivered one."""
+        with self._lock:
+            self.cancelled = True
+            if self._stream is not None:
+                self._stream.close()
+
+
+class Router:
+    """
+    Routes requests over several providers by their recent latency and health.
+
+    Candidates are tried fastest first by rolling p50 time to first chunk;
+    candidates without measurements yet come first so every one gets measured,
+    and candidates whose recent error rate exceeds `max_error_rate` come last.
+    With `hedge`, when the chosen provider has not produced its first chunk
+    after its own p95, the same request is also sent to the next candidate;
+    the first to answer wins and the other is cancelled. A failed attempt
+    falls over to the next candidate.
+    """
+
+    def __init__(self, window: int = 100, max_error_rate: float = 0.5, min_samples: int = 5,
+                 hedge: bool = True):
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.hedge = hedge
+        self._stats = {}
+        self._lock = threading.Lock()
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def stats(self, key: Hashable) -> LatencyStats:
+        with self._lock:
+            if key not in self._stats:
+                self._stats[key] = LatencyStats(self.window)
+            return self._stats[key]
+
+    def healthy(self, key: Hashable) -> bool:
+        stats = self.stats(key)
+        return len(stats) < self.min_samples or stats.error_rate <= self.max_error_rate
+
+    def rank(self, candidates: Sequence[Hashable]) -> List[Hashable]:
+        """Candidates in the order they should be tried."""
+        def order(key):
+            p50 = self.stats(key).p50
+            return (not self.healthy(key), p50 is not None, p50 or 0.0)
+        return sorted(candidates, key=order)
+
+    def hedge_delay(self, key: Hashable) -> Optional[float]:
+        """Seconds to wait for key's first chunk before hedging, or None to not hedge."""
+        stats = self.stats(key)
+        if not self.hedge or len(stats) < self.min_samples:
+            return None
+        return stats.p95
+
+    def stream(self, candidates: Sequence[Hashable], open_stream: Callable[[Hashable], Iterator[str]],
+               deadline: Optional[float] = None,
+               on_select: Optional[Callable[[Hashable], None]] = None) -> Iterator[str]:
+        """
+        Stream a response from the best candidate.
+
+        Parameters:
+        - candidates (list): Keys of the providers to route over, e.g. (provider, model).
+        - open_stream (callable): Returns the text stream of the request for a key.
+        - deadline (float): time.monotonic() by which the first chunk must arrive.
+        - on_select (callable): Called with the key of the provider that answers.
+
+        Raises the last provider's error if every candidate fails, and
+        DeadlineExceeded if no candidate answers in time; the attempts still
+        running are then cancelled and recorded as failures.
+        """
+        pending = self.rank(candidates)
+        results = queue.Queue()
+        running = []
+        error = None
+        hedged = False
+
+        def start():
+            running.append(_Attempt(pending.pop(0), open_stream, results))
+
+        start()
+        primary = running[0]
+        try:
+            while True:
+                if not running:
+                    if not pending:
+                        raise error
+                    start()
+                timeout = remaining(deadline)
+                hedge = False
+                delay = self.hedge_delay(running[0].key) if len(running) == 1 and pending else None
+                if delay is not None:
+                    until_hedge = max(0.0, running[0].started + delay - time.monotonic())
+                    if timeout is None or until_hedge < timeout:
+                        timeout, hedge = until_hedge, True
+                try:
+                    attempt, stream, first, failure = results.get(timeout=timeout)
+                except queue.Empty:
+                    if not hedge:
+                        raise DeadlineExceeded("deadline exceeded")
+                    logger.debug(f"Hedging {running[0].key} with {pending[0]}")
+                    self.hedged += 1
+                    hedged = True
+                    start()
+                    continue
+                running.remove(attempt)
+                if failure is None:
+                    break
+                self.stats(attempt.key).record(None, ok=False)
+                logger.warning(f"Routed request to {attempt.key} failed: {failure}")
+                error = failure
+        except DeadlineExceeded:
+            # Attempts still waiting for their first chunk count as failures, so a
+            # hanging provider becomes unhealthy, and are stopped
+            for late in running:
+                late.cancel()
+                self.stats(late.key).record(None, ok=False)
+            raise
+
+        latency = time.monotonic() - attempt.started
+        if hedged and attempt is not primary:
+            self.hedge_wins += 1
+        for loser in running:
+            loser.cancel()
+        if on_select is not None:
+            on_select(attempt.key)
+
+        ok = True
+        try:
+            if first is not None:
+                yield first
+            yield from stream
+        except Exception:
+            ok = False
+            raise
+        finally:
+            stream.close()
+            self.stats(attempt.key).record(latency if ok else None, ok)
+
+    def summary(self) -> Dict[Hashable, Dict[str, Any]]:
+        """p50, p95, error rate and sample count per provider key."""
+        with self._lock:
+            keys = list(self._stats)
+        return {
+            key: {"p50": self.stats(key).p50, "p95": self.stats(key).p95,
+                  "error_rate": self.stats(key).error_rate, "samples": len(self.stats(key))}
+            for key in keys
+        }
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+        self.hedged = self.hedge_wins = 0
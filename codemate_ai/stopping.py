@@ -0,0 +1,239 @@
+import re
+from typing import Iterator, List, Optional, Sequence
+
+_FENCE = "```"
+
+
+def _fence_end(text: str, after: int = 0) -> Optional[int]:
+    """Index just past the line that closes the first fenced code block closed at or after `after` in text."""
+    opened = False
+    position = 0
+    for line in text.splitlines(keepends=True):
+        start = position
+        position += len(line)
+        if line.strip().startswith(_FENCE):
+            if opened and line.endswith("\n"):
+                if start >= after:
+                    return position
+                opened = False
+            else:
+                opened = True
+    return None
+
+
+def _open_triple_quote(line: str, quote: Optional[str] = None) -> Optional[str]:
+    """The triple quote still open at the end of a line of Python, given the one open at its start."""
+    i = 0
+    while i < len(line):
+        if quote:
+            if line[i] == "\\":
+                i += 2
+            elif line.startswith(quote, i):
+                quote = None
+                i += 3
+            else:
+                i += 1
+            continue
+        char = line[i]
+        if char == "#":
+            break
+        if line.startswith('"""', i) or line.startswith("'''", i):
+            quote = line[i:i + 3]
+            i += 3
+        elif char in "'\"":
+            # A one-line string: skip to its closing quote
+            i += 1
+            while i < len(line) and line[i] != char:
+                i += 2 if line[i] == "\\" else 1
+            i += 1
+        else:
+            i += 1
+    return quote
+
+
+def _function_header(name: str) -> "re.Pattern":
+    return re.compile(rf"^(\s*)(?:async\s+)?def\s+{re.escape(name)}\s*\(", re.MULTILINE)
+
+
+def _function_end(text: str, name: str) -> Optional[int]:
+    """
+    Index where the definition of function `name` ends in text.
+
+    The body ends at the first non-blank line indented no deeper than the
+    `def` line (the next definition, top-level code or a closing fence).
+    Lines inside triple-quoted strings never end it. Only complete lines are
+    considered, so a partially received line never ends it.
+    """
+    header = _function_header(name)
+    indent = None
+    depth = 0
+    in_body = False
+    quote = None
+    position = 0
+    for line in text.splitlines(keepends=True):
+        start = position
+        position += len(line)
+        if not line.endswith("\n"):
+            break
+        if indent is None:
+            match = header.match(line)
+            if not match:
+                continue
+            indent = len(match.group(1).expandtabs())
+        elif in_body:
+            in_string, quote = quote, _open_triple_quote(line, quote)
+            stripped = line.strip()
+            if in_string or not stripped:
+                continue
+            if len(line) - len(line.lstrip()) <= indent:
+                # A closing fence is kept so the markdown stays well-formed
+                return position if stripped.startswith(_FENCE) else start
+            continue
+
+        # Still in the signature, which may span several lines
+        quote = _open_triple_quote(line, quote)
+        code = line.split("#", 1)[0]
+        depth += code.count("(") + code.count("[") - code.count(")") - code.count("]")
+        if depth <= 0 and code.rstrip().endswith(":"):
+            in_body = True
+        elif depth <= 0 and ":" in code and code.rstrip()[-1:] != ":":
+            # One-line definition: `def f(x): return x`
+            return position
+    return None
+
+
+class StopConditions:
+    """
+    When a response is complete, independent of the provider.
+
+    - sequences: custom stop strings. They are passed to each provider's native
+      stop parameter and also enforced on the received text.
+    - fence: stop after the first fenced code block is closed.
+    - function: stop once the definition of this function is complete. With
+      fence also set, only a fence closed after the function's `def` line
+      counts, so code blocks before the function do not end the response.
+
+    Fence and function stops are detected on the text as it streams in; the
+    provider stream is closed at that point, which ends generation (and
+    billing) early.
+    """
+
+    def __init__(self, sequences: Sequence[str] = (), fence: bool = False, function: Optional[str] = None):
+        self.sequences = tuple(s for s in sequences if s)
+        self.fence = fence
+        self.function = function
+
+    @classmethod
+    def parse(cls, spec, function: Optional[str] = None) -> Optional["StopConditions"]:
+        """
+        Build stop conditions from a magic's `--stop` option.
+
+        `fence` and `function` select the structural stops (`function` needs the
+        function name), `none` disables stopping, anything else is a custom
+        stop string in which `\\n` stands for a newline.
+        """
+        if spec in (None, True, "", "none"):
+            return None
+        if spec == "fence":
+            return cls(fence=True)
+        if spec == "function":
+            return cls(fence=True, function=function) if function else cls(fence=True)
+        return cls(sequences=[spec.replace("\\n", "\n")])
+
+    def key(self) -> tuple:
+        return (self.sequences, self.fence, self.function)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, StopConditions) and self.key() == other.key()
+
+    def __hash__(self) -> int:
+        return hash(self.key())
+
+    def __repr__(self) -> str:
+        return f"StopConditions(sequences={list(self.sequences)}, fence={self.fence}, function={self.function!r})"
+
+    @property
+    def holdback(self) -> int:
+        """Characters that must be held back while streaming, as they may start a stop sequence."""
+        return max((len(s) - 1 for s in self.sequences), default=0)
+
+    def native(self, limit: Optional[int] = None) -> List[str]:
+        """Stop strings for a provider's native stop parameter."""
+        return list(self.sequences[:limit] if limit else self.sequences)
+
+    def cut(self, text: str) -> Optional[int]:
+        """Return the length text should be truncated to, or None if it is not complete yet."""
+        cuts = [text.find(s) for s in self.sequences]
+        cuts = [i for i in cuts if i >= 0]
+        if self.function:
+            end = _function_end(text, self.function)
+            if end is not None:
+                cuts.append(end)
+        if self.fence:
+            after = 0
+            if self.function:
+                header = _function_header(self.function).search(text)
+                after = header.start() if header else None
+            end = _fence_end(text, after) if after is not None else None
+            if end is not None:
+                cuts.append(end)
+        return min(cuts) if cuts else None
+
+
+def apply_stops(stream: Iterator[str], stops: Optional[StopConditions]) -> Iterator[str]:
+    """
+    Pass a text stream through until a stop condition matches, then close it.
+
+    Text is yielded as it arrives, except for a short tail that could still
+    turn out to be the start of a stop sequence or a line ending the response.
+    """
+    if stops is None:
+        yield from stream
+        return
+
+    text = ""
+    sent = 0
+    structural = stops.fence or stops.function
+    try:
+        for delta in stream:
+            text += delta
+            end = stops.cut(text)
+            if end is not None:
+                if end > sent:
+                    yield text[sent:end]
+                return
+            safe = len(text) - stops.holdback
+            if structural:
+                # A partial line may still turn out to end the response
+                safe = min(safe, text.rfind("\n") + 1)
+            if safe > sent:
+                yield text[sent:safe]
+                sent = safe
+        if len(text) > sent:
+            yield text[sent:]
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+
+
+class StopCriteria:
+    """
+    Stopping criterion for local `generate`: ends each sequence of a batch once
+    its generated text meets the stop conditions.
+
+    Duck-types transformers.StoppingCriteria, returning one flag per sequence.
+    """
+
+    def __init__(self, stops: StopConditions, tokenizer, prompt_length: int):
+        self.stops = stops
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+        done = [
+            self.stops.cut(self.tokenizer.decode(row[self.prompt_length:], skip_special_tokens=True)) is not None
+            for row in input_ids
+        ]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,239 @@
+"""
+A local stand-in for an OpenAI-compatible inference server.
+
+Serves POST /v1/chat/completions (streamed as server-sent events or as one
+JSON body) and GET /v1/models with a canned response, a configurable delay
+before the first token and a configurable token rate. Point the openai
+provider at it for load tests and offline CI runs:
+
+    python -m codemate_ai.stub_server --port 8000 --latency 0.3 --tokens-per-second 50
+
+    %set_base_url openai http://127.0.0.1:8000/v1
+    %set_llm_provider openai stub
+
+or from Python:
+
+    with StubServer(latency=0.05) as server:
+        config.api_keys["openai"]["base_url"] = server.url
+"""
+import re
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+DEFAULT_RESPONSE = (
+    "Here is an implementation:\n\n"
+    "```python\n"
+    "def reverse_string(text):\n"
+    "    \"\"\"Return text reversed.\"\"\"\n"
+    "    return text[::-1]\n"
+    "```\n\n"
+    "Slicing with a step of -1 walks the string from the end to the start."
+)
+
+
+def split_tokens(text: str) -> List[str]:
+    """Split text into word-sized pieces that concatenate back to text."""
+    return re.findall(r"\s*\S+|\s+", text)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/v1/models":
+            self._send_json(200, {"object": "list", "data": [{"id": self.server.stub.model, "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "Invalid JSON body"}})
+            return
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        with stub.lock:
+            stub.requests += 1
+            stub.last_request = request
+
+        tokens, finish_reason = stub.completion(request)
+        model = request.get("model") or stub.model
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        time.sleep(stub.latency)
+
+        if not request.get("stream"):
+            time.sleep(len(tokens) / stub.tokens_per_second if stub.tokens_per_second else 0)
+            self._send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": finish_reason}],
+                "usage": stub.usage(request, tokens),
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(delta, finish=None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+
+        interval = 1.0 / stub.tokens_per_second if stub.tokens_per_second else 0.0
+        try:
+            event({"role": "assistant"})
+            for token in tokens:
+                event({"content": token})
+                if interval:
+                    time.sleep(interval)
+            event({}, finish_reason)
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early (stop condition, cancelled hedge)
+            self.close_connection = True
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    stub: "StubServer"
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            # Clients may drop pooled keep-alive connections at any time
+            return
+        super().handle_error(request, client_address)
+
+
+class StubServer:
+    """
+    An OpenAI-compatible chat-completions server on a background thread.
+
+    Parameters:
+    - host (str), port (int): Address to listen on; port 0 picks a free port.
+    - latency (float): Seconds before the first token (time to first token).
+    - tokens_per_second (float): Streaming rate; 0 sends all tokens at once.
+    - response (str): Text every request is answered with.
+    - model (str): Model id reported when the request does not name one.
+
+    `max_tokens` and `stop` in the request are honored. `requests` counts
+    the completions served and `last_request` holds the latest request body.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 tokens_per_second: float = 0.0, response: str = DEFAULT_RESPONSE, model: str = "stub"):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.response = response
+        self.model = model
+        self.requests = 0
+        self.last_request = None
+        self.lock = threading.Lock()
+        self._httpd = _Server((host, port), _Handler)
+        self._httpd.stub = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Base URL to configure as the provider's base_url."""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def completion(self, request: dict):
+        """Return (tokens, finish_reason) for a request."""
+        text = self.response
+        finish_reason = "stop"
+        stops = request.get("stop") or []
+        for stop in [stops] if isinstance(stops, str) else stops:
+            index = text.find(stop)
+            if index >= 0:
+                text = text[:index]
+        tokens = split_tokens(text)
+        max_tokens = request.get("max_tokens")
+        if max_tokens is not None and len(tokens) > max_tokens:
+            tokens, finish_reason = tokens[:max_tokens], "length"
+        return tokens, finish_reason
+
+    @staticmethod
+    def usage(request: dict, tokens: List[str]) -> dict:
+        prompt = " ".join(str(message.get("content", "")) for message in request.get("messages", []))
+        prompt_tokens = len(split_tokens(prompt))
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                "total_tokens": prompt_tokens + len(tokens)}
+
+    def serve_forever(self):
+        """Serve on the calling thread until interrupted."""
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+    def start(self) -> "StubServer":
+        """Serve on a background thread."""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="codemate-stub-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "StubServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stub server for load tests and CI.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="streaming rate; 0 is unthrottled")
+    parser.add_argument("--response-file", default=None, help="file with the text to answer every request with")
+    args = parser.parse_args(argv)
+
+    response = DEFAULT_RESPONSE
+    if args.response_file:
+        with open(args.response_file, encoding="utf-8") as f:
+            response = f.read()
+    server = StubServer(args.host, args.port, args.latency, args.tokens_per_second, response)
+    print(f"Serving OpenAI-compatible chat completions at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
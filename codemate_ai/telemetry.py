@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import logging
+import functools
+import threading
+import contextvars
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Counters a span accumulates while its magic runs.
+COUNTERS = ("prompt_tokens", "completion_tokens", "bytes_sent", "bytes_received", "retries")
+
+
+def percentile(values: Iterable[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile (0-100) of values, or None when there are none."""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class Span:
+    """
+    Timings and counters of one magic invocation.
+
+    Stages are the pipeline stages marked by PipelineProgress (extract, parse,
+    prompt, provider, render); each lasts until the next one starts. Token
+    counts are estimates (see context.estimate_tokens) and bytes are the
+    HTTP request and streamed response bodies.
+    """
+
+    def __init__(self, magic: str):
+        self.magic = magic
+        self.timestamp = time.time()
+        self.provider = None
+        self.model = None
+        self.stages = {}
+        self.ttft = None
+        self.cache_hit = False
+        self.error = None
+        self.total = None
+        for name in COUNTERS:
+            setattr(self, name, 0)
+        self._started = time.perf_counter()
+        self._stage = None
+        self._stage_started = None
+
+    def mark(self, stage: str):
+        """Start a stage, ending the previous one."""
+        now = time.perf_counter()
+        self._end_stage(now)
+        self._stage, self._stage_started = stage, now
+
+    def _end_stage(self, now: float):
+        if self._stage is not None:
+            self.stages[self._stage] = self.stages.get(self._stage, 0.0) + now - self._stage_started
+            self._stage = None
+
+    def finish(self):
+        now = time.perf_counter()
+        self._end_stage(now)
+        self.total = now - self._started
+
+    def to_dict(self) -> Dict[str, Any]:
+        record = {
+            "magic": self.magic, "timestamp": self.timestamp, "provider": self.provider, "model": self.model,
+            "total": self.total, "stages": dict(self.stages), "ttft": self.ttft,
+            "cache_hit": self.cache_hit, "error": self.error,
+        }
+        record.update((name, getattr(self, name)) for name in COUNTERS)
+        return record
+
+
+class Recorder:
+    """
+    Keeps the spans of the last `capacity` magic invocations.
+
+    With `sink` set to a file path, every finished span is also appended to
+    it as one JSON line. The CODEMATE_TELEMETRY environment variable sets
+    the default sink.
+    """
+
+    def __init__(self, capacity: int = 1000, sink: Optional[str] = None):
+        self.spans = deque(maxlen=capacity)
+        self.sink = sink
+        self._lock = threading.Lock()
+
+    def record(self, span: Span):
+        record = span.to_dict()
+        with self._lock:
+            self.spans.append(record)
+            if self.sink:
+                try:
+                    with open(self.sink, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record) + "\n")
+                except OSError as e:
+                    logger.warning(f"Could not write telemetry to {self.sink}: {e}")
+
+    def records(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self.spans)
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+    def summary(self, by: str) -> Dict[Any, Dict[str, Any]]:
+        """
+        Aggregate the recorded spans grouped by a span field ("magic" or "provider").
+
+        Returns count, p50/p95 of total time and time-to-first-token, mean
+        token counts, cache hit rate, error count, retries and the p50 of
+        each stage per group.
+        """
+        groups = {}
+        for record in self.records():
+            groups.setdefault(record[by], []).append(record)
+        summary = {}
+        for key, records in groups.items():
+            totals = [r["total"] for r in records]
+            ttfts = [r["ttft"] for r in records if r["ttft"] is not None]
+            stages = {}
+            for record in records:
+                for stage, elapsed in record["stages"].items():
+                    stages.setdefault(stage, []).append(elapsed)
+            summary[key] = {
+                "count": len(records),
+                "p50": percentile(totals, 50),
+                "p95": percentile(totals, 95),
+                "ttft_p50": percentile(ttfts, 50),
+                "ttft_p95": percentile(ttfts, 95),
+                "prompt_tokens": sum(r["prompt_tokens"] for r in records) / len(records),
+                "completion_tokens": sum(r["completion_tokens"] for r in records) / len(records),
+                "cache_hit_rate": sum(1 for r in records if r["cache_hit"]) / len(records),
+                "errors": sum(1 for r in records if r["error"]),
+                "retries": sum(r["retries"] for r in records),
+                "stages": {stage: percentile(values, 50) for stage, values in stages.items()},
+            }
+        return summary
+
+
+recorder = Recorder(sink=os.environ.get("CODEMATE_TELEMETRY") or None)
+
+# The span of the magic running in this context. Worker threads that work for
+# a magic run in a copy of its context (contextvars.copy_context().run).
+_active_span = contextvars.ContextVar("codemate_active_span", default=None)
+_counter_lock = threading.Lock()
+
+
+def active() -> Optional[Span]:
+    """The span of the magic currently running in this context, if it has not finished yet."""
+    span = _active_span.get()
+    if span is None or span.total is not None:
+        # Work that outlives its magic (a cancelled hedge, a late stream) is not counted
+        return None
+    return span
+
+
+def mark(stage: str):
+    """Start a pipeline stage in the active span."""
+    span = active()
+    if span is not None:
+        span.mark(stage)
+
+
+def count(**amounts: int):
+    """Add to counters of the active span, e.g. count(bytes_received=512)."""
+    span = active()
+    if span is not None:
+        with _counter_lock:
+            for name, amount in amounts.items():
+                setattr(span, name, getattr(span, name) + amount)
+
+
+def annotate(**fields: Any):
+    """Set fields of the active span, e.g. annotate(provider="openai", cache_hit=True)."""
+    span = active()
+    if span is not None:
+        for name, value in fields.items():
+            setattr(span, name, value)
+
+
+def traced(func: Callable) -> Callable:
+    """Record a span for each call of a magic method. Nested magics are part of the outer span."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if active() is not None:
+            return func(*args, **kwargs)
+        span = Span(func.__name__)
+        token = _active_span.set(span)
+        try:
+            return func(*args, **kwargs)
+        except BaseException as e:
+            span.error = span.error or type(e).__name__
+            raise
+        finally:
+            _active_span.reset(token)
+            span.finish()
+            recorder.record(span)
+    return wrapper
@@ -45,7 +45,8 @@ setup(
         "pytorch-lightning",
         "jupyter_server",
         "astor",
-        "pygments"
+        "pygments",
+        "numpy"
     ],
     entry_points={
         "console_scripts": [
@@ -1,27 +1,44 @@
+import os
+import pytest
+from codemate_ai import providers
+from codemate_ai.providers import call_openai, call_anthropic, call_gemini
 
+# These tests call the live APIs and load real models, so they only run on request:
+# CODEMATE_LIVE_TESTS=1 OPENAI_API_KEY=... pytest tests/test_ML.py
+pytestmark = pytest.mark.skipif(not os.environ.get("CODEMATE_LIVE_TESTS"), reason="set CODEMATE_LIVE_TESTS=1")
+
+
+def _use_key(provider, variable):
+    key = os.environ.get(variable)
+    if not key:
+        pytest.skip(f"{variable} not set")
+    providers.config.api_keys[provider]["api_key"] = key
 
-import pytest
-from code_assist.providers import call_openai, call_anthropic, call_gemini
 
 def test_openai():
+    _use_key("openai", "OPENAI_API_KEY")
     prompt = "How do I reverse a string in Python?"
     response = call_openai(prompt)
     assert response is not None
     assert "reverse" in response.lower()
 
 def test_anthropic():
+    _use_key("anthropic", "ANTHROPIC_API_KEY")
     prompt = "How do I reverse a string in Python?"
     response = call_anthropic(prompt)
     assert response is not None
     assert "reverse" in response.lower()
 
 def test_gemini():
+    _use_key("gemini", "GEMINI_API_KEY")
     prompt = "How do I reverse a string in Python?"
     response = call_gemini(prompt)
     assert response is not None
     assert "reverse" in response.lower()
 
-# Test model loading (ensure models are available in the provided paths)
+# Test model loading (set CODEMATE_TEST_MODEL to a local model directory or Hub id)
 def test_model_loading():
-    model_path = "path_to_local_model"
-    assert load_model(model_path)
+    model_path = os.environ.get("CODEMATE_TEST_MODEL")
+    if not model_path:
+        pytest.skip("CODEMATE_TEST_MODEL not set")
+    assert providers.load_local_transformers_model(model_path)
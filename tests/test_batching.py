@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+from codemate_ai.batching import BatchScheduler, length_bucket
+
+
+def test_length_bucket_groups_lengths_within_a_factor_of_two():
+    assert length_bucket(100) == length_bucket(128)
+    assert length_bucket(128) != length_bucket(129)
+    assert length_bucket(3) == length_bucket(60)
+
+
+def test_concurrent_prompts_share_a_batch_and_get_their_own_results():
+    batches = []
+
+    def generate_batch(prompts, max_new_tokens):
+        batches.append(list(prompts))
+        return [f"{prompt}:{max_new_tokens}" for prompt in prompts]
+
+    scheduler = BatchScheduler(generate_batch, max_batch_size=4, max_wait=1.0, length=len)
+    futures = [scheduler.submit(f"p{i}", max_new_tokens=5) for i in range(6)]
+
+    assert [future.result(timeout=5) for future in futures] == [f"p{i}:5" for i in range(6)]
+    assert [len(batch) for batch in batches] == [4, 2]
+    scheduler.close()
+
+
+def test_different_lengths_and_parameters_are_not_mixed():
+    batches = []
+    release = threading.Event()
+
+    def generate_batch(prompts, max_new_tokens):
+        release.wait(5)
+        batches.append(sorted(prompts))
+        return prompts
+
+    scheduler = BatchScheduler(generate_batch, max_batch_size=8, max_wait=0.05, length=len)
+    futures = [
+        scheduler.submit("a" * 3, max_new_tokens=1),
+        scheduler.submit("b" * 300, max_new_tokens=1),
+        scheduler.submit("c" * 3, max_new_tokens=2),
+        scheduler.submit("d" * 3, max_new_tokens=1),
+    ]
+    release.set()
+    for future in futures:
+        future.result(timeout=5)
+    assert sorted(batches) == [["a" * 3, "d" * 3], ["b" * 300], ["c" * 3]]
+    scheduler.close()
+
+
+def test_batch_errors_reach_every_caller():
+    def generate_batch(prompts):
+        raise RuntimeError("out of memory")
+
+    scheduler = BatchScheduler(generate_batch, max_batch_size=2, max_wait=0.5)
+    futures = [scheduler.submit("x"), scheduler.submit("y")]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="out of memory"):
+            future.result(timeout=5)
+    scheduler.close()
@@ -0,0 +1,39 @@
+import os
+import importlib.util
+
+_spec = importlib.util.spec_from_file_location(
+    "benchmark_suite", os.path.join(os.path.dirname(__file__), "..", "benchmarks", "run.py")
+)
+suite = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(suite)
+
+
+def test_compare_flags_only_slowdowns_beyond_tolerance():
+    baseline = {"a": 1.0, "b": 1.0, "c": 1.0}
+    results = {"a": 1.2, "b": 1.6, "c": 0.5, "new": 9.0}
+    assert suite.compare(results, baseline, tolerance=0.5) == ["b"]
+
+
+def test_baselines_are_the_median_of_several_runs():
+    runs = [{"a": 0.3, "b": 2.0}, {"a": 0.1, "b": 1.0}, {"a": 0.2, "b": 9.0}]
+    assert suite.median_results(runs) == {"a": 0.2, "b": 2.0}
+
+
+def test_suite_runs_offline_on_a_small_notebook(tmp_path):
+    results = suite.run_suite([(3, 2)], repeat=1)
+    names = {name.split("[")[0] for name in results}
+    assert names == {"analyze_code", "create_parent_map", "extract_code_from_notebook",
+                     "display_highlighted_code", "render_response", "render_unfenced",
+                     "split_code_and_explanation", "build_prompt"}
+    assert all(seconds > 0 for seconds in results.values())
+
+
+def test_baseline_covers_the_full_suite():
+    import json
+    with open(suite.BASELINE) as f:
+        baseline = json.load(f)
+    expected = {f"{name}[cells={cells},depth={depth}]" for cells, depth in suite.SIZES
+                for name in ("analyze_code", "create_parent_map", "extract_code_from_notebook",
+                             "display_highlighted_code", "render_response", "render_unfenced",
+                             "split_code_and_explanation", "build_prompt")}
+    assert expected <= set(baseline)
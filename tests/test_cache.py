@@ -0,0 +1,41 @@
+from codemate_ai.cache import ResponseCache
+
+
+def _key(prompt, persona="normal"):
+    return ResponseCache.make_key("openai", "gpt-4", {"temperature": 0.7}, persona, prompt)
+
+
+def test_memory_and_disk_tiers(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    cache = ResponseCache(path=path)
+    assert cache.get(_key("a")) is None
+    cache.put(_key("a"), "answer")
+    assert cache.get(_key("a")) == "answer"
+    cache.close()
+
+    reopened = ResponseCache(path=path)
+    assert reopened.get(_key("a")) == "answer"
+    assert reopened.get(_key("a")) == "answer"
+    assert reopened.stats()["disk_hits"] == 1
+    assert reopened.stats()["memory_hits"] == 1
+
+
+def test_key_depends_on_persona_and_prompt():
+    assert _key("a") != _key("b")
+    assert _key("a", "expert") != _key("a", "concise")
+
+
+def test_ttl_expiry(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "r.sqlite"), ttl=-1)
+    cache.put(_key("a"), "answer")
+    assert cache.get(_key("a")) is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_size_eviction_drops_least_recently_used(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "r.sqlite"), max_memory_entries=1, max_disk_bytes=10)
+    cache.put(_key("a"), "x" * 6)
+    cache.put(_key("b"), "y" * 6)
+    assert cache.stats()["disk_entries"] == 1
+    assert cache.get(_key("b")) == "y" * 6
+    assert cache.get(_key("a")) is None
@@ -0,0 +1,33 @@
+from codemate_ai.clients import ClientPool
+
+
+class _Client:
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_client_reused_until_key_changes():
+    pool = ClientPool()
+    first = pool.get("openai", ("key-1",), lambda: _Client("a"))
+    assert pool.get("openai", ("key-1",), lambda: _Client("b")) is first
+
+    second = pool.get("openai", ("key-2",), lambda: _Client("c"))
+    assert second.name == "c"
+    assert first.closed
+
+
+def test_reset_closes_clients():
+    pool = ClientPool()
+    openai = pool.get("openai", 1, lambda: _Client("a"))
+    gemini = pool.get("gemini", 1, lambda: _Client("b"))
+
+    pool.reset("openai")
+    assert openai.closed and not gemini.closed
+    assert pool.get("openai", 1, lambda: _Client("c")).name == "c"
+
+    pool.reset()
+    assert gemini.closed
@@ -0,0 +1,54 @@
+from codemate_ai.context import build_context, estimate_tokens, referenced_names, traceback_names
+
+
+def _tree(count):
+    functions = {
+        f"func_{i}": {"params": ["x"], "docstring": "d" * 200, "variables": {"x": ["read"]}}
+        for i in range(count)
+    }
+    return {"functions": functions, "classes": {"Loader": {"docstring": None, "methods": {"load": {
+        "params": ["self", "path"], "docstring": None, "variables": {"path": ["read"]}}}}}}
+
+
+def test_everything_fits_in_a_large_budget():
+    tree = _tree(3)
+    text, report = build_context(tree, budget=100000)
+    assert text == str(tree)
+    assert not report.dropped
+
+
+def test_budget_keeps_the_most_relevant_entries():
+    tree = _tree(50)
+    text, report = build_context(tree, budget=200, cell="result = func_42(3)\nLoader().load(p)", target="func_7")
+    assert report.kept == ["func_7", "Loader", "func_42"]
+    assert report.dropped
+    assert report.tokens <= 200 + estimate_tokens("{'functions': {}, 'classes': {}}")
+    assert "dropped" in report.summary()
+
+
+def test_traceback_frames_rank_innermost_first():
+    error = (
+        'Traceback (most recent call last):\n'
+        '  File "<cell>", line 3, in func_1\n'
+        '  File "<cell>", line 9, in func_2\n'
+        'ZeroDivisionError: division by zero'
+    )
+    assert traceback_names(error) == ["func_1", "func_2"]
+    _, report = build_context(_tree(10), budget=150, error=error)
+    assert report.kept[:2] == ["func_2", "func_1"]
+
+
+def test_referenced_names_survives_syntax_errors():
+    assert {"foo", "bar"} <= referenced_names("foo(bar")
+    assert referenced_names("obj.method(arg)") == {"obj", "method", "arg"}
+
+
+def test_snippets_fill_the_remaining_budget():
+    snippets = [
+        {"name": "helper", "source": "def helper():\n    return 42"},
+        {"name": "cell_itself", "source": "x = helper()"},
+        {"name": "huge", "source": "y = 1\n" * 1000},
+    ]
+    text, report = build_context(_tree(1), budget=200, cell="x = helper()", snippets=snippets)
+    assert report.snippets == ["helper"]
+    assert "def helper():" in text
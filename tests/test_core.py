@@ -0,0 +1,201 @@
+import pytest
+from codemate_ai import core
+from codemate_ai.cache import CellCache
+from codemate_ai.retrieval import CodeIndex
+
+CELLS = [
+    "import math\n",
+    "def area(r):\n    \"\"\"Circle area.\"\"\"\n    return math.pi * r ** 2\n",
+    "class Shape:\n    def scale(self, k):\n        for i in range(k):\n            if i > 2:\n                self.size = self.size * k\n",
+    "def area(r, unit):\n    return r * r\n",
+]
+
+
+@pytest.fixture
+def cell_cache(tmp_path, monkeypatch):
+    cache = CellCache(path=str(tmp_path / "cells.json"), version=core.ANALYZER_VERSION)
+    monkeypatch.setattr(core, "cell_cache", cache)
+    monkeypatch.setattr(core, "code_index", CodeIndex(path=str(tmp_path / "index.json")))
+    return cache
+
+
+def _normalized(tree):
+    """Sort usage lists so trees can be compared independently of set ordering."""
+    def norm_vars(variables):
+        return {name: sorted(labels) for name, labels in variables.items()}
+
+    functions = {name: dict(info, variables=norm_vars(info["variables"]))
+                 for name, info in tree["functions"].items()}
+    classes = {}
+    for name, info in tree["classes"].items():
+        methods = {m: dict(mi, variables=norm_vars(mi["variables"])) for m, mi in info["methods"].items()}
+        classes[name] = dict(info, methods=methods)
+    return {"functions": functions, "classes": classes, "no_definitions": tree.get("no_definitions")}
+
+
+def test_analyze_cells_matches_analyze_code(cell_cache):
+    expected = _normalized(core.analyze_code("\n\n".join(CELLS)))
+    assert _normalized(core.analyze_cells(CELLS)) == expected
+    assert core.context_tree["functions"]["area"]["params"] == ["r", "unit"]
+
+
+def test_analyze_cells_reuses_cached_fragments(cell_cache, monkeypatch):
+    core.analyze_cells(CELLS)
+
+    parsed = []
+    original_parse = core.ast.parse
+    monkeypatch.setattr(core.ast, "parse", lambda code: parsed.append(code) or original_parse(code))
+
+    core.analyze_cells(CELLS + ["def extra():\n    pass\n"])
+    assert parsed == ["def extra():\n    pass\n"]
+
+
+def test_cell_cache_survives_reload(cell_cache):
+    core.analyze_cells(CELLS)
+
+    reloaded = CellCache(path=cell_cache.path, version=core.ANALYZER_VERSION)
+    assert reloaded.get(CELLS[1])["functions"]["area"]["docstring"] == "Circle area."
+    assert CellCache(path=cell_cache.path, version=core.ANALYZER_VERSION + 1).get(CELLS[1]) is None
+
+
+def test_parse_failures_are_reported_once(cell_cache, capsys):
+    cells = CELLS + ["def broken(:\n"]
+    core.analyze_cells(cells)
+    assert capsys.readouterr().out.count("Error parsing code") == 1
+
+    core.analyze_cells(cells)
+    assert "Error parsing code" not in capsys.readouterr().out
+    assert "broken" not in core.context_tree["functions"]
+
+
+def test_analyze_cells_without_definitions(cell_cache):
+    tree = core.analyze_cells(["x = 1\n", "print(x)\n"])
+    assert "no_definitions" in tree
+
+
+def _legacy_variable_usage(node):
+    """Reference implementation: parent map plus a full ancestor walk per name."""
+    parents = core.create_parent_map(node)
+    usage = {}
+    for child in core.ast.walk(node):
+        if isinstance(child, core.ast.Name):
+            labels = usage.setdefault(child.id, set())
+            labels.add(core.CONTEXT_LABELS[type(child.ctx)])
+            current = child
+            while current in parents:
+                current = parents[current]
+                label = core.USAGE_LABELS.get(type(current))
+                if label:
+                    labels.add(label)
+    return {name: sorted(labels) for name, labels in usage.items()}
+
+
+def test_variable_usage_matches_parent_map_walk():
+    source = """
+def process(items, limit):
+    total = 0
+    for item in items:
+        if item > limit:
+            total += item * 2 if item % 2 else item
+        while total > 100:
+            total = total - items[0]
+    del limit
+    return helper(total)
+"""
+    node = core.ast.parse(source).body[0]
+    assert core.variable_usage(node) == _legacy_variable_usage(node)
+
+
+class _FakeHistory:
+    def __init__(self, sources):
+        self.input_hist_raw = [""] + sources
+
+
+class _FakeShell:
+    def __init__(self, sources):
+        self.history_manager = _FakeHistory(sources)
+
+
+def test_extract_cells_from_kernel_dedupes_and_strips_magics():
+    shell = _FakeShell([
+        "%load_ext codemate_ai",
+        "def f():\n    return 1",
+        "!pip install numpy\nx = 2",
+        "def f():\n    return 1",
+        "%generate_code g",
+    ])
+    assert core.extract_cells_from_kernel(shell) == ["x = 2", "def f():\n    return 1"]
+
+
+def test_get_source_cells_prefers_kernel_history(monkeypatch):
+    monkeypatch.setattr(core, "extract_cells_from_kernel", lambda: ["y = 1"])
+    monkeypatch.setattr(core, "get_notebook_path", lambda: pytest.fail("notebook lookup not expected"))
+    assert core.get_source_cells() == ["y = 1"]
+
+
+def test_get_notebook_path_probes_servers_concurrently_and_caches(tmp_path, monkeypatch):
+    import threading
+    import time
+
+    notebook = tmp_path / "demo.ipynb"
+    notebook.write_text("{}")
+    hung = threading.Event()
+
+    class _Shell:
+        config = {"IPKernelApp": {"connection_file": "/run/kernel-abc123.json"}}
+
+    def fake_find(server, kernel_id, timeout):
+        if server["url"] == "hung":
+            hung.wait(5)
+            return None
+        return str(notebook)
+
+    probes = []
+    monkeypatch.setattr(core, "get_ipython", lambda: _Shell())
+    monkeypatch.setattr(core, "list_running_servers", lambda: probes.append(1) or [{"url": "hung"}, {"url": "ok"}])
+    monkeypatch.setattr(core, "_find_session_path", fake_find)
+    core.clear_notebook_path_cache()
+
+    start = time.perf_counter()
+    assert core.get_notebook_path(timeout=1.0) == str(notebook)
+    assert time.perf_counter() - start < 1.0
+    assert core.get_notebook_path() == str(notebook)
+    assert len(probes) == 1
+
+    notebook.unlink()
+    core.get_notebook_path(timeout=0.1)
+    assert len(probes) == 2
+    hung.set()
+
+
+def test_analyze_cells_indexes_chunks_for_retrieval(cell_cache):
+    core.analyze_cells(CELLS)
+    names = [hit["name"] for hit in core.search_code("scale the shape size", k=2)]
+    assert names[0] == "Shape.scale"
+
+    core.analyze_cells(CELLS[:2])
+    assert "Shape.scale" not in [hit["name"] for hit in core.search_code("scale shape", k=5)]
+
+
+def test_renderer_reuses_formatters_and_lexers():
+    assert core._formatter("rrt") is core._formatter("rrt")
+    assert core._formatter("rrt") is not core._formatter("rrt", wrapcode=True)
+    assert core._lexer("json") is core._lexer("json")
+    assert core._lexer("no-such-language").name == "Python"
+
+
+def test_detect_lexer_prefers_markdown_for_fenced_blocks_and_samples_the_rest(monkeypatch):
+    response = "Here is the fix:\n\n```python\ndef f():\n    return 1\n```\n\nIt returns one."
+    assert core._detect_lexer(response).name == "Markdown"
+
+    seen = []
+    monkeypatch.setattr(core, "guess_lexer", lambda text: seen.append(text) or core.PythonLexer())
+    core._detect_lexer("SELECT id FROM users;\n" * 1000)
+    assert len(seen[0]) <= core.DETECTION_SAMPLE_CHARS
+    assert seen[0].endswith("SELECT id FROM users;")
+
+    seen.clear()
+    code = "".join(f"def f{i}(x):\n    for y in x:\n        print(y)\n" for i in range(500))
+    assert core._detect_lexer(code).name == "Python"
+    core._detect_lexer("Sorry, I cannot help with that.")
+    assert seen == ["Sorry, I cannot help with that."]
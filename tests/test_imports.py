@@ -0,0 +1,14 @@
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ("torch", "transformers", "huggingface_hub", "google.generativeai",
+                 "jupyter_server", "nbformat", "numpy")
+
+
+def test_loading_the_extension_does_not_import_heavy_backends():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    probe = f"import sys, codemate_ai; print([m for m in {HEAVY_MODULES!r} if m in sys.modules])"
+    result = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True,
+                            cwd=root, check=True)
+    assert result.stdout.strip() == "[]"
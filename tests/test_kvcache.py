@@ -0,0 +1,49 @@
+from codemate_ai.kvcache import PrefixKVCache, common_prefix_length
+
+
+class _Cache:
+    def __init__(self, length):
+        self.length = length
+
+    def get_seq_length(self):
+        return self.length
+
+    def crop(self, max_length):
+        assert max_length < 0
+        self.length += max_length
+
+
+def test_common_prefix_length():
+    assert common_prefix_length([1, 2, 3], [1, 2, 4]) == 2
+    assert common_prefix_length([1, 2], [1, 2, 3]) == 2
+
+
+def test_lookup_returns_a_cropped_copy_of_the_longest_prefix():
+    cache = PrefixKVCache(min_prefix=2)
+    cache.store("model", [1, 2, 3, 4, 5], _Cache(8))
+    cache.store("model", [1, 2, 9, 9], _Cache(4))
+
+    found, length = cache.lookup("model", [1, 2, 3, 4, 7, 7])
+    assert (length, found.get_seq_length()) == (4, 4)
+    # The stored entry is untouched and can be reused again
+    again, length = cache.lookup("model", [1, 2, 3, 4, 5, 6])
+    assert (length, again.get_seq_length()) == (5, 5)
+    assert cache.hits == 2
+
+
+def test_lookup_leaves_one_token_to_prefill_and_skips_short_prefixes():
+    cache = PrefixKVCache(min_prefix=3)
+    cache.store("model", [1, 2, 3, 4], _Cache(4))
+
+    found, length = cache.lookup("model", [1, 2, 3, 4])
+    assert (length, found.get_seq_length()) == (3, 3)
+    assert cache.lookup("model", [1, 2, 8, 8]) == (None, 0)
+
+
+def test_entries_are_dropped_when_the_model_changes_or_overflow():
+    cache = PrefixKVCache(max_entries=2, min_prefix=1)
+    for i in range(3):
+        cache.store("a", [i, i, i], _Cache(3))
+    assert len(cache) == 2
+    assert cache.lookup("b", [1, 1, 1, 1]) == (None, 0)
+    assert len(cache) == 0
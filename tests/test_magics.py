@@ -0,0 +1,74 @@
+from codemate_ai.magics import CodeAssistMagics
+
+
+def test_parse_options_converts_timeout_and_rejects_invalid_values(capsys):
+    assert CodeAssistMagics._parse_options("area --timeout=1 --no-cache") == ("area", {"timeout": 1.0, "no-cache": True})
+    assert CodeAssistMagics._parse_options("area --timeout=soon") == ("area", None)
+    assert "Invalid --timeout value: soon" in capsys.readouterr().out
+
+
+def test_interrupted_stream_keeps_partial_output(monkeypatch, capsys):
+    from codemate_ai import providers
+
+    def interrupted(prompt, **kwargs):
+        yield "def f():\n"
+        yield "    return 1\n"
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(providers, "stream_cached", interrupted)
+    monkeypatch.setattr(providers.config, "stream", False)
+
+    magics = CodeAssistMagics.__new__(CodeAssistMagics)
+    assert magics._stream_response("prompt") == "def f():\n    return 1"
+    assert "interrupted" in capsys.readouterr().out
+
+
+def test_set_progress_toggles_the_pipeline_display(monkeypatch):
+    from codemate_ai import providers
+
+    monkeypatch.setattr(providers.config, "show_progress", True)
+    magics = CodeAssistMagics.__new__(CodeAssistMagics)
+
+    assert magics.set_progress("off") == "Progress display turned off"
+    assert providers.config.show_progress is False
+    assert not magics._progress().enabled
+    assert magics.set_progress("sometimes").startswith("Usage")
+    assert magics.set_progress("on") == "Progress display turned on"
+    assert providers.config.show_progress is True
+
+
+def test_generate_code_reports_stages_in_pipeline_order(monkeypatch, tmp_path):
+    from codemate_ai import core, magics as magics_module, providers
+    from codemate_ai.cache import CellCache
+    from codemate_ai.progress import PipelineProgress, STAGES
+    from codemate_ai.retrieval import CodeIndex
+
+    monkeypatch.setattr(core, "cell_cache", CellCache(path=str(tmp_path / "cells.json"), version=core.ANALYZER_VERSION))
+    monkeypatch.setattr(core, "code_index", CodeIndex(path=str(tmp_path / "index.json")))
+    monkeypatch.setattr(core, "get_source_cells", lambda path=None: ["def area(r):\n    return r * r\n"])
+    monkeypatch.setattr(providers, "stream_cached", lambda prompt, **kwargs: iter(["```python\ndef f():\n    pass\n```\n"]))
+    monkeypatch.setattr(providers.config, "provider", providers.LLMProvider.OPENAI)
+    monkeypatch.setattr(providers.config, "stream", False)
+    monkeypatch.setattr(magics_module, "display_highlighted_code", lambda code: None)
+
+    stages = []
+    original = PipelineProgress.stage
+    monkeypatch.setattr(PipelineProgress, "stage", lambda self, name, detail="": stages.append(name) or original(self, name, detail))
+
+    CodeAssistMagics.__new__(CodeAssistMagics).generate_code("f")
+    assert stages == list(STAGES)
+
+
+def test_switching_provider_keeps_pooled_clients(monkeypatch):
+    from codemate_ai import providers
+    from codemate_ai.clients import ClientPool
+
+    pool = ClientPool()
+    monkeypatch.setattr("codemate_ai.magics.clients", pool)
+    monkeypatch.setattr(providers.config, "provider", None)
+    session = pool.get("openai", ("key",), object)
+
+    magics = CodeAssistMagics.__new__(CodeAssistMagics)
+    magics.set_llm_provider("anthropic")
+    magics.set_llm_provider("openai")
+    assert pool.get("openai", ("key",), object) is session
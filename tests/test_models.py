@@ -0,0 +1,197 @@
+import pytest
+
+from codemate_ai.models import ModelRegistry, model_memory
+
+MB = 2 ** 20
+
+
+class _Tensor:
+    def __init__(self, size, device="cpu"):
+        self.size = size
+        self.device = device
+
+    def numel(self):
+        return self.size
+
+    def element_size(self):
+        return 1
+
+
+class _Model:
+    def __init__(self, size, device="cpu"):
+        self.weight = _Tensor(size, device)
+        self.buffer = _Tensor(size // 4, device)
+
+    def parameters(self):
+        # Tied weights appear twice but are counted once
+        return [self.weight, self.weight]
+
+    def buffers(self):
+        return [self.buffer]
+
+
+def test_model_memory_counts_parameters_and_buffers_once():
+    assert model_memory(_Model(100 * MB)) == {"cpu": 125 * MB}
+
+
+def test_registry_reuses_loaded_models():
+    registry = ModelRegistry(budgets={"cpu": None})
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return _Model(MB), "tokenizer"
+
+    first = registry.load(("m", "float16", "cpu"), loader)
+    assert registry.load(("m", "float16", "cpu"), loader) == first
+    assert len(loads) == 1
+
+
+def test_registry_evicts_least_recently_used_models_over_budget():
+    registry = ModelRegistry(budgets={"cpu": 300 * MB})
+    registry.load("a", lambda: (_Model(100 * MB), None))
+    registry.load("b", lambda: (_Model(100 * MB), None))
+    registry.get("a")
+    registry.load("c", lambda: (_Model(100 * MB), None))
+
+    assert "b" not in registry
+    assert [entry.key for entry in registry.entries()] == ["a", "c"]
+    assert registry.usage() == {"cpu": 250 * MB}
+
+
+def test_registry_makes_room_before_loading_and_budgets_devices_separately():
+    registry = ModelRegistry(budgets={"cpu": 200 * MB, "cuda": 200 * MB})
+    registry.load("cpu", lambda: (_Model(100 * MB), None))
+    registry.load("gpu", lambda: (_Model(100 * MB, "cuda"), None))
+
+    evicted_before_load = []
+    registry.load("big", lambda: (evicted_before_load.append("gpu" not in registry) or _Model(120 * MB, "cuda"), None),
+                  expected={"cuda": 120 * MB})
+    assert evicted_before_load == [True]
+    assert "cpu" in registry
+
+    registry.clear()
+    assert len(registry) == 0
+
+
+def test_select_dtype_prefers_bf16_only_on_capable_cpus(monkeypatch):
+    from codemate_ai import models
+
+    monkeypatch.setattr(models, "cpu_supports_bf16", lambda: True)
+    assert models.select_dtype("cpu") == "bfloat16"
+    monkeypatch.setattr(models, "cpu_supports_bf16", lambda: False)
+    assert models.select_dtype("cpu") == "float32"
+    assert models.select_dtype("cuda:0") == "float16"
+
+
+def test_quantize_int8_shrinks_linear_layers():
+    torch = pytest.importorskip("torch")
+    from codemate_ai.models import quantize_int8
+
+    model = torch.nn.Sequential(torch.nn.Linear(256, 256), torch.nn.ReLU(), torch.nn.Linear(256, 8))
+    x = torch.randn(2, 256)
+    expected = model(x)
+    before = model_memory(model)["cpu"]
+
+    quantized = quantize_int8(model)
+    assert model_memory(quantized)["cpu"] < before / 3
+    assert torch.allclose(quantized(x), expected, atol=0.1)
+
+
+def test_cpu_8bit_loading_falls_back_to_dynamic_int8(monkeypatch):
+    from codemate_ai import providers
+
+    keys = []
+    monkeypatch.setattr(providers, "resolve_device", lambda device: "cpu")
+    monkeypatch.setattr(providers.model_registry, "load", lambda key, loader, expected: keys.append(key) or (None, None))
+    monkeypatch.setattr(providers.config, "local_model", None)
+    monkeypatch.setattr(providers.config, "local_tokenizer", None)
+
+    assert providers.load_local_transformers_model("model", load_in_8bit=True)
+    assert keys == [("model", "float32", "cpu", "int8")]
+
+
+
+def test_registry_reports_unloads():
+    registry = ModelRegistry(budgets={"cpu": 80 * MB})
+    unloaded = []
+    registry.on_unload.append(unloaded.append)
+    registry.load("a", lambda: (_Model(40 * MB), None))
+    registry.load("b", lambda: (_Model(40 * MB), None))
+    assert unloaded == ["a"]
+    registry.clear()
+    assert unloaded == ["a", "b"]
+
+
+def test_unloading_the_active_model_drops_its_prefix_cache(monkeypatch):
+    from codemate_ai import providers
+
+    registry = ModelRegistry(budgets={"cpu": 80 * MB})
+    registry.on_unload += [providers.prefix_cache.discard, providers._on_model_unloaded]
+    monkeypatch.setattr(providers, "model_registry", registry)
+    monkeypatch.setattr(providers, "_load_registered_model", lambda path, *args: (path,) + registry.load(
+        path, lambda: (_Model(40 * MB), "tokenizer")))
+    for name in ("local_model", "local_tokenizer", "local_model_key"):
+        monkeypatch.setattr(providers.config, name, None)
+
+    assert providers.load_local_transformers_model("main")
+    providers.prefix_cache.store("main", list(range(64)), type("C", (), {"get_seq_length": lambda self: 64})())
+    assert len(providers.prefix_cache) == 1
+    # A later model at the same address must not see the unloaded model's KV caches
+    registry.unload("main")
+    assert len(providers.prefix_cache) == 0
+    assert providers.config.local_model is None and providers.config.local_model_key is None
+
+
+def test_registry_keeps_pinned_models_and_reports_unloads():
+    registry = ModelRegistry(budgets={"cpu": 160 * MB})
+    unloaded = []
+    registry.on_unload.append(unloaded.append)
+    for key in ("main", "draft", "old"):
+        registry.load(key, lambda: (_Model(40 * MB), None))
+    registry.pin("main", "draft")
+    registry.load("new", lambda: (_Model(40 * MB), None))
+
+    assert [entry.key for entry in registry.entries()] == ["main", "draft", "new"]
+    assert unloaded == ["old"]
+    registry.clear()
+    assert sorted(unloaded) == ["draft", "main", "new", "old"]
+
+
+def test_active_model_and_draft_are_pinned_and_switching_models_drops_the_draft(monkeypatch):
+    from codemate_ai import providers
+
+    registry = ModelRegistry(budgets={"cpu": 200 * MB})
+    registry.on_unload += [providers.prefix_cache.discard, providers._on_model_unloaded]
+    monkeypatch.setattr(providers, "model_registry", registry)
+    for name in ("local_model", "local_tokenizer", "local_model_key", "draft_model", "draft_tokenizer",
+                 "draft_model_key"):
+        monkeypatch.setattr(providers.config, name, None)
+
+    class _Tokenizer:
+        def __init__(self, vocab):
+            self.vocab = vocab
+
+        def get_vocab(self):
+            return self.vocab
+
+    def load(path, device, load_in_8bit, dtype, quantize):
+        size = 40 * MB if "draft" in path else 80 * MB
+        return (path,) + registry.load(path, lambda: (_Model(size), _Tokenizer({"a": 0})))
+
+    monkeypatch.setattr(providers, "_load_registered_model", load)
+
+    assert providers.load_local_transformers_model("main")
+    assert providers.load_draft_model("draft")
+    assert providers.config.draft_tokenizer is None
+    # A third model cannot evict the active pair
+    registry.load("other", lambda: (_Model(80 * MB), None))
+    assert "main" in registry and "draft" in registry
+
+    providers.prefix_cache.store("main", list(range(64)), type("C", (), {"get_seq_length": lambda self: 64})())
+    assert len(providers.prefix_cache) == 1
+    # Switching models drops the draft; the old model may then be evicted with its KV caches
+    assert providers.load_local_transformers_model("second")
+    assert providers.config.draft_model is None
+    assert "main" not in registry
+    assert len(providers.prefix_cache) == 0
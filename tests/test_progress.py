@@ -0,0 +1,70 @@
+import pytest
+from codemate_ai import progress
+from codemate_ai.progress import PipelineProgress, StreamingDisplay, STAGES
+
+
+class _Handle:
+    def __init__(self, shown):
+        self.shown = shown
+
+    def update(self, obj):
+        self.shown.append(obj)
+
+
+@pytest.fixture
+def shown(monkeypatch):
+    """Collect everything displayed or updated in place, as if running in Jupyter."""
+    shown = []
+
+    def display(obj, display_id=False):
+        shown.append(obj)
+        return _Handle(shown)
+
+    monkeypatch.setattr(progress, "display", display)
+    monkeypatch.setattr(progress, "live_display_supported", lambda: True)
+    monkeypatch.delenv("CODEMATE_PROGRESS", raising=False)
+    return shown
+
+
+def test_stages_update_one_line_in_pipeline_order(shown):
+    with PipelineProgress() as bar:
+        for name in STAGES:
+            bar.stage(name)
+        assert bar.current == "render"
+
+    steps = [html.data.split("]")[0].split("[")[-1] for html in shown[:-1]]
+    assert steps == [f"{i}/{len(STAGES)}" for i in range(1, len(STAGES) + 1)]
+    assert "Waiting for the model" in shown[3].data
+    # Leaving the block clears the progress line
+    assert shown[-1].data == ""
+
+
+def test_progress_can_be_disabled(shown, monkeypatch):
+    with PipelineProgress(enabled=False) as bar:
+        bar.stage("extract")
+        assert bar.current == "extract"
+
+    monkeypatch.setenv("CODEMATE_PROGRESS", "0")
+    assert not progress.progress_supported()
+    with PipelineProgress() as bar:
+        bar.stage("extract")
+    assert shown == []
+
+
+def test_progress_is_off_outside_jupyter(monkeypatch):
+    monkeypatch.setattr(progress, "get_ipython", lambda: None)
+    monkeypatch.delenv("CODEMATE_PROGRESS", raising=False)
+    assert not progress.progress_supported()
+    assert not PipelineProgress().enabled
+
+
+def test_streaming_display_throttles_updates(shown):
+    live = StreamingDisplay(interval=60)
+    live.update(["a"])
+    live.update(["a", "b"])
+    live.update(["a", "b", "c"], force=True)
+    live.close()
+
+    assert [getattr(obj, "data", None) for obj in shown] == ["a", "abc", ""]
+    StreamingDisplay(enabled=False).update(["x"], force=True)
+    assert len(shown) == 3
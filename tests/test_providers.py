@@ -0,0 +1,525 @@
+import json
+import time
+import asyncio
+import threading
+import pytest
+import requests
+from codemate_ai import providers
+
+
+class _FakeResponse:
+    def __init__(self, lines, status_code=200, headers=None):
+        self.lines = lines
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.encoding = None
+        self.closed = False
+
+    def iter_lines(self, decode_unicode=False):
+        yield from self.lines
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"HTTP {self.status_code}", response=self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class _FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def post(self, url, json=None, stream=False, **kwargs):
+        self.requests.append({"url": url, "json": json, "stream": stream, "timeout": kwargs.get("timeout")})
+        return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+
+def _sse(*payloads):
+    lines = []
+    for payload in payloads:
+        lines.append("data: " + (payload if isinstance(payload, str) else json.dumps(payload)))
+        lines.append("")
+    return lines
+
+
+@pytest.fixture
+def api_keys(monkeypatch):
+    keys = {name: dict(entry, api_key="test-key") for name, entry in providers.config.api_keys.items()}
+    monkeypatch.setattr(providers.config, "api_keys", keys)
+    return keys
+
+
+def test_iter_sse_joins_multiline_events_and_skips_comments():
+    response = _FakeResponse([": keep-alive", "data: first", "data: second", "", "data:third", ""])
+    assert list(providers._iter_sse(response)) == ["first\nsecond", "third"]
+
+
+def test_stream_openai_yields_deltas(api_keys, monkeypatch):
+    response = _FakeResponse(_sse(
+        {"choices": [{"delta": {"role": "assistant"}}]},
+        {"choices": [{"delta": {"content": "def "}}]},
+        {"choices": [{"delta": {"content": "f(): pass"}}]},
+        "[DONE]",
+    ))
+    session = _FakeSession(response)
+    monkeypatch.setattr(providers, "_http_session", lambda name, headers: session)
+
+    assert list(providers.stream_openai("prompt")) == ["def ", "f(): pass"]
+    assert session.requests[0]["json"]["stream"] is True
+    assert response.closed
+
+
+def test_stream_anthropic_yields_text_deltas(api_keys, monkeypatch):
+    response = _FakeResponse(_sse(
+        {"type": "message_start"},
+        {"type": "content_block_delta", "delta": {"type": "text_delta", "text": "Hello"}},
+        {"type": "content_block_delta", "delta": {"type": "text_delta", "text": " world"}},
+        {"type": "message_stop"},
+    ))
+    monkeypatch.setattr(providers, "_http_session", lambda name, headers: _FakeSession(response))
+    assert providers.call_anthropic("prompt") == "Hello world"
+
+
+def test_stop_conditions_are_sent_natively_and_enforced_on_the_stream(api_keys, monkeypatch):
+    from codemate_ai.stopping import StopConditions
+
+    response = _FakeResponse(_sse(
+        {"choices": [{"delta": {"content": "def f():\n    return 1\n"}}]},
+        {"choices": [{"delta": {"content": "\ndef g():\n"}}]},
+        {"choices": [{"delta": {"content": "    pass\n"}}]},
+        "[DONE]",
+    ))
+    session = _FakeSession(response)
+    monkeypatch.setattr(providers, "_http_session", lambda name, headers: session)
+
+    stops = StopConditions(sequences=["###"], function="f")
+    text = providers.call_provider("prompt", providers.LLMProvider.OPENAI, stops=stops)
+    assert text == "def f():\n    return 1"
+    assert session.requests[0]["json"]["stop"] == ["###"]
+    assert response.closed
+
+
+def test_blocking_wrapper_returns_error_string(api_keys, monkeypatch):
+    monkeypatch.setattr(providers.config, "max_retries", 0)
+    monkeypatch.setattr(providers, "_http_session", lambda name, headers: _FakeSession(_FakeResponse([], 500)))
+    assert providers.call_openai("prompt") == "Error: HTTP 500"
+
+    api_keys["openai"]["api_key"] = None
+    assert providers.call_openai("prompt").startswith("OpenAI API key not set")
+    with pytest.raises(providers.ProviderError):
+        list(providers.stream_openai("prompt"))
+
+
+def test_rate_limited_request_is_retried_after_retry_after(api_keys, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(providers.time, "sleep", sleeps.append)
+    session = _FakeSession(
+        _FakeResponse([], 429, headers={"Retry-After": "2"}),
+        _FakeResponse(_sse({"choices": [{"delta": {"content": "ok"}}]}, "[DONE]")),
+    )
+    monkeypatch.setattr(providers, "_http_session", lambda name, headers: session)
+
+    assert providers.call_openai("prompt") == "ok"
+    assert len(session.requests) == 2
+    assert sleeps and sleeps[0] >= 2
+    assert session.requests[0]["timeout"] is not None
+
+
+def test_client_errors_are_not_retried_and_deadlines_are_enforced(api_keys, monkeypatch):
+    session = _FakeSession(_FakeResponse([], 400))
+    monkeypatch.setattr(providers, "_http_session", lambda name, headers: session)
+    assert providers.call_openai("prompt") == "Error: HTTP 400"
+    assert len(session.requests) == 1
+
+    assert providers.call_openai("prompt", deadline=time.monotonic() - 1) == "Error: deadline exceeded"
+
+
+def test_local_generation_error_does_not_hang(monkeypatch):
+    class _Inputs(dict):
+        def to(self, device):
+            return self
+
+    class _Tokenizer:
+        eos_token_id = 0
+
+        def __call__(self, prompt, return_tensors=None):
+            return _Inputs(input_ids=[[1, 2, 3]])
+
+    class _Model:
+        device = "cpu"
+
+        def generate(self, *args, **kwargs):
+            raise RuntimeError("out of memory")
+
+    monkeypatch.setattr(providers.config, "local_model", _Model())
+    monkeypatch.setattr(providers.config, "local_tokenizer", _Tokenizer())
+    assert providers.call_local_transformers("prompt") == "Local Transformers Error: out of memory"
+
+
+class _LocalInputs(dict):
+    def to(self, device):
+        return self
+
+
+class _LocalTokenizer:
+    eos_token_id = 0
+
+    def __call__(self, prompt, return_tensors=None):
+        return _LocalInputs(input_ids=[[1, 2, 3]])
+
+    def decode(self, ids, **kwargs):
+        return ""
+
+
+class _StreamingModel:
+    """Feeds the streamer piece by piece until the stopping criteria say stop."""
+    device = "cpu"
+
+    def __init__(self, pieces, delay=0.0):
+        self.pieces = pieces
+        self.delay = delay
+        self.kwargs = None
+        self.stopped = threading.Event()
+
+    def generate(self, input_ids, **kwargs):
+        self.kwargs = kwargs
+        streamer = kwargs["streamer"]
+        for piece in self.pieces:
+            if kwargs["stopping_criteria"][0](None, None):
+                self.stopped.set()
+                break
+            streamer.on_finalized_text(piece)
+            time.sleep(self.delay)
+        streamer.end()
+
+
+@pytest.fixture
+def local_model(monkeypatch):
+    def install(model):
+        monkeypatch.setattr(providers.config, "local_model", model)
+        monkeypatch.setattr(providers.config, "local_tokenizer", _LocalTokenizer())
+        monkeypatch.setattr(providers.config, "prefix_cache", False)
+        monkeypatch.setattr(providers.config, "draft_model", None)
+        return model
+    return install
+
+
+def test_local_generation_streams_text_as_it_is_generated(local_model):
+    model = local_model(_StreamingModel(["def f():", "\n    return 1", ""]))
+
+    assert list(providers.stream_local_transformers("prompt")) == ["def f():", "\n    return 1"]
+    assert model.kwargs["max_new_tokens"] == providers.config.max_tokens
+    assert not model.stopped.is_set()
+
+
+def test_interrupted_local_generation_keeps_partial_output_and_stops(local_model):
+    model = local_model(_StreamingModel(["def f():", "\n    return 1", "\n"] * 50, delay=0.01))
+
+    received = []
+    stream = providers.stream_local_transformers("prompt")
+    with pytest.raises(KeyboardInterrupt):
+        for text in stream:
+            received.append(text)
+            if len(received) == 2:
+                raise KeyboardInterrupt
+    stream.close()
+
+    assert "".join(received) == "def f():\n    return 1"
+    # Closing the stream stops generation at the next token
+    assert model.stopped.wait(1)
+
+
+def test_local_generation_timeout_reports_the_deadline(monkeypatch):
+    class _Inputs(dict):
+        def to(self, device):
+            return self
+
+    class _Tokenizer:
+        eos_token_id = 0
+
+        def __call__(self, prompt, return_tensors=None):
+            return _Inputs(input_ids=[[1, 2, 3]])
+
+    class _Model:
+        device = "cpu"
+
+        def generate(self, *args, **kwargs):
+            time.sleep(0.5)
+
+    monkeypatch.setattr(providers.config, "local_model", _Model())
+    monkeypatch.setattr(providers.config, "local_tokenizer", _Tokenizer())
+    monkeypatch.setattr(providers.config, "prefix_cache", False)
+    monkeypatch.setattr(providers.config, "draft_model", None)
+    result = providers.call_local_transformers("prompt", deadline=time.monotonic() + 0.1)
+    assert result == "Local Transformers Error: deadline exceeded"
+
+
+def test_draft_model_is_used_for_single_sequence_generation(monkeypatch):
+    class _Inputs(dict):
+        def to(self, device):
+            return self
+
+    class _Tokenizer:
+        eos_token_id = 0
+
+        def __call__(self, prompt, return_tensors=None):
+            return _Inputs(input_ids=[[1, 2, 3]])
+
+    class _Model:
+        device = "cpu"
+        calls = []
+
+        def generate(self, *args, **kwargs):
+            self.calls.append(kwargs)
+            kwargs["streamer"].end()
+
+    draft = object()
+    monkeypatch.setattr(providers.config, "local_model", _Model())
+    monkeypatch.setattr(providers.config, "local_tokenizer", _Tokenizer())
+    monkeypatch.setattr(providers.config, "prefix_cache", False)
+    monkeypatch.setattr(providers.config, "draft_model", draft)
+    monkeypatch.setattr(providers.config, "draft_tokenizer", None)
+
+    assert list(providers.stream_local_transformers("prompt")) == []
+    assert _Model.calls[0]["assistant_model"] is draft
+    assert "assistant_tokenizer" not in _Model.calls[0]
+    # Assisted generation works on one sequence at a time
+    assert providers._assistant_kwargs(batch_size=2) == {}
+
+
+def test_batched_generation_restores_the_shared_tokenizer_padding(monkeypatch):
+    torch = pytest.importorskip("torch")
+
+    class _Inputs(dict):
+        def to(self, device):
+            return self
+
+    class _Tokenizer:
+        eos_token = "</s>"
+        pad_token = None
+        padding_side = "right"
+
+        @property
+        def pad_token_id(self):
+            return 0 if self.pad_token else None
+
+        def __call__(self, prompts, return_tensors=None, padding=False):
+            assert (self.pad_token, self.padding_side) == ("</s>", "left")
+            ids = torch.ones(len(prompts), 3, dtype=torch.long)
+            return _Inputs(input_ids=ids, attention_mask=ids)
+
+        def batch_decode(self, rows, skip_special_tokens=True):
+            return [" out" for _ in rows]
+
+    class _Model:
+        device = "cpu"
+
+        def generate(self, input_ids, **kwargs):
+            assert kwargs["pad_token_id"] == 0
+            return torch.ones(input_ids.shape[0], 5, dtype=torch.long)
+
+    tokenizer = _Tokenizer()
+    monkeypatch.setattr(providers.config, "local_model", _Model())
+    monkeypatch.setattr(providers.config, "local_tokenizer", tokenizer)
+
+    assert providers.generate_local_batch(["a", "b"], max_new_tokens=2, temperature=0.7) == ["out", "out"]
+    assert (tokenizer.pad_token, tokenizer.padding_side) == (None, "right")
+
+
+def test_stream_cached_serves_repeat_prompts(tmp_path, monkeypatch):
+    from codemate_ai.cache import ResponseCache
+
+    calls = []
+
+    def fake_stream(prompt, provider=None, deadline=None, stops=None):
+        calls.append(prompt)
+        yield "cached "
+        yield "answer"
+
+    monkeypatch.setattr(providers, "response_cache", ResponseCache(path=str(tmp_path / "r.sqlite")))
+    monkeypatch.setattr(providers, "stream_provider", fake_stream)
+    monkeypatch.setattr(providers.config, "provider", providers.LLMProvider.OPENAI)
+
+    assert "".join(providers.stream_cached("p", persona="normal")) == "cached answer"
+    assert list(providers.stream_cached("p", persona="normal")) == ["cached answer"]
+    assert len(calls) == 1
+
+    list(providers.stream_cached("p", persona="expert"))
+    list(providers.stream_cached("p", persona="normal", use_cache=False))
+    assert len(calls) == 3
+    assert providers.response_cache.stats()["hits"] == 1
+
+
+def test_agather_provider_limits_concurrency(monkeypatch):
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+
+    def fake_call(prompt, provider=None, deadline=None, stops=None):
+        with lock:
+            in_flight.append(prompt)
+            peak.append(len(in_flight))
+        time.sleep(0.05)
+        with lock:
+            in_flight.remove(prompt)
+        return prompt.upper()
+
+    monkeypatch.setattr(providers, "call_provider", fake_call)
+    prompts = [f"p{i}" for i in range(8)]
+    results = asyncio.run(providers.agather_provider(prompts, limit=3))
+    assert results == [p.upper() for p in prompts]
+    assert max(peak) == 3
+
+
+def test_acall_local_transformers_raises_like_call_provider(monkeypatch):
+    def slow_batch(prompts, max_new_tokens, temperature, stops=None):
+        time.sleep(0.5)
+        return ["late"] * len(prompts)
+
+    monkeypatch.setattr(providers, "generate_local_batch", slow_batch)
+    monkeypatch.setattr(providers, "_batcher", None)
+    monkeypatch.setattr(providers.config, "local_batching", True)
+    monkeypatch.setattr(providers.config, "local_model", None)
+    with pytest.raises(providers.ProviderError, match="Local model not loaded"):
+        asyncio.run(providers.acall_local_transformers("prompt"))
+
+    monkeypatch.setattr(providers.config, "local_model", object())
+    monkeypatch.setattr(providers.config, "local_tokenizer", object())
+    with pytest.raises(providers.ProviderError, match="deadline exceeded"):
+        asyncio.run(providers.acall_local_transformers("prompt", deadline=time.monotonic() + 0.1))
+    providers._batcher.close()
+
+
+def test_astream_provider_closes_stream_when_consumer_stops(monkeypatch):
+    closed = []
+
+    def fake_stream(prompt, provider=None, deadline=None, stops=None):
+        try:
+            for i in range(100):
+                yield f"t{i} "
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(providers, "stream_provider", fake_stream)
+
+    async def first_two():
+        received = []
+        stream = providers.astream_provider("p")
+        async for delta in stream:
+            received.append(delta)
+            if len(received) == 2:
+                break
+        await stream.aclose()
+        return received
+
+    assert providers.run_async(first_two()) == ["t0 ", "t1 "]
+    for _ in range(50):
+        if closed:
+            break
+        time.sleep(0.01)
+    assert closed
+
+
+def test_astream_provider_raises_provider_errors(monkeypatch):
+    def failing_stream(prompt, provider=None, deadline=None, stops=None):
+        yield "partial"
+        raise providers.ProviderError("Error: boom")
+
+    monkeypatch.setattr(providers, "stream_provider", failing_stream)
+
+    async def consume():
+        return [delta async for delta in providers.astream_provider("p")]
+
+    with pytest.raises(providers.ProviderError):
+        asyncio.run(consume())
+
+
+def test_requests_are_routed_over_configured_providers(monkeypatch):
+    from codemate_ai.routing import Router
+
+    def failing(prompt, deadline=None, stops=None):
+        raise providers.ProviderError("OpenAI API Error: 503")
+        yield
+
+    def working(prompt, deadline=None, stops=None):
+        yield "from anthropic"
+
+    monkeypatch.setattr(providers, "router", Router())
+    monkeypatch.setattr(providers, "stream_openai", failing)
+    monkeypatch.setattr(providers, "stream_anthropic", working)
+    monkeypatch.setattr(providers.config, "routing", [providers.LLMProvider.OPENAI, providers.LLMProvider.ANTHROPIC])
+
+    assert providers.call_provider("prompt") == "from anthropic"
+    # An explicit provider bypasses routing
+    assert providers.call_provider("prompt", providers.LLMProvider.OPENAI) == "OpenAI API Error: 503"
+    summary = providers.router.summary()
+    assert summary[providers._route_key(providers.LLMProvider.ANTHROPIC)]["samples"] == 1
+
+
+def test_bytes_on_the_wire_are_recorded_in_the_active_span(api_keys, monkeypatch):
+    from codemate_ai import telemetry
+
+    recorder = telemetry.Recorder()
+    monkeypatch.setattr(telemetry, "recorder", recorder)
+    response = _FakeResponse(_sse({"choices": [{"delta": {"content": "ok"}}]}, "[DONE]"))
+    monkeypatch.setattr(providers, "_http_session", lambda name, headers: _FakeSession(response))
+
+    @telemetry.traced
+    def generate_code():
+        return providers.call_openai("prompt")
+
+    assert generate_code() == "ok"
+    record, = recorder.records()
+    assert record["bytes_sent"] > len("prompt")
+    assert record["bytes_received"] > 0
+
+
+def test_prefix_cache_with_a_real_tiny_model_matches_fresh_generation(monkeypatch):
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    if providers._dynamic_cache_class() is None:
+        pytest.skip("transformers without DynamicCache")
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from codemate_ai.kvcache import PrefixKVCache
+
+    words = [f"w{i}" for i in range(60)]
+    backend = Tokenizer(models.WordLevel({word: i for i, word in enumerate(["[UNK]", "</s>"] + words)},
+                                         unk_token="[UNK]"))
+    backend.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=backend, unk_token="[UNK]", eos_token="</s>")
+    torch.manual_seed(0)
+    model = transformers.GPT2LMHeadModel(transformers.GPT2Config(
+        vocab_size=len(tokenizer), n_positions=256, n_embd=32, n_layer=2, n_head=2)).eval()
+
+    cache = PrefixKVCache()
+    monkeypatch.setattr(providers, "prefix_cache", cache)
+    monkeypatch.setattr(providers.config, "local_model", model)
+    monkeypatch.setattr(providers.config, "local_tokenizer", tokenizer)
+    monkeypatch.setattr(providers.config, "local_model_key", ("tiny", "float32", "cpu", None))
+    monkeypatch.setattr(providers.config, "draft_model", None)
+    monkeypatch.setattr(providers.config, "max_tokens", 8)
+
+    shared = " ".join(words[i % 50] for i in range(80))
+    prompts = [f"{shared} w5{i}" for i in range(3)]
+
+    def generate(prompt, seed):
+        torch.manual_seed(seed)
+        return providers.call_local_transformers(prompt)
+
+    monkeypatch.setattr(providers.config, "prefix_cache", False)
+    fresh = [generate(prompt, seed) for seed, prompt in enumerate(prompts)]
+
+    monkeypatch.setattr(providers.config, "prefix_cache", True)
+    # Back-to-back calls: each one must see the cache stored by the previous one
+    cached = [generate(prompt, seed) for seed, prompt in enumerate(prompts)]
+    assert cached == fresh
+    assert (cache.misses, cache.hits) == (1, 2)
+    assert cache.reused_tokens == 2 * 80
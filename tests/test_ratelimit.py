@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+from codemate_ai.ratelimit import (
+    DeadlineExceeded, RateLimiter, TokenBucket, backoff_delay, parse_retry_after, remaining
+)
+
+
+def test_token_bucket_allows_burst_then_waits():
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.reserve(60) == 0.0
+    # Empty bucket refills at one unit per second
+    assert bucket.reserve(2) == pytest.approx(2.0, abs=0.05)
+
+
+def test_unlimited_bucket_never_waits():
+    assert TokenBucket(None).reserve(10 ** 9) == 0.0
+
+
+def test_rate_limiter_refuses_waits_past_the_deadline():
+    limiter = RateLimiter(requests_per_minute=1)
+    limiter.acquire(100, deadline=time.monotonic() + 1)
+    with pytest.raises(DeadlineExceeded):
+        limiter.acquire(100, deadline=time.monotonic() + 1)
+
+
+def test_rejected_acquire_gives_its_budget_back():
+    limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=600)
+    limiter.acquire(600)
+    with pytest.raises(DeadlineExceeded):
+        limiter.acquire(600, deadline=time.monotonic() + 1)
+    # Only the first call's usage counts: one request left, tokens refill at ten per second
+    assert limiter.requests.reserve(1) == 0.0
+    assert limiter.tokens.reserve(10) == pytest.approx(1.0, abs=0.05)
+
+
+def test_parse_retry_after_accepts_seconds_and_dates():
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after("soon") is None
+
+
+def test_backoff_delay_is_bounded_and_honors_retry_after():
+    for attempt in range(10):
+        assert 0 <= backoff_delay(attempt, cap=4.0) <= 4.0
+    assert backoff_delay(0, retry_after=5.0) >= 5.0
+
+
+def test_remaining_raises_once_the_deadline_passed():
+    assert remaining(None) is None
+    assert remaining(time.monotonic() + 10) > 9
+    with pytest.raises(DeadlineExceeded):
+        remaining(time.monotonic() - 1)
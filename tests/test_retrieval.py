@@ -0,0 +1,36 @@
+from codemate_ai.retrieval import CodeIndex, tokenize
+
+
+def _chunk(name, source):
+    return {"name": name, "kind": "function", "source": source}
+
+
+def test_tokenize_splits_identifiers():
+    assert tokenize("loadCsvFile(path_to_data)") == [
+        "loadcsvfile", "load", "csv", "file", "path_to_data", "path", "to", "data"]
+
+
+def test_search_ranks_matching_chunks_first(tmp_path):
+    index = CodeIndex(path=str(tmp_path / "index.json"))
+    index.update_cell("a", [_chunk("load_csv", "def load_csv(path):\n    return pd.read_csv(path)")])
+    index.update_cell("b", [_chunk("plot", "def plot(df):\n    df.plot()"),
+                            _chunk("train", "def train(model, df):\n    model.fit(df)")])
+
+    hits = index.search("read the csv file", k=2)
+    assert [hit["name"] for hit in hits] == ["load_csv"]
+    assert index.search("fit model")[0]["name"] == "train"
+    assert index.search("nothing matches this") == []
+
+
+def test_sync_is_incremental_and_persistent(tmp_path):
+    path = str(tmp_path / "index.json")
+    index = CodeIndex(path=path)
+    index.sync({"a": [_chunk("alpha", "alpha = 1")], "b": [_chunk("beta", "beta = 2")]})
+    index.sync({"b": [_chunk("beta", "beta = 2")], "c": [_chunk("gamma", "gamma = 3")]})
+    assert len(index) == 2
+    assert index.search("alpha") == []
+    index.save()
+
+    reloaded = CodeIndex.load(path)
+    assert len(reloaded) == 2
+    assert reloaded.search("gamma")[0]["name"] == "gamma"
@@ -0,0 +1,98 @@
+import time
+import threading
+import pytest
+from codemate_ai.routing import LatencyStats, Router
+
+
+def _stream(text, delay=0.0, closed=None, key=None):
+    try:
+        time.sleep(delay)
+        yield text
+    finally:
+        if closed is not None:
+            closed.append(key)
+
+
+def _warm(router, key, latency, samples=5):
+    for _ in range(samples):
+        router.stats(key).record(latency)
+
+
+def test_latency_stats_percentiles_and_error_rate():
+    stats = LatencyStats(window=10)
+    for latency in [0.1, 0.2, 0.3, 0.4, 1.0]:
+        stats.record(latency)
+    stats.record(None, ok=False)
+
+    assert stats.p50 == 0.3
+    assert stats.p95 == 1.0
+    assert stats.error_rate == pytest.approx(1 / 6)
+
+
+def test_router_prefers_fast_healthy_providers():
+    router = Router(min_samples=2)
+    _warm(router, "slow", 2.0)
+    _warm(router, "fast", 0.1)
+    _warm(router, "broken", 0.01)
+    for _ in range(10):
+        router.stats("broken").record(None, ok=False)
+
+    # Unmeasured providers are tried first so they get measured
+    assert router.rank(["slow", "broken", "fast", "new"]) == ["new", "fast", "slow", "broken"]
+
+
+def test_router_fails_over_to_the_next_provider():
+    router = Router()
+    _warm(router, "a", 0.1)
+    _warm(router, "b", 0.2)
+
+    def open_stream(key):
+        if key == "a":
+            raise RuntimeError("503")
+        return _stream("from b")
+
+    assert "".join(router.stream(["a", "b"], open_stream)) == "from b"
+    assert router.stats("a").error_rate > 0
+
+
+def test_slow_request_is_hedged_and_loser_cancelled():
+    router = Router()
+    _warm(router, "a", 0.05)
+    _warm(router, "b", 0.06)
+    closed = []
+
+    def open_stream(key):
+        return _stream(f"from {key}", delay=1.0 if key == "a" else 0.0, closed=closed, key=key)
+
+    start = time.monotonic()
+    assert "".join(router.stream(["a", "b"], open_stream)) == "from b"
+    assert time.monotonic() - start < 0.5
+    assert router.hedged == 1 and router.hedge_wins == 1
+
+    # The slow attempt is closed once it produces its first chunk
+    for _ in range(40):
+        if "a" in closed:
+            break
+        time.sleep(0.05)
+    assert closed == ["b", "a"]
+
+
+def test_deadline_cancels_running_attempts_and_counts_them_as_failures():
+    from codemate_ai.ratelimit import DeadlineExceeded
+
+    router = Router(hedge=False)
+    closed = []
+
+    def open_stream(key):
+        return _stream("late", delay=0.3, closed=closed, key=key)
+
+    with pytest.raises(DeadlineExceeded):
+        "".join(router.stream(["hung"], open_stream, deadline=time.monotonic() + 0.05))
+    assert router.stats("hung").error_rate == 1.0
+
+    # The hung attempt is closed as soon as it answers instead of being left open
+    for _ in range(20):
+        if closed:
+            break
+        time.sleep(0.05)
+    assert closed == ["hung"]
@@ -0,0 +1,89 @@
+import pytest
+
+from codemate_ai.stopping import StopConditions, StopCriteria, apply_stops
+
+RESPONSE = """Here is the function:
+```python
+import math
+
+def area(radius: float,
+         scale: float = 1.0) -> float:
+    \"\"\"Area of a circle.\"\"\"
+
+    return math.pi * radius ** 2 * scale
+
+print(area(2))
+```
+It computes the area.
+"""
+
+
+def test_function_stop_ends_at_the_first_dedented_line():
+    stops = StopConditions(function="area")
+    end = stops.cut(RESPONSE)
+    assert RESPONSE[:end].endswith("return math.pi * radius ** 2 * scale\n\n")
+
+
+def test_function_stop_keeps_a_closing_fence_and_handles_one_liners():
+    text = "```python\ndef area(r):\n    return r * r\n```\nMore text\n"
+    assert text[:StopConditions(function="area").cut(text)] == "```python\ndef area(r):\n    return r * r\n```\n"
+    assert StopConditions(function="sq").cut("def sq(x): return x * x\nprint(1)\n") == len("def sq(x): return x * x\n")
+    assert StopConditions(function="area").cut("def area(r):\n    return r") is None
+
+
+def test_function_stop_ignores_dedented_lines_inside_triple_quoted_strings():
+    text = 'def query():\n    sql = """\nSELECT *\nFROM t\n"""\n    return sql\nprint(query())\n'
+    assert text[:StopConditions(function="query").cut(text)].endswith("    return sql\n")
+
+
+def test_function_stop_skips_code_blocks_before_the_function():
+    text = "```python\nimport os\n```\nThen:\n```python\ndef f():\n    return 1\n```\nDone.\n"
+    stops = StopConditions.parse("function", function="f")
+    assert text[:stops.cut(text)] == text[:-len("Done.\n")]
+    assert stops.cut("```python\nimport os\n```\nThen:\n") is None
+
+
+def test_fence_stop_and_custom_sequences():
+    assert RESPONSE[:StopConditions(fence=True).cut(RESPONSE)].endswith("print(area(2))\n```\n")
+    assert StopConditions(sequences=["print("]).cut(RESPONSE) == RESPONSE.index("print(")
+    assert StopConditions(fence=True).cut("```python\nx = 1\n") is None
+
+
+def test_apply_stops_holds_back_partial_stop_sequences_and_closes_the_stream():
+    closed = []
+
+    def stream():
+        try:
+            yield from ["answer E", "N", "D and more", " never sent"]
+        finally:
+            closed.append(True)
+
+    chunks = list(apply_stops(stream(), StopConditions(sequences=["END"])))
+    assert "".join(chunks) == "answer "
+    assert closed
+
+
+def test_apply_stops_streams_whole_lines_for_structural_stops():
+    deltas = [RESPONSE[i:i + 7] for i in range(0, len(RESPONSE), 7)]
+    chunks = list(apply_stops(iter(deltas), StopConditions(function="area")))
+    assert "".join(chunks) == RESPONSE[:StopConditions(function="area").cut(RESPONSE)]
+    assert all(chunk.endswith("\n") for chunk in chunks)
+
+
+def test_parse_magic_option():
+    assert StopConditions.parse(None) is None
+    assert StopConditions.parse("none", function="f") is None
+    assert StopConditions.parse("function", function="f") == StopConditions(fence=True, function="f")
+    assert StopConditions.parse("###\\n").sequences == ("###\n",)
+
+
+def test_stop_criteria_flags_each_sequence_of_a_batch():
+    torch = pytest.importorskip("torch")
+
+    class _Tokenizer:
+        def decode(self, ids, skip_special_tokens=True):
+            return "".join(chr(int(i)) for i in ids)
+
+    ids = torch.tensor([[ord(c) for c in "p:ab#"], [ord(c) for c in "p:abc"]])
+    criteria = StopCriteria(StopConditions(sequences=["#"]), _Tokenizer(), prompt_length=2)
+    assert criteria(ids, None).tolist() == [True, False]
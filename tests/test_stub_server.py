@@ -0,0 +1,37 @@
+import time
+import pytest
+from codemate_ai import providers
+from codemate_ai.stopping import StopConditions
+from codemate_ai.stub_server import StubServer, DEFAULT_RESPONSE, split_tokens
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    keys = {name: dict(entry) for name, entry in providers.config.api_keys.items()}
+    monkeypatch.setattr(providers.config, "api_keys", keys)
+    with StubServer(latency=0.05, tokens_per_second=500) as server:
+        keys["openai"].update(api_key=None, base_url=server.url, model="stub-model")
+        yield server
+
+
+def test_split_tokens_round_trips():
+    assert "".join(split_tokens(DEFAULT_RESPONSE)) == DEFAULT_RESPONSE
+
+
+def test_openai_provider_streams_from_configured_base_url(stub):
+    start = time.monotonic()
+    chunks = list(providers.stream_openai("Reverse a string"))
+    assert "".join(chunks) == DEFAULT_RESPONSE
+    assert len(chunks) == len(split_tokens(DEFAULT_RESPONSE))
+    assert time.monotonic() - start >= stub.latency
+    assert stub.last_request["model"] == "stub-model"
+    assert stub.last_request["stream"] is True
+
+
+def test_stub_honors_stop_and_max_tokens(stub, monkeypatch):
+    assert providers.call_provider("prompt", providers.LLMProvider.OPENAI,
+                                   stops=StopConditions(sequences=["def "])) == DEFAULT_RESPONSE.split("def ")[0].strip()
+
+    monkeypatch.setattr(providers.config, "max_tokens", 3)
+    assert providers.call_openai("prompt") == "".join(split_tokens(DEFAULT_RESPONSE)[:3]).strip()
+    assert stub.requests == 2
@@ -0,0 +1,97 @@
+import json
+import threading
+import contextvars
+import pytest
+from codemate_ai import telemetry
+from codemate_ai.telemetry import Recorder, percentile
+
+
+@pytest.fixture
+def recorder(monkeypatch, tmp_path):
+    recorder = Recorder(capacity=3, sink=str(tmp_path / "spans.jsonl"))
+    monkeypatch.setattr(telemetry, "recorder", recorder)
+    return recorder
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile(range(1, 101), 95) == 95
+
+
+def test_traced_records_stages_and_counters(recorder):
+    @telemetry.traced
+    def generate_code(line):
+        telemetry.mark("prompt")
+        telemetry.mark("provider")
+        telemetry.annotate(provider="openai", model="gpt-4", ttft=0.25)
+        telemetry.count(prompt_tokens=100, bytes_sent=400)
+        telemetry.count(bytes_sent=100, retries=1)
+        return line
+
+    assert generate_code("f") == "f"
+    record, = recorder.records()
+    assert record["magic"] == "generate_code"
+    assert set(record["stages"]) == {"prompt", "provider"}
+    assert record["bytes_sent"] == 500 and record["retries"] == 1
+    assert record["provider"] == "openai" and record["ttft"] == 0.25
+
+    # Outside a magic nothing is recorded
+    telemetry.count(bytes_sent=1)
+    assert len(recorder.records()) == 1
+
+    with open(recorder.sink) as f:
+        assert json.loads(f.readline())["magic"] == "generate_code"
+
+
+def test_summary_groups_by_magic_and_provider(recorder):
+    @telemetry.traced
+    def explain_code(provider, hit=False):
+        telemetry.annotate(provider=provider, cache_hit=hit)
+
+    @telemetry.traced
+    def debug_cell():
+        raise ValueError("boom")
+
+    explain_code("openai")
+    explain_code("openai", hit=True)
+    with pytest.raises(ValueError):
+        debug_cell()
+
+    by_magic = recorder.summary("magic")
+    assert by_magic["explain_code"]["count"] == 2
+    assert by_magic["explain_code"]["cache_hit_rate"] == 0.5
+    assert by_magic["debug_cell"]["errors"] == 1
+    assert recorder.summary("provider")["openai"]["count"] == 2
+
+    # The ring buffer keeps the most recent spans only
+    explain_code("anthropic")
+    assert [r["magic"] for r in recorder.records()] == ["explain_code", "debug_cell", "explain_code"]
+
+
+def test_worker_counts_reach_their_own_magic_only(recorder):
+    def in_thread(target, *args, **kwargs):
+        worker = threading.Thread(target=target, args=args, kwargs=kwargs)
+        worker.start()
+        worker.join()
+
+    contexts = []
+
+    @telemetry.traced
+    def generate_code():
+        context = contextvars.copy_context()
+        in_thread(context.run, telemetry.count, bytes_received=10)
+        contexts.append(context)
+
+    @telemetry.traced
+    def explain_code():
+        # A straggler of the previous magic and a thread outside any magic are not counted here
+        contexts[0].run(telemetry.count, bytes_received=99)
+        in_thread(telemetry.count, bytes_received=5)
+        telemetry.count(bytes_received=1)
+
+    generate_code()
+    explain_code()
+    first, second = recorder.records()
+    assert first["bytes_received"] == 10
+    assert second["bytes_received"] == 1